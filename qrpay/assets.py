@@ -0,0 +1,11 @@
+import os
+from functools import lru_cache
+
+STATIC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "static")
+
+@lru_cache(maxsize=None)
+def load_static(name):
+    # Contents of a file in qrpay/static, read once per process and shared by
+    # every session
+    with open(os.path.join(STATIC_DIR, name), encoding="utf-8") as f:
+        return f.read()
@@ -0,0 +1,153 @@
+# Bulk QR decoding for directories, zip archives and videos.
+#
+# Decodes every image (or video frame) with detect_qr_code/parse_qr_data across
+# all cores and streams one JSON object per item as soon as it is done:
+#
+#     python -m qrpay.batch slips/ archive.zip counter.mp4 > results.jsonl
+#
+# Only a bounded number of items is in flight at any time, so memory use does
+# not grow with the size of the input.
+import argparse
+import json
+import os
+import sys
+import time
+import zipfile
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+import cv2
+import numpy as np
+
+from qrpay.qr import detect_qr_code, parse_qr_data, warm_up_qr_detector
+
+IMAGE_EXTENSIONS = {".jpg", ".jpeg", ".png", ".bmp", ".tif", ".tiff"}
+VIDEO_EXTENSIONS = {".mp4", ".avi", ".mov", ".mkv", ".webm"}
+
+# Frames per video task; each task opens the video once and seeks to its start
+VIDEO_CHUNK = 120
+
+def iter_tasks(inputs, frame_step=1):
+    # Lazily expand the inputs into (kind, source, item, payload) tasks
+    for path in inputs:
+        if os.path.isdir(path):
+            for root, dirs, files in os.walk(path):
+                dirs.sort()
+                for name in sorted(files):
+                    yield from file_tasks(os.path.join(root, name), frame_step)
+        else:
+            yield from file_tasks(path, frame_step)
+
+def file_tasks(path, frame_step):
+    ext = os.path.splitext(path)[1].lower()
+    if ext == ".zip":
+        # Members are read one at a time, only when the pool has room for them
+        with zipfile.ZipFile(path) as archive:
+            for info in archive.infolist():
+                if os.path.splitext(info.filename)[1].lower() in IMAGE_EXTENSIONS:
+                    yield "bytes", path, info.filename, archive.read(info)
+    elif ext in IMAGE_EXTENSIONS:
+        yield "image", path, None, None
+    elif ext in VIDEO_EXTENSIONS:
+        capture = cv2.VideoCapture(path)
+        frame_count = int(capture.get(cv2.CAP_PROP_FRAME_COUNT))
+        capture.release()
+        if frame_count <= 0:
+            yield "error", path, None, "could not read video"
+        for start in range(0, frame_count, VIDEO_CHUNK):
+            yield "video", path, (start, min(start + VIDEO_CHUNK, frame_count), frame_step), None
+
+def decode_image(img, source, item):
+    record = {"source": source, "item": item, "ok": False, "qr_data": None,
+              "payment": None, "decode_ms": None, "error": None}
+    if img is None:
+        record["error"] = "could not decode image"
+        return record
+    started = time.perf_counter()
+    _, qr_value = detect_qr_code(img)
+    payment = parse_qr_data(qr_value) if qr_value else None
+    record["decode_ms"] = round((time.perf_counter() - started) * 1000, 2)
+    record["qr_data"] = qr_value
+    record["payment"] = payment
+    record["ok"] = payment is not None
+    if qr_value is None:
+        record["error"] = "no QR code found"
+    elif payment is None:
+        record["error"] = "not a payment QR code"
+    return record
+
+def process_task(kind, source, item, payload):
+    # Runs in a worker process and returns the records for one task
+    try:
+        if kind == "image":
+            return [decode_image(cv2.imread(source, cv2.IMREAD_COLOR), source, item)]
+        if kind == "bytes":
+            img = cv2.imdecode(np.frombuffer(payload, np.uint8), cv2.IMREAD_COLOR)
+            return [decode_image(img, source, item)]
+        if kind == "video":
+            start, stop, step = item
+            capture = cv2.VideoCapture(source)
+            capture.set(cv2.CAP_PROP_POS_FRAMES, start)
+            records = []
+            for index in range(start, stop):
+                ok, frame = capture.read()
+                if not ok:
+                    break
+                if index % step == 0:
+                    records.append(decode_image(frame, source, index))
+            capture.release()
+            return records
+        raise ValueError(payload)
+    except Exception as e:
+        return [{"source": source, "item": item, "ok": False, "qr_data": None,
+                 "payment": None, "decode_ms": None, "error": str(e)}]
+
+def init_worker():
+    # Keep the decoders' progress prints off stdout, which carries the JSON Lines
+    sys.stdout = sys.stderr
+    # Each worker process reuses one detector for all its tasks; build it now
+    warm_up_qr_detector()
+
+def decode_batch(inputs, workers=None, frame_step=1, max_in_flight=None):
+    # Yield one record per decoded item, in completion order
+    workers = workers or os.cpu_count() or 1
+    max_in_flight = max_in_flight or workers * 2
+    with ProcessPoolExecutor(max_workers=workers, initializer=init_worker) as pool:
+        pending = set()
+        for task in iter_tasks(inputs, frame_step):
+            pending.add(pool.submit(process_task, *task))
+            if len(pending) >= max_in_flight:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    yield from future.result()
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                yield from future.result()
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Decode payment QR codes in bulk")
+    parser.add_argument("inputs", nargs="+", help="Image files, directories, zip archives or videos")
+    parser.add_argument("-o", "--output", help="Write JSON Lines here instead of stdout")
+    parser.add_argument("-j", "--workers", type=int, help="Worker processes (default: all cores)")
+    parser.add_argument("--frame-step", type=int, default=1, help="Decode every Nth video frame")
+    args = parser.parse_args(argv)
+
+    out = open(args.output, "w") if args.output else sys.stdout
+    started = time.perf_counter()
+    total = decoded = 0
+    try:
+        for record in decode_batch(args.inputs, args.workers, args.frame_step):
+            out.write(json.dumps(record) + "\n")
+            out.flush()
+            total += 1
+            decoded += record["ok"]
+    finally:
+        if out is not sys.stdout:
+            out.close()
+    elapsed = time.perf_counter() - started
+    print(f"Decoded {decoded}/{total} items in {elapsed:.1f}s "
+          f"({total / elapsed if elapsed else 0:.1f} items/s)", file=sys.stderr)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
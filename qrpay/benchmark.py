@@ -0,0 +1,273 @@
+# Offline scanner benchmark.
+#
+# Builds a synthetic corpus with generate_qr_array, renders it under several
+# distortions and resolutions, and runs both the upload path (the enhanced_decode
+# ladder) and the live QRCodeScanner.recv logic headlessly. Each configuration runs in
+# its own process so peak RSS can be reported per configuration.
+#
+#     python -m qrpay.benchmark --samples 10 --json bench.json
+#     python -m qrpay.benchmark --compare bench.json
+import argparse
+import json
+import multiprocessing
+import resource
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import av
+import cv2
+import numpy as np
+
+from qrpay.payload import encode_qr_payload
+from qrpay.enhance import enhanced_decode
+from qrpay.ingest import load_upload_gray
+from qrpay.qr import generate_qr_array, get_decode_executor
+
+RESOLUTIONS = {
+    "480p": (640, 480),
+    "720p": (1280, 720),
+    "1080p": (1920, 1080),
+    "12mp": (4000, 3000),
+    "40mp": (7296, 5472),
+}
+
+def rotate(img, rng):
+    h, w = img.shape[:2]
+    rotation = cv2.getRotationMatrix2D((w / 2, h / 2), rng.uniform(-30, 30), 1.0)
+    return cv2.warpAffine(img, rotation, (w, h), borderMode=cv2.BORDER_REPLICATE)
+
+def blur(img, rng):
+    # Kernel grows with resolution so the blur looks similar at every size
+    k = max(3, (min(img.shape[:2]) // 240) | 1)
+    return cv2.GaussianBlur(img, (k, k), 0)
+
+def perspective(img, rng):
+    h, w = img.shape[:2]
+    src = np.float32([[0, 0], [w, 0], [w, h], [0, h]])
+    jitter = rng.uniform(-0.08, 0.08, size=(4, 2)) * [w, h]
+    warp = cv2.getPerspectiveTransform(src, (src + jitter).astype(np.float32))
+    return cv2.warpPerspective(img, warp, (w, h), borderMode=cv2.BORDER_REPLICATE)
+
+def noise(img, rng):
+    grain = rng.normal(0, 12, img.shape)
+    return np.clip(img + grain, 0, 255).astype(np.uint8)
+
+def low_light(img, rng):
+    dark = cv2.convertScaleAbs(img, alpha=0.25, beta=5)
+    return noise(dark, rng) if rng.random() < 0.5 else dark
+
+def low_contrast(img, rng):
+    # Faded print photographed in flat light, with a little sensor noise
+    faded = cv2.convertScaleAbs(img, alpha=0.05, beta=122)
+    return np.clip(faded + rng.normal(0, 3, img.shape), 0, 255).astype(np.uint8)
+
+def defocus(img, rng):
+    # Camera focused past the code; stronger than "blur" and scaled to the frame
+    return cv2.GaussianBlur(img, (0, 0), 4 * min(img.shape[:2]) / 720)
+
+def inverted(img, rng):
+    # Light modules on a dark background
+    return cv2.bitwise_not(img)
+
+DISTORTIONS = {
+    "clean": lambda img, rng: img,
+    "rotation": rotate,
+    "blur": blur,
+    "perspective": perspective,
+    "noise": noise,
+    "low_light": low_light,
+    "low_contrast": low_contrast,
+    "defocus": defocus,
+    "inverted": inverted,
+}
+
+def build_sample(index, resolution, distortion, seed=0):
+    # Render one payment code at a random place on a frame of the given size
+    rng = np.random.default_rng(seed * 1000 + index)
+    data = {
+        "type": "payment",
+        "sender": f"Merchant {index}",
+        "sender_cnic": f"{rng.integers(10000, 99999)}-{rng.integers(1000000, 9999999)}-{index % 10}",
+        "amount": round(float(rng.uniform(1, 50000)), 2),
+    }
+    code = cv2.cvtColor(generate_qr_array(data, box_size=4), cv2.COLOR_GRAY2BGR)
+    width, height = RESOLUTIONS[resolution]
+    side = int(min(width, height) * rng.uniform(0.35, 0.6))
+    code = cv2.resize(code, (side, side), interpolation=cv2.INTER_NEAREST)
+    frame = np.full((height, width, 3), 200, np.uint8)
+    x = int(rng.integers(0, width - side))
+    y = int(rng.integers(0, height - side))
+    frame[y:y + side, x:x + side] = code
+    return DISTORTIONS[distortion](frame, rng), encode_qr_payload(data)
+
+def percentiles(values):
+    if not values:
+        return {"p50": None, "p95": None, "p99": None}
+    p50, p95, p99 = np.percentile(values, [50, 95, 99])
+    return {"p50": round(float(p50), 2), "p95": round(float(p95), 2), "p99": round(float(p99), 2)}
+
+def peak_rss_mb():
+    # ru_maxrss is KiB on Linux and bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return round(peak / (1024 * 1024 if sys.platform == "darwin" else 1024), 1)
+
+def upload_sample(img, expected):
+    # A sample as the Upload Image tab receives it: JPEG bytes
+    return cv2.imencode(".jpg", img, [cv2.IMWRITE_JPEG_QUALITY, 90])[1].tobytes(), expected
+
+def build_upload_sample(index, resolution, distortion, seed=0):
+    return upload_sample(*build_sample(index, resolution, distortion, seed))
+
+def bench_upload(samples, count):
+    # Load each JPEG and run the enhancement ladder on the shared decode
+    # threads, as the Upload Image tab does. samples may be lazy; only the
+    # decode of each one is timed.
+    executor = get_decode_executor()
+    latencies, decoded, stages, load_estimate = [], 0, {}, 0
+    for data, expected in samples:
+        t = time.perf_counter()
+        img, image = load_upload_gray(data)
+        qr_value, stage = enhanced_decode(img, executor=executor)
+        latencies.append((time.perf_counter() - t) * 1000)
+        decoded += qr_value == expected
+        stages[stage or "failed"] = stages.get(stage or "failed", 0) + 1
+        load_estimate = max(load_estimate, image["load_bytes_estimate"])
+    total = sum(latencies) / 1000
+    return {
+        "fps": round(count / total, 2) if total else None,
+        "latency_ms": percentiles(latencies),
+        "success_rate": round(decoded / count, 3),
+        "stages": stages,
+        # Largest estimated loading footprint; peak_rss_mb is the measured one
+        "load_estimate_mb": round(load_estimate / (1024 * 1024), 1),
+    }
+
+def bench_live(samples, count, fps=30, max_frames=90):
+    # Feed each image to a fresh QRCodeScanner as a paced yuv420p stream, the
+    # way WebRTC delivers it, until the scanner confirms a code or gives up.
+    # samples may be lazy; only recv and the time to confirm are timed.
+    from qrpay.scanner import QRCodeScanner
+
+    recv_latencies, confirm_latencies, decoded, frames = [], [], 0, 0
+    recv_total = 0.0
+    for img, expected in samples:
+        scanner = QRCodeScanner(session_sync=False)
+        frame = av.VideoFrame.from_ndarray(img, format="bgr24").reformat(format="yuv420p")
+        started = time.perf_counter()
+        for i in range(max_frames):
+            frame.pts = i
+            t = time.perf_counter()
+            scanner.recv(frame)
+            elapsed = time.perf_counter() - t
+            recv_latencies.append(elapsed * 1000)
+            recv_total += elapsed
+            frames += 1
+            if scanner.qr_code is not None:
+                break
+            time.sleep(max(0.0, 1.0 / fps - elapsed))
+        if scanner.qr_code == expected:
+            decoded += 1
+            confirm_latencies.append((time.perf_counter() - started) * 1000)
+        scanner.on_ended()
+    return {
+        "fps": round(frames / recv_total, 2) if recv_total else None,
+        "latency_ms": percentiles(recv_latencies),
+        "time_to_confirm_ms": percentiles(confirm_latencies),
+        "success_rate": round(decoded / count, 3),
+    }
+
+def run_config(path, resolution, distortion, count, seed):
+    # peak_rss_mb should measure the scanning, not the corpus, so samples are
+    # never all held at once: uploads are rendered and encoded in a helper
+    # process (only their JPEG bytes come back), live frames one at a time.
+    indexes = range(count)
+    if path == "upload":
+        context = multiprocessing.get_context("spawn")
+        with ProcessPoolExecutor(max_workers=1, mp_context=context) as builder:
+            # One at a time, so building never competes with a timed decode
+            samples = (builder.submit(build_upload_sample, i, resolution, distortion, seed).result()
+                       for i in indexes)
+            result = bench_upload(samples, count)
+    else:
+        result = bench_live((build_sample(i, resolution, distortion, seed) for i in indexes), count)
+    result.update(path=path, resolution=resolution, distortion=distortion, samples=count)
+    result["peak_rss_mb"] = peak_rss_mb()
+    return result
+
+def run(paths, resolutions, distortions, count, seed=0, isolate=True):
+    results = []
+    for path in paths:
+        for resolution in resolutions:
+            for distortion in distortions:
+                args = (path, resolution, distortion, count, seed)
+                if isolate:
+                    # Fresh process per configuration so peak RSS is not shared
+                    context = multiprocessing.get_context("spawn")
+                    with ProcessPoolExecutor(max_workers=1, mp_context=context) as pool:
+                        result = pool.submit(run_config, *args).result()
+                else:
+                    result = run_config(*args)
+                print_row(result)
+                results.append(result)
+    return results
+
+def print_row(result):
+    latency = result["latency_ms"]
+    print(f"{result['path']:<7} {result['resolution']:<6} {result['distortion']:<12} "
+          f"{result['fps'] or 0:>9.1f} {latency['p50'] or 0:>8.1f} {latency['p95'] or 0:>8.1f} "
+          f"{latency['p99'] or 0:>8.1f} {result['success_rate'] * 100:>8.1f}% {result['peak_rss_mb']:>9.1f}")
+
+def compare(results, baseline, tolerance):
+    # Flag configurations that got slower or decode less than the baseline
+    previous = {(r["path"], r["resolution"], r["distortion"]): r for r in baseline}
+    regressions = []
+    for result in results:
+        old = previous.get((result["path"], result["resolution"], result["distortion"]))
+        if old is None:
+            continue
+        name = f"{result['path']}/{result['resolution']}/{result['distortion']}"
+        if result["success_rate"] < old["success_rate"]:
+            regressions.append(f"{name}: success rate {old['success_rate']} -> {result['success_rate']}")
+        old_p95, new_p95 = old["latency_ms"]["p95"], result["latency_ms"]["p95"]
+        if old_p95 and new_p95 and new_p95 > old_p95 * (1 + tolerance):
+            regressions.append(f"{name}: p95 latency {old_p95} ms -> {new_p95} ms")
+    return regressions
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark QR scanning on a synthetic corpus")
+    parser.add_argument("--path", action="append", choices=["upload", "live"],
+                        help="Scanning path to benchmark (default: both)")
+    parser.add_argument("--resolution", action="append", choices=list(RESOLUTIONS),
+                        help="Frame size (default: all)")
+    parser.add_argument("--distortion", action="append", choices=list(DISTORTIONS),
+                        help="Image distortion (default: all)")
+    parser.add_argument("--samples", type=int, default=10, help="Images per configuration")
+    parser.add_argument("--seed", type=int, default=0, help="Corpus seed")
+    parser.add_argument("--no-isolate", action="store_true",
+                        help="Run every configuration in this process (peak RSS becomes cumulative)")
+    parser.add_argument("--json", help="Write the results to this file")
+    parser.add_argument("--compare", help="Baseline JSON from an earlier run to check for regressions")
+    parser.add_argument("--tolerance", type=float, default=0.2,
+                        help="Allowed relative p95 latency increase over the baseline")
+    args = parser.parse_args(argv)
+
+    print(f"{'path':<7} {'res':<6} {'distortion':<12} {'fps':>9} {'p50 ms':>8} {'p95 ms':>8} "
+          f"{'p99 ms':>8} {'success':>9} {'rss MB':>9}")
+    results = run(args.path or ["upload", "live"], args.resolution or list(RESOLUTIONS),
+                  args.distortion or list(DISTORTIONS), args.samples, args.seed,
+                  isolate=not args.no_isolate)
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for line in regressions:
+            print(f"REGRESSION {line}")
+        return 1 if regressions else 0
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
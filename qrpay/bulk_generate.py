@@ -0,0 +1,184 @@
+# Bulk payment QR generation.
+#
+# Reads payment rows from a CSV or JSON Lines file (sender, sender_cnic, amount
+# and an optional invoice / filename), renders the codes on a process pool and
+# streams them into a ZIP or tar archive as they finish, next to a per-row
+# status manifest:
+#
+#     python -m qrpay.bulk_generate merchants.csv -o codes.zip
+#     python -m qrpay.bulk_generate invoices.jsonl -o codes.tar.gz --format svg
+#
+# Only a bounded number of rows is in flight, so memory use does not depend on
+# the size of the input.
+import argparse
+import csv
+import io
+import json
+import os
+import re
+import sys
+import tarfile
+import time
+import zipfile
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+from qrpay.payments import validate_cnic
+from qrpay.qr import generate_qr_code, generate_qr_svg
+
+MANIFEST_FIELDS = ["row", "file", "status", "error", "bytes", "render_ms"]
+
+def read_rows(path):
+    # Lazily yield payment rows from a CSV (with a header) or JSON Lines file.
+    # A line that is not a JSON object is yielded as a ValueError, so it ends
+    # up in the manifest as that row's error instead of stopping the job.
+    with open(path, newline="") as f:
+        if path.lower().endswith((".jsonl", ".ndjson", ".json")):
+            for number, line in enumerate(f, start=1):
+                if not line.strip():
+                    continue
+                try:
+                    row = json.loads(line)
+                except json.JSONDecodeError as e:
+                    yield ValueError(f"line {number}: invalid JSON: {e.msg}")
+                    continue
+                if not isinstance(row, dict):
+                    yield ValueError(f"line {number}: not a JSON object")
+                    continue
+                yield row
+        else:
+            yield from csv.DictReader(f)
+
+def row_to_payment(row):
+    # Build the same payload the Generate Payment QR tab encodes
+    sender = str(row.get("sender") or "").strip()
+    sender_cnic = str(row.get("sender_cnic") or "").strip()
+    if not sender:
+        raise ValueError("missing sender")
+    if not validate_cnic(sender_cnic):
+        raise ValueError("CNIC must be in the exact format: 00000-0000000-0")
+    amount = float(row.get("amount") or 0)
+    if amount < 1.0:
+        raise ValueError("amount must be at least 1.00")
+    payment = {"type": "payment", "sender": sender, "sender_cnic": sender_cnic, "amount": amount}
+    if row.get("invoice"):
+        payment["invoice"] = str(row["invoice"])
+    return payment
+
+def file_name(index, row, payment, fmt):
+    name = row.get("filename") or f"{index:06d}_{payment['sender']}_{payment['amount']:.2f}"
+    name = re.sub(r"[^A-Za-z0-9._-]+", "_", str(name)).strip("_") or f"{index:06d}"
+    return f"{name}.{fmt}"
+
+def render_row(index, row, fmt, box_size):
+    # Runs in a worker process: returns the file name, its bytes and a manifest entry
+    started = time.perf_counter()
+    entry = {"row": index, "file": None, "status": "error", "error": None, "bytes": 0, "render_ms": None}
+    try:
+        if isinstance(row, Exception):
+            raise row
+        payment = row_to_payment(row)
+        if fmt == "svg":
+            data = generate_qr_svg(payment, box_size)
+        else:
+            buf = io.BytesIO()
+            generate_qr_code(payment, box_size).save(buf, format="PNG")
+            data = buf.getvalue()
+        entry.update(file=file_name(index, row, payment, fmt), status="ok", bytes=len(data))
+    except Exception as e:
+        data = None
+        entry["error"] = str(e)
+    entry["render_ms"] = round((time.perf_counter() - started) * 1000, 2)
+    return entry, data
+
+class ArchiveWriter:
+    # Appends files one at a time to a ZIP or (optionally compressed) tar archive
+    def __init__(self, path):
+        lower = path.lower()
+        if lower.endswith(".zip"):
+            self.zip = zipfile.ZipFile(path, "w")
+            self.tar = None
+        else:
+            mode = "w:gz" if lower.endswith((".tar.gz", ".tgz")) else "w:bz2" if lower.endswith(".tar.bz2") else "w"
+            self.zip = None
+            self.tar = tarfile.open(path, mode)
+        self.names = set()
+
+    def add(self, name, data):
+        # Duplicate names (e.g. repeated filename values) get a numeric suffix
+        base, ext = os.path.splitext(name)
+        suffix = 1
+        while name in self.names:
+            suffix += 1
+            name = f"{base}_{suffix}{ext}"
+        self.names.add(name)
+        if self.zip is not None:
+            # PNGs are already compressed, SVG text is not
+            compression = zipfile.ZIP_DEFLATED if ext == ".svg" else zipfile.ZIP_STORED
+            self.zip.writestr(name, data, compress_type=compression)
+        else:
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            info.mtime = int(time.time())
+            self.tar.addfile(info, io.BytesIO(data))
+        return name
+
+    def close(self):
+        (self.zip or self.tar).close()
+
+def generate_bulk(rows, output, manifest, fmt="png", box_size=10, workers=None, max_in_flight=None):
+    # Render every row into the archive and write one manifest line per row.
+    # Returns (rows, generated, seconds).
+    workers = workers or os.cpu_count() or 1
+    max_in_flight = max_in_flight or workers * 4
+    archive = ArchiveWriter(output)
+    writer = csv.DictWriter(manifest, fieldnames=MANIFEST_FIELDS)
+    writer.writeheader()
+    started = time.perf_counter()
+    total = generated = 0
+
+    def collect(done):
+        nonlocal total, generated
+        for future in done:
+            entry, data = future.result()
+            if data is not None:
+                entry["file"] = archive.add(entry["file"], data)
+                generated += 1
+            writer.writerow(entry)
+            total += 1
+
+    try:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            pending = set()
+            for index, row in enumerate(rows, start=1):
+                pending.add(pool.submit(render_row, index, row, fmt, box_size))
+                if len(pending) >= max_in_flight:
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    collect(done)
+            while pending:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                collect(done)
+    finally:
+        archive.close()
+    return total, generated, time.perf_counter() - started
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Generate payment QR codes in bulk")
+    parser.add_argument("input", help="CSV or JSON Lines file of payments (sender, sender_cnic, amount)")
+    parser.add_argument("-o", "--output", required=True, help="Archive to write: .zip, .tar, .tar.gz or .tar.bz2")
+    parser.add_argument("--manifest", help="Per-row status CSV (default: <output>.manifest.csv)")
+    parser.add_argument("--format", choices=["png", "svg"], default="png", help="Image format")
+    parser.add_argument("--box-size", type=int, default=10, help="Pixels per QR module (PNG) or SVG unit size")
+    parser.add_argument("-j", "--workers", type=int, help="Worker processes (default: all cores)")
+    args = parser.parse_args(argv)
+
+    manifest_path = args.manifest or args.output + ".manifest.csv"
+    with open(manifest_path, "w", newline="") as manifest:
+        total, generated, elapsed = generate_bulk(
+            read_rows(args.input), args.output, manifest, args.format, args.box_size, args.workers
+        )
+    print(f"Generated {generated}/{total} QR codes in {elapsed:.1f}s "
+          f"({total / elapsed if elapsed else 0:.1f} rows/s); manifest: {manifest_path}", file=sys.stderr)
+    return 0 if generated == total else 1
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,144 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from functools import lru_cache
+
+# Decode result caches. Staff upload the same slip and rescan the same
+# merchant code many times a day; a repeat is answered from here instead of
+# going through image loading, the enhancement ladder and payload parsing.
+
+# Entries kept in memory per cache, and how long an entry stays valid
+DECODE_CACHE_ENTRIES = int(os.environ.get("QRPAY_DECODE_CACHE_ENTRIES", "4096"))
+DECODE_CACHE_TTL = float(os.environ.get("QRPAY_DECODE_CACHE_TTL", str(24 * 3600)))
+
+# SQLite file backing the upload cache, so results survive restarts and are
+# shared between server worker processes; unset keeps it in memory only
+DECODE_CACHE_PATH = os.environ.get("QRPAY_DECODE_CACHE_PATH", "")
+
+# Rows kept in that file; the ones closest to expiring go first
+DECODE_CACHE_DISK_ENTRIES = int(os.environ.get("QRPAY_DECODE_CACHE_DISK_ENTRIES", "100000"))
+
+# Returned by DecodeCache.get on a miss, since None is a valid cached result
+MISS = object()
+
+def content_key(data):
+    # Fast 128-bit hash of uploaded bytes
+    return hashlib.blake2b(data, digest_size=16).hexdigest()
+
+class DecodeCache:
+    # LRU with a TTL, optionally backed by a SQLite table. Values must be
+    # JSON-serialisable; callers get a fresh copy, never the cached object.
+    def __init__(self, max_entries=DECODE_CACHE_ENTRIES, ttl=DECODE_CACHE_TTL, path="",
+                 max_disk_entries=DECODE_CACHE_DISK_ENTRIES):
+        self.max_entries = max_entries
+        self.max_disk_entries = max_disk_entries
+        self.ttl = ttl
+        self.path = path
+        self.entries = OrderedDict()    # key -> (expires, JSON text)
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.disk_evictions = 0
+        self.expirations = 0
+        self.local = threading.local()
+        if path:
+            with self.connection() as conn:
+                conn.execute("CREATE TABLE IF NOT EXISTS decode_cache "
+                             "(key TEXT PRIMARY KEY, value TEXT NOT NULL, expires REAL NOT NULL)")
+                conn.execute("CREATE INDEX IF NOT EXISTS decode_cache_expires ON decode_cache (expires)")
+                self.prune(conn)
+
+    def connection(self):
+        # One connection per thread; the table is small and writes are rare
+        conn = getattr(self.local, "conn", None)
+        if conn is None:
+            conn = self.local.conn = sqlite3.connect(self.path, timeout=5)
+            conn.execute("PRAGMA journal_mode=WAL")
+        return conn
+
+    def get(self, key):
+        now = time.time()
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                expires, text = entry
+                if expires > now:
+                    self.entries.move_to_end(key)
+                    self.hits += 1
+                    return json.loads(text)
+                del self.entries[key]
+                self.expirations += 1
+        if self.path:
+            row = self.connection().execute(
+                "SELECT value, expires FROM decode_cache WHERE key = ? AND expires > ?", (key, now)
+            ).fetchone()
+            if row is not None:
+                self.remember(key, row[1], row[0])
+                with self.lock:
+                    self.disk_hits += 1
+                return json.loads(row[0])
+        with self.lock:
+            self.misses += 1
+        return MISS
+
+    def put(self, key, value):
+        expires = time.time() + self.ttl
+        text = json.dumps(value)
+        self.remember(key, expires, text)
+        if self.path:
+            with self.connection() as conn:
+                conn.execute("INSERT OR REPLACE INTO decode_cache (key, value, expires) VALUES (?, ?, ?)",
+                             (key, text, expires))
+                self.prune(conn)
+
+    def prune(self, conn):
+        # Drop expired rows, then the ones closest to expiring (the least
+        # recently written, as every row gets the same TTL) past the row cap.
+        # Both walk the expires index; puts only happen on decode misses.
+        conn.execute("DELETE FROM decode_cache WHERE expires < ?", (time.time(),))
+        evicted = conn.execute(
+            "DELETE FROM decode_cache WHERE expires <= (SELECT expires FROM decode_cache "
+            "ORDER BY expires DESC LIMIT 1 OFFSET ?)", (self.max_disk_entries,)
+        ).rowcount
+        if evicted > 0:
+            with self.lock:
+                self.disk_evictions += evicted
+
+    def remember(self, key, expires, text):
+        with self.lock:
+            self.entries[key] = (expires, text)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.disk_hits + self.misses
+            return {
+                "entries": len(self.entries),
+                "max_entries": self.max_entries,
+                "hits": self.hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "disk_evictions": self.disk_evictions,
+                "expirations": self.expirations,
+                "hit_ratio": round((self.hits + self.disk_hits) / lookups, 4) if lookups else None,
+            }
+
+@lru_cache(maxsize=None)
+def get_upload_cache():
+    # Decoded uploads by content hash of the image bytes
+    return DecodeCache(path=DECODE_CACHE_PATH)
+
+@lru_cache(maxsize=None)
+def get_parse_cache():
+    # Parsed payments by QR text; parsing is cheap, so memory only
+    return DecodeCache()
@@ -0,0 +1,107 @@
+import json
+import threading
+from http.client import HTTPConnection, HTTPSConnection
+from urllib.parse import quote, urlencode, urlsplit
+
+from qrpay.ledger import AccountNameMismatch, IdempotencyConflict, InsufficientFunds, UnknownAccount
+
+class ApiRequestError(Exception):
+    pass
+
+class RemoteService:
+    # LocalService over HTTP, talking to a qrpay.server instance. Each thread
+    # (i.e. each Streamlit session run) keeps its own keep-alive connection.
+    def __init__(self, base_url, token="", timeout=30):
+        url = urlsplit(base_url)
+        self.connection_class = HTTPSConnection if url.scheme == "https" else HTTPConnection
+        self.netloc = url.netloc
+        self.prefix = url.path.rstrip("/")
+        self.timeout = timeout
+        self.auth_headers = {"Authorization": f"Bearer {token}"} if token else {}
+        self.local = threading.local()
+
+    def warm_up(self):
+        # The server warms its own image workers at startup
+        pass
+
+    def request(self, method, path, body=None, content_type="application/json", query=None):
+        if query:
+            path += "?" + urlencode({key: value for key, value in query.items() if value is not None})
+        if body is not None and content_type == "application/json":
+            body = json.dumps(body).encode()
+        headers = dict(self.auth_headers)
+        if body is not None:
+            headers["Content-Type"] = content_type
+        for attempt in range(2):
+            conn = getattr(self.local, "conn", None)
+            if conn is None:
+                conn = self.local.conn = self.connection_class(self.netloc, timeout=self.timeout)
+            try:
+                conn.request(method, self.prefix + path, body=body, headers=headers)
+                response = conn.getresponse()
+                payload = response.read()
+                break
+            except (ConnectionError, OSError):
+                # The server may have closed an idle keep-alive connection
+                conn.close()
+                self.local.conn = None
+                if attempt:
+                    raise
+        if response.getheader("Connection", "").lower() == "close":
+            conn.close()
+            self.local.conn = None
+        if response.status == 200:
+            if response.getheader("Content-Type", "").startswith("application/json"):
+                return json.loads(payload)
+            return payload
+        error = json.loads(payload) if payload else {}
+        message = error.get("error", response.reason)
+        if response.status == 402:
+            raise InsufficientFunds(error.get("balance"))
+        if response.status == 404 and path.startswith("/accounts/"):
+            raise UnknownAccount(message)
+        if response.status == 403 and path == "/accounts":
+            raise AccountNameMismatch(message)
+        if response.status == 409:
+            raise IdempotencyConflict(message)
+        if response.status in (400, 422):
+            raise ValueError(message)
+        raise ApiRequestError(f"{method} {path}: {response.status} {message}")
+
+    def account_path(self, cnic, suffix=""):
+        return f"/accounts/{quote(cnic, safe='')}{suffix}"
+
+    def generate_qr(self, data, box_size=10, fmt="png"):
+        return self.request("POST", "/generate", {"data": data, "box_size": box_size, "format": fmt})
+
+    def decode_image(self, data):
+        return self.request("POST", "/decode-image", data, content_type="application/octet-stream")["qr_data"]
+
+    def parse(self, qr_data):
+        return self.request("POST", "/parse", {"qr_data": qr_data})["payment"]
+
+    def pay(self, payer_cnic, amount, recipient, recipient_cnic, qr_data, scan_session):
+        return self.request("POST", "/pay", {
+            "payer_cnic": payer_cnic, "amount": amount, "recipient": recipient,
+            "recipient_cnic": recipient_cnic, "qr_data": qr_data, "scan_session": scan_session,
+        })["transaction"]
+
+    def open_account(self, cnic, name, initial_balance=0.0):
+        return self.request("POST", "/accounts", {"cnic": cnic, "name": name, "initial_balance": initial_balance})
+
+    def balance(self, cnic):
+        return self.request("GET", self.account_path(cnic))["balance"]
+
+    def summary(self, cnic):
+        return self.request("GET", self.account_path(cnic, "/summary"))
+
+    def list_transactions(self, cnic, limit=20, before_id=None, since=None, until=None, counterparty=None):
+        query = {"limit": limit, "before_id": before_id, "since": since, "until": until,
+                 "counterparty": counterparty or None}
+        return self.request("GET", self.account_path(cnic, "/transactions"), query=query)["transactions"]
+
+    def period_totals(self, cnic, kind="day", limit=30):
+        return self.request("GET", self.account_path(cnic, "/totals"), query={"kind": kind, "limit": limit})["totals"]
+
+    def top_counterparties(self, cnic, limit=5):
+        return self.request("GET", self.account_path(cnic, "/counterparties"), query={"limit": limit})["counterparties"]
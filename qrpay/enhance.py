@@ -0,0 +1,142 @@
+import os
+import threading
+from collections import Counter
+
+import cv2
+
+from qrpay.qr import DECODE_WORKERS, detect_qr_code
+
+# Enhancement ladder for uploaded photos. Each stage turns the grayscale photo
+# into one or more variants for the detector; stages run cheapest first and the
+# ladder stops at the first one that decodes, so easy images cost one attempt.
+
+# Stage name -> function(gray) returning the variants to try
+ENHANCEMENT_STAGES = {}
+
+# Stages tried for uploads, in order (QRPAY_UPLOAD_STAGES, comma-separated)
+UPLOAD_STAGES = [
+    name.strip()
+    for name in os.environ.get("QRPAY_UPLOAD_STAGES", "gray,clahe,adaptive,sharpen,invert,rescale").split(",")
+    if name.strip()
+]
+
+CLAHE_CLIP_LIMIT = 3.0
+
+# Upscaled variants are skipped when they would be larger than this
+RESCALE_MAX_SIDE = 2400
+
+def register_enhancement(name):
+    # Decorator adding a variant function to ENHANCEMENT_STAGES under name
+    def register(func):
+        ENHANCEMENT_STAGES[name] = func
+        return func
+    return register
+
+@register_enhancement("gray")
+def gray_variants(gray):
+    # The photo as uploaded
+    return [gray]
+
+@register_enhancement("clahe")
+def clahe_variants(gray):
+    # Local contrast equalisation for washed-out and unevenly lit photos
+    return [cv2.createCLAHE(clipLimit=CLAHE_CLIP_LIMIT, tileGridSize=(8, 8)).apply(gray)]
+
+@register_enhancement("adaptive")
+def adaptive_threshold_variants(gray):
+    # Binarise against the local mean, which flattens glare and shadows.
+    # The block spans a few modules of a code filling a third of the image.
+    block = max(3, min(gray.shape[:2]) // 24 | 1)
+    return [cv2.adaptiveThreshold(gray, 255, cv2.ADAPTIVE_THRESH_GAUSSIAN_C, cv2.THRESH_BINARY, block, 5)]
+
+@register_enhancement("sharpen")
+def sharpen_variants(gray):
+    # Unsharp mask for slightly out-of-focus photos
+    blurred = cv2.GaussianBlur(gray, (0, 0), 3)
+    return [cv2.addWeighted(gray, 1.8, blurred, -0.8, 0)]
+
+@register_enhancement("invert")
+def invert_variants(gray):
+    # Light-on-dark codes (dark mode screens, engraved plates)
+    return [cv2.bitwise_not(gray)]
+
+@register_enhancement("rescale")
+def rescale_variants(gray):
+    # Tiny modules read better upscaled, noisy oversized ones downscaled
+    variants = []
+    if max(gray.shape[:2]) * 2 <= RESCALE_MAX_SIDE:
+        variants.append(cv2.resize(gray, None, fx=2, fy=2, interpolation=cv2.INTER_CUBIC))
+    if min(gray.shape[:2]) >= 128:
+        variants.append(cv2.resize(gray, None, fx=0.5, fy=0.5, interpolation=cv2.INTER_AREA))
+    return variants
+
+class StageStats:
+    # Process-wide count of which stage read each upload, to tune the ladder
+    def __init__(self):
+        self.counts = Counter()
+        self.lock = threading.Lock()
+
+    def record(self, stage):
+        with self.lock:
+            self.counts[stage or "failed"] += 1
+
+    def stats(self):
+        with self.lock:
+            return dict(self.counts)
+
+stage_stats = StageStats()
+
+def enhancement_stats():
+    # Uploads decoded per stage, plus "failed" for those no stage could read
+    return stage_stats.stats()
+
+def run_stage(name, gray, cancelled=None):
+    # Text of the first variant of this stage that decodes, or None. Gives up
+    # between variants once cancelled is set (a cheaper stage already won).
+    try:
+        for variant in ENHANCEMENT_STAGES[name](gray):
+            if cancelled is not None and cancelled.is_set():
+                return None
+            _, qr_value = detect_qr_code(variant)
+            if qr_value:
+                return qr_value
+    except Exception as e:
+        print(f"Enhancement stage {name} failed: {str(e)}")
+    return None
+
+def enhanced_decode(img, stages=None, executor=None, parallel=DECODE_WORKERS):
+    # Returns (qr_value, stage) for the cheapest stage that decodes img, or
+    # (None, None). Without an executor the stages run one by one in this
+    # thread. With one, every stage runs on it: the first alone, the rest
+    # `parallel` at a time, and a batch only starts once every cheaper stage
+    # has failed. Results are taken in stage order, so a costlier stage that
+    # finishes first never beats a cheaper one of its batch.
+    stages = stages or UPLOAD_STAGES
+    unknown = [name for name in stages if name not in ENHANCEMENT_STAGES]
+    if unknown:
+        raise ValueError(f"unknown enhancement stages: {', '.join(unknown)}")
+    gray = img if img.ndim == 2 else cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+
+    width = max(1, parallel) if executor is not None else 1
+    batches = [stages[:1]] + [stages[i:i + width] for i in range(1, len(stages), width)]
+    for batch in batches:
+        if executor is None:
+            outcomes = [(batch[0], lambda: run_stage(batch[0], gray))]
+        else:
+            cancelled = threading.Event()
+            futures = [executor.submit(run_stage, name, gray, cancelled) for name in batch]
+            outcomes = [(name, future.result) for name, future in zip(batch, futures)]
+        for name, result in outcomes:
+            qr_value = result()
+            if qr_value:
+                if executor is not None:
+                    # Costlier stages of the batch are no longer needed
+                    cancelled.set()
+                    for future in futures:
+                        future.cancel()
+                stage_stats.record(name)
+                if name != stages[0]:
+                    print(f"QR code read after enhancement stage {name}")
+                return qr_value, name
+    stage_stats.record(None)
+    return None, None
@@ -0,0 +1,95 @@
+import io
+import math
+import os
+import threading
+
+import cv2
+import numpy as np
+from PIL import Image
+
+# Upload ingestion. The header is read first to learn the format and size,
+# then the image is decoded straight to grayscale, JPEGs at a reduced scale
+# (libjpeg DCT scaling) when they are larger than the decoder needs. At most
+# UPLOAD_MAX_DECODE_PIXELS are ever decoded at once, so each upload holds at
+# most its encoded bytes plus that many bytes of grayscale pixels.
+
+# Longest side handed to the QR decoder; larger images are scaled down
+UPLOAD_MAX_SIDE = int(os.environ.get("QRPAY_UPLOAD_MAX_SIDE", "3000"))
+
+# Most pixels decoded for one upload. JPEGs that would still exceed it at 1/8
+# scale, and other formats larger than it, are rejected.
+UPLOAD_MAX_DECODE_PIXELS = int(os.environ.get("QRPAY_UPLOAD_MAX_DECODE_PIXELS", str(16 * 1000 * 1000)))
+
+# Uploads decoded at the same time in this process; bounds total memory
+UPLOAD_CONCURRENCY = int(os.environ.get("QRPAY_UPLOAD_CONCURRENCY", str(max(2, os.cpu_count() or 1))))
+
+upload_slots = threading.BoundedSemaphore(UPLOAD_CONCURRENCY)
+
+REDUCED_GRAYSCALE = {
+    1: cv2.IMREAD_GRAYSCALE,
+    2: cv2.IMREAD_REDUCED_GRAYSCALE_2,
+    4: cv2.IMREAD_REDUCED_GRAYSCALE_4,
+    8: cv2.IMREAD_REDUCED_GRAYSCALE_8,
+}
+
+def read_image_header(data):
+    # (format, width, height) of an encoded image without decoding any pixels
+    try:
+        with Image.open(io.BytesIO(data)) as image:
+            return image.format, image.width, image.height
+    except Image.DecompressionBombError:
+        raise ValueError("image too large")
+    except OSError:
+        raise ValueError("could not decode image")
+
+def decode_reduction(fmt, width, height):
+    # Largest power-of-two reduction (up to 1/8) that still leaves the longest
+    # side at UPLOAD_MAX_SIDE or more; only JPEG can be decoded reduced
+    factor = 1
+    if fmt == "JPEG":
+        while factor < 8 and max(width, height) / (factor * 2) >= UPLOAD_MAX_SIDE:
+            factor *= 2
+    return factor
+
+def check_decode_size(fmt, width, height, factor):
+    if math.ceil(width / factor) * math.ceil(height / factor) > UPLOAD_MAX_DECODE_PIXELS:
+        raise ValueError(f"image too large ({width}x{height} {fmt})")
+
+def load_upload_gray(data):
+    # Grayscale ndarray of an uploaded image, longest side at most
+    # UPLOAD_MAX_SIDE, and a report of how it was loaded
+    fmt, width, height = read_image_header(data)
+    factor = decode_reduction(fmt, width, height)
+    check_decode_size(fmt, width, height, factor)
+
+    img = cv2.imdecode(np.frombuffer(data, np.uint8), REDUCED_GRAYSCALE[factor])
+    if img is None:
+        raise ValueError("could not decode image")
+    # Estimate, not a measurement: the encoded bytes and the pixel buffers
+    # held at once, without the image decoder's own working memory
+    buffer_bytes = len(data) + img.nbytes
+    longest = max(img.shape[:2])
+    if longest > UPLOAD_MAX_SIDE:
+        scale = UPLOAD_MAX_SIDE / longest
+        img = cv2.resize(img, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+        buffer_bytes += img.nbytes
+    return img, {
+        "format": fmt,
+        "width": width,
+        "height": height,
+        "reduction": factor,
+        "decoded_width": img.shape[1],
+        "decoded_height": img.shape[0],
+        "load_bytes_estimate": buffer_bytes,
+    }
+
+def upload_preview(data, max_side=600):
+    # Small RGB PIL image of an upload for display, under the same size
+    # limits as load_upload_gray. JPEGs are decoded reduced (draft, up to
+    # 1/8), and the browser never has to render formats like TIFF.
+    fmt, width, height = read_image_header(data)
+    check_decode_size(fmt, width, height, 8 if fmt == "JPEG" else 1)
+    with upload_slots, Image.open(io.BytesIO(data)) as image:
+        image.draft("RGB", (max_side, max_side))
+        image.thumbnail((max_side, max_side))
+        return image.convert("RGB")
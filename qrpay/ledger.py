@@ -0,0 +1,472 @@
+import heapq
+import itertools
+import os
+import queue
+import sqlite3
+import time
+from contextlib import contextmanager
+from functools import lru_cache
+
+from qrpay.payments import validate_cnic
+
+# SQLite file holding every account and transaction
+LEDGER_PATH = os.environ.get("QRPAY_LEDGER_PATH", "qrpay_ledger.db")
+
+# Connections kept open per ledger; each Streamlit session borrows one per call
+LEDGER_POOL_SIZE = int(os.environ.get("QRPAY_LEDGER_POOL_SIZE", "4"))
+
+# Amounts are stored as integer paisa so balances never drift.
+# period_totals and counterparty_totals are maintained with every transaction
+# (a fixed number of upserts), so summaries never rescan the history.
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS accounts (
+    cnic TEXT PRIMARY KEY,
+    name TEXT NOT NULL,
+    balance INTEGER NOT NULL CHECK (balance >= 0),
+    created_at TEXT NOT NULL,
+    opening_balance INTEGER NOT NULL DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS transactions (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    user_cnic TEXT NOT NULL,
+    date TEXT NOT NULL,
+    type TEXT NOT NULL,
+    amount INTEGER NOT NULL,
+    counterparty TEXT NOT NULL,
+    counterparty_cnic TEXT NOT NULL,
+    balance_after INTEGER NOT NULL,
+    idempotency_key TEXT
+);
+CREATE INDEX IF NOT EXISTS transactions_user ON transactions (user_cnic, id);
+CREATE INDEX IF NOT EXISTS transactions_user_date ON transactions (user_cnic, date);
+CREATE INDEX IF NOT EXISTS transactions_counterparty ON transactions (user_cnic, counterparty_cnic, id);
+CREATE TABLE IF NOT EXISTS period_totals (
+    user_cnic TEXT NOT NULL,
+    kind TEXT NOT NULL,
+    period TEXT NOT NULL,
+    paid INTEGER NOT NULL,
+    received INTEGER NOT NULL,
+    count INTEGER NOT NULL,
+    PRIMARY KEY (user_cnic, kind, period)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS counterparty_totals (
+    user_cnic TEXT NOT NULL,
+    counterparty_cnic TEXT NOT NULL,
+    counterparty TEXT NOT NULL,
+    paid INTEGER NOT NULL,
+    received INTEGER NOT NULL,
+    count INTEGER NOT NULL,
+    volume INTEGER NOT NULL,
+    PRIMARY KEY (user_cnic, counterparty_cnic)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS counterparty_totals_volume ON counterparty_totals (user_cnic, volume);
+"""
+
+# Bumped whenever an existing ledger file needs migrate() to catch up
+SCHEMA_VERSION = 2
+
+# The aggregate tables recomputed from scratch, in their column order. Used
+# to rebuild them and to reconcile them against the history.
+PAID = "SUM(CASE WHEN type = 'payment' THEN amount ELSE 0 END)"
+RECEIVED = "SUM(CASE WHEN type = 'payment' THEN 0 ELSE amount END)"
+RECOMPUTED_PERIOD_TOTALS = f"""
+SELECT user_cnic, 'day' AS kind, substr(date, 1, 10) AS period, {PAID} AS paid, {RECEIVED} AS received,
+       COUNT(*) AS count
+FROM transactions GROUP BY 1, 3
+UNION ALL
+SELECT user_cnic, 'month', substr(date, 1, 7), {PAID}, {RECEIVED}, COUNT(*)
+FROM transactions GROUP BY 1, 3
+"""
+# The bare counterparty column comes from the MAX(id) row, i.e. the latest name
+RECOMPUTED_COUNTERPARTY_TOTALS = f"""
+SELECT user_cnic, counterparty_cnic, counterparty, {PAID} AS paid, {RECEIVED} AS received,
+       COUNT(*) AS count, SUM(amount) AS volume, MAX(id) AS last_id
+FROM transactions GROUP BY 1, 2
+"""
+PERIOD_COLUMNS = "user_cnic, kind, period, paid, received, count"
+COUNTERPARTY_COLUMNS = "user_cnic, counterparty_cnic, counterparty, paid, received, count, volume"
+
+class InsufficientFunds(Exception):
+    pass
+
+class UnknownAccount(Exception):
+    pass
+
+class IdempotencyConflict(ValueError):
+    pass
+
+class AccountNameMismatch(Exception):
+    pass
+
+def same_name(a, b):
+    # Names as typed at login: ignore case and repeated spaces
+    return " ".join(a.split()).casefold() == " ".join(b.split()).casefold()
+
+def to_paisa(amount):
+    return int(round(amount * 100))
+
+def row_to_transaction(row):
+    # Same shape as the dicts the app used to keep in session state
+    return {
+        "id": row["id"],
+        "date": row["date"],
+        "type": row["type"],
+        "amount": row["amount"] / 100,
+        "counterparty": row["counterparty"],
+        "counterparty_cnic": row["counterparty_cnic"],
+        "balance_after": row["balance_after"] / 100,
+    }
+
+class Ledger:
+    # Accounts and transaction history in SQLite (WAL mode, so readers never
+    # block the writer). Every balance change happens in one IMMEDIATE
+    # transaction together with its history rows.
+    def __init__(self, path=LEDGER_PATH, pool_size=LEDGER_POOL_SIZE):
+        self.path = path
+        self.pool = queue.LifoQueue()
+        for _ in range(pool_size):
+            self.pool.put(self.connect())
+        with self.connection() as conn:
+            conn.executescript(SCHEMA)
+        self.migrate()
+
+    def connect(self):
+        conn = sqlite3.connect(self.path, timeout=30, isolation_level=None, check_same_thread=False)
+        conn.row_factory = sqlite3.Row
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute("PRAGMA foreign_keys=ON")
+        return conn
+
+    @contextmanager
+    def connection(self):
+        conn = self.pool.get()
+        try:
+            yield conn
+        finally:
+            self.pool.put(conn)
+
+    @contextmanager
+    def transaction(self):
+        # Write lock up front, so a compare-and-update cannot interleave
+        with self.connection() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                yield conn
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+            conn.execute("COMMIT")
+
+    def migrate(self):
+        # Bring a ledger file written by an older version up to date
+        with self.transaction() as conn:
+            version = conn.execute("PRAGMA user_version").fetchone()[0]
+            if version >= SCHEMA_VERSION:
+                return
+            columns = {row["name"] for row in conn.execute("PRAGMA table_info(accounts)")}
+            if version < 1 and "opening_balance" not in columns:
+                conn.execute("ALTER TABLE accounts ADD COLUMN opening_balance INTEGER NOT NULL DEFAULT 0")
+                # Work back from the current balance through the history
+                conn.execute(f"""
+                    UPDATE accounts SET opening_balance = balance - COALESCE((
+                        SELECT {RECEIVED} - {PAID} FROM transactions WHERE user_cnic = accounts.cnic
+                    ), 0)
+                """)
+            if version < 1:
+                self.rebuild_aggregates(conn)
+            columns = {row["name"] for row in conn.execute("PRAGMA table_info(transactions)")}
+            if "idempotency_key" not in columns:
+                conn.execute("ALTER TABLE transactions ADD COLUMN idempotency_key TEXT")
+            # One payment per key and payer; retries find the original row here
+            conn.execute(
+                "CREATE UNIQUE INDEX IF NOT EXISTS transactions_idempotency "
+                "ON transactions (user_cnic, idempotency_key) WHERE idempotency_key IS NOT NULL"
+            )
+            conn.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+
+    def rebuild_aggregates(self, conn):
+        conn.execute("DELETE FROM period_totals")
+        conn.execute("DELETE FROM counterparty_totals")
+        conn.execute(f"INSERT INTO period_totals ({PERIOD_COLUMNS}) {RECOMPUTED_PERIOD_TOTALS}")
+        conn.execute(
+            f"INSERT INTO counterparty_totals ({COUNTERPARTY_COLUMNS}) "
+            f"SELECT {COUNTERPARTY_COLUMNS} FROM ({RECOMPUTED_COUNTERPARTY_TOTALS})"
+        )
+
+    def close(self):
+        while not self.pool.empty():
+            self.pool.get_nowait().close()
+
+    def open_account(self, cnic, name, initial_balance=0.0):
+        # Create the account on first login; returning users keep their
+        # balance, but must give the name the account was opened with
+        if to_paisa(initial_balance) < 0:
+            # INSERT OR IGNORE would silently skip the row on the CHECK
+            raise ValueError("initial balance must not be negative")
+        with self.transaction() as conn:
+            conn.execute(
+                "INSERT OR IGNORE INTO accounts (cnic, name, balance, created_at, opening_balance) VALUES (?, ?, ?, ?, ?)",
+                (cnic, name, to_paisa(initial_balance), time.strftime("%Y-%m-%d %H:%M:%S"), to_paisa(initial_balance)),
+            )
+            row = conn.execute("SELECT * FROM accounts WHERE cnic = ?", (cnic,)).fetchone()
+        if not same_name(row["name"], name):
+            raise AccountNameMismatch(cnic)
+        return {"cnic": row["cnic"], "name": row["name"], "balance": row["balance"] / 100}
+
+    def balance(self, cnic):
+        with self.connection() as conn:
+            row = conn.execute("SELECT balance FROM accounts WHERE cnic = ?", (cnic,)).fetchone()
+        if row is None:
+            raise UnknownAccount(cnic)
+        return row["balance"] / 100
+
+    def record(self, conn, user_cnic, date, kind, amount, counterparty, counterparty_cnic, idempotency_key=None):
+        # Apply a signed change to one account and append its history row
+        row = conn.execute(
+            "UPDATE accounts SET balance = balance + ? WHERE cnic = ? AND balance + ? >= 0 RETURNING balance",
+            (amount, user_cnic, amount),
+        ).fetchone()
+        if row is None:
+            return None
+        cursor = conn.execute(
+            "INSERT INTO transactions (user_cnic, date, type, amount, counterparty, counterparty_cnic, balance_after, "
+            "idempotency_key) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            (user_cnic, date, kind, abs(amount), counterparty, counterparty_cnic, row["balance"], idempotency_key),
+        )
+        self.add_to_aggregates(conn, user_cnic, date, kind, abs(amount), counterparty, counterparty_cnic)
+        return row_to_transaction({
+            "id": cursor.lastrowid, "date": date, "type": kind, "amount": abs(amount),
+            "counterparty": counterparty, "counterparty_cnic": counterparty_cnic,
+            "balance_after": row["balance"],
+        })
+
+    def add_to_aggregates(self, conn, user_cnic, date, kind, amount, counterparty, counterparty_cnic):
+        # Three primary-key upserts per transaction, however long the history
+        paid, received = (amount, 0) if kind == "payment" else (0, amount)
+        for period_kind, period in (("day", date[:10]), ("month", date[:7])):
+            conn.execute(
+                f"INSERT INTO period_totals ({PERIOD_COLUMNS}) VALUES (?, ?, ?, ?, ?, 1) "
+                "ON CONFLICT (user_cnic, kind, period) DO UPDATE SET paid = paid + excluded.paid, "
+                "received = received + excluded.received, count = count + 1",
+                (user_cnic, period_kind, period, paid, received),
+            )
+        conn.execute(
+            f"INSERT INTO counterparty_totals ({COUNTERPARTY_COLUMNS}) VALUES (?, ?, ?, ?, ?, 1, ?) "
+            "ON CONFLICT (user_cnic, counterparty_cnic) DO UPDATE SET counterparty = excluded.counterparty, "
+            "paid = paid + excluded.paid, received = received + excluded.received, count = count + 1, "
+            "volume = volume + excluded.volume",
+            (user_cnic, counterparty_cnic, counterparty, paid, received, amount),
+        )
+
+    def transfer(self, payer_cnic, amount, recipient, recipient_cnic, idempotency_key=None):
+        # Debit the payer and, if the recipient has an account here, credit
+        # them, all or nothing. Returns the payer's transaction, with
+        # "replayed" set when idempotency_key already paid and the original
+        # transaction is returned instead of charging again.
+        paisa = to_paisa(amount)
+        if paisa <= 0:
+            raise ValueError("amount must be positive")
+        if recipient_cnic == payer_cnic:
+            # Would be a debit with no matching receipt
+            raise ValueError("cannot pay your own QR code")
+        date = time.strftime("%Y-%m-%d %H:%M:%S")
+        with self.transaction() as conn:
+            payer = conn.execute("SELECT name, balance FROM accounts WHERE cnic = ?", (payer_cnic,)).fetchone()
+            if payer is None:
+                raise UnknownAccount(payer_cnic)
+            if idempotency_key is not None:
+                row = conn.execute(
+                    "SELECT * FROM transactions WHERE user_cnic = ? AND idempotency_key = ?",
+                    (payer_cnic, idempotency_key),
+                ).fetchone()
+                if row is not None:
+                    if row["amount"] != paisa or row["counterparty_cnic"] != recipient_cnic:
+                        raise IdempotencyConflict("idempotency key was already used for a different payment")
+                    return dict(row_to_transaction(row), replayed=True)
+            transaction = self.record(conn, payer_cnic, date, "payment", -paisa, recipient, recipient_cnic,
+                                      idempotency_key)
+            if transaction is None:
+                raise InsufficientFunds(payer["balance"] / 100)
+            self.record(conn, recipient_cnic, date, "receipt", paisa, payer["name"], payer_cnic)
+        return dict(transaction, replayed=False)
+
+    def list_transactions(self, cnic, limit=20, before_id=None, since=None, until=None, counterparty=None):
+        # Newest first. Pass the last id of a page as before_id for the next
+        # one; every filter walks an index in order (no sort), so a page costs
+        # the same whatever the history size. since/until are inclusive
+        # "YYYY-MM-DD" dates; counterparty is a CNIC (exact) or the start of a
+        # counterparty's name, in any case.
+        with self.connection() as conn:
+            queries = self.transactions_queries(conn, cnic, limit, before_id, since, until, counterparty)
+            streams = [conn.execute(sql, params).fetchall() for sql, params in queries]
+        # One stream per counterparty for a name prefix, each newest first
+        rows = streams[0] if len(streams) == 1 else heapq.merge(*streams, key=lambda row: -row["id"])
+        return [row_to_transaction(row) for row in itertools.islice(rows, limit)]
+
+    def transactions_queries(self, conn, cnic, limit, before_id=None, since=None, until=None, counterparty=None):
+        # [(sql, params)] for list_transactions; also what reconcile
+        # --check-plans runs EXPLAIN QUERY PLAN on
+        where, params = "user_cnic = ?", [cnic]
+        if since:
+            where += " AND date >= ?"
+            params.append(str(since))
+        if until:
+            # Dates are "YYYY-MM-DD HH:MM:SS", so this covers the whole day
+            where += " AND date < ?"
+            params.append(f"{until} 99")
+        if counterparty:
+            # Newest first along (user_cnic, counterparty_cnic, id); dates are
+            # checked on the rows walked. A name prefix is resolved to the
+            # matching counterparties first, from their (small) totals table.
+            if validate_cnic(counterparty):
+                counterparty_cnics = [counterparty]
+            else:
+                counterparty_cnics = [row[0] for row in conn.execute(
+                    "SELECT counterparty_cnic FROM counterparty_totals WHERE user_cnic = ? "
+                    "AND counterparty >= ? COLLATE NOCASE AND counterparty < ? COLLATE NOCASE",
+                    (cnic, counterparty, counterparty + "\U0010ffff"),
+                )]
+            if before_id is not None:
+                where += " AND id < ?"
+                params.append(before_id)
+            return [
+                ("SELECT * FROM transactions INDEXED BY transactions_counterparty "
+                 f"WHERE {where} AND counterparty_cnic = ? ORDER BY id DESC LIMIT ?",
+                 params + [counterparty_cnic, limit])
+                for counterparty_cnic in counterparty_cnics
+            ]
+        if since or until:
+            # Along transactions_user_date, i.e. (user_cnic, date, id), so the
+            # cursor is the (date, id) of the last row of the previous page
+            if before_id is not None:
+                row = conn.execute("SELECT date FROM transactions WHERE id = ?", (before_id,)).fetchone()
+                if row is not None:
+                    where += " AND date <= ? AND (date, id) < (?, ?)"
+                    params.extend([row["date"], row["date"], before_id])
+                else:
+                    where += " AND id < ?"
+                    params.append(before_id)
+            return [(f"SELECT * FROM transactions WHERE {where} ORDER BY date DESC, id DESC LIMIT ?",
+                     params + [limit])]
+        if before_id is not None:
+            where += " AND id < ?"
+            params.append(before_id)
+        return [(f"SELECT * FROM transactions WHERE {where} ORDER BY id DESC LIMIT ?", params + [limit])]
+
+    def check_query_plans(self):
+        # Problems with the list_transactions query plans: each filter has to
+        # walk an index in order, with no temp B-tree sort and no table scan.
+        # The newest transaction supplies the account, counterparty and cursor.
+        with self.connection() as conn:
+            row = conn.execute("SELECT * FROM transactions ORDER BY id DESC LIMIT 1").fetchone()
+            cnic, cursor = (row["user_cnic"], row["id"]) if row else ("00000-0000000-0", 1)
+            counterparty_cnic = row["counterparty_cnic"] if row else "00000-0000000-0"
+            prefix = row["counterparty"][:1] if row else "a"
+            day = row["date"][:10] if row else "2025-01-01"
+            cases = {
+                "newest": {},
+                "next page": {"before_id": cursor},
+                "date range": {"since": day, "until": day},
+                "date range, next page": {"since": day, "until": day, "before_id": cursor},
+                "counterparty CNIC": {"counterparty": counterparty_cnic},
+                "counterparty CNIC, date range, next page": {"counterparty": counterparty_cnic, "since": day,
+                                                             "before_id": cursor},
+                "counterparty name": {"counterparty": prefix},
+            }
+            problems = []
+            for name, filters in cases.items():
+                for sql, params in self.transactions_queries(conn, cnic, 25, **filters):
+                    plan = " / ".join(step["detail"] for step in conn.execute("EXPLAIN QUERY PLAN " + sql, params))
+                    if "TEMP B-TREE" in plan or plan.startswith("SCAN") or " SCAN " in f" {plan}":
+                        problems.append(f"query plan for {name}: {plan}")
+        return problems
+
+    def last_transaction(self, cnic):
+        transactions = self.list_transactions(cnic, limit=1)
+        return transactions[0] if transactions else None
+
+    def period_totals(self, cnic, kind="day", limit=30):
+        # Newest "day" (YYYY-MM-DD) or "month" (YYYY-MM) totals first
+        with self.connection() as conn:
+            rows = conn.execute(
+                "SELECT period, paid, received, count FROM period_totals "
+                "WHERE user_cnic = ? AND kind = ? ORDER BY period DESC LIMIT ?",
+                (cnic, kind, limit),
+            ).fetchall()
+        return [
+            {"period": row["period"], "paid": row["paid"] / 100, "received": row["received"] / 100,
+             "net": (row["received"] - row["paid"]) / 100, "count": row["count"]}
+            for row in rows
+        ]
+
+    def top_counterparties(self, cnic, limit=5):
+        # Counterparties with the most money moved in either direction
+        with self.connection() as conn:
+            rows = conn.execute(
+                "SELECT * FROM counterparty_totals WHERE user_cnic = ? ORDER BY volume DESC LIMIT ?",
+                (cnic, limit),
+            ).fetchall()
+        return [
+            {"counterparty": row["counterparty"], "counterparty_cnic": row["counterparty_cnic"],
+             "paid": row["paid"] / 100, "received": row["received"] / 100, "count": row["count"]}
+            for row in rows
+        ]
+
+    def summary(self, cnic):
+        # Balance plus today's and this month's totals
+        today = time.strftime("%Y-%m-%d")
+        zero = {"paid": 0.0, "received": 0.0, "net": 0.0, "count": 0}
+        with self.connection() as conn:
+            rows = conn.execute(
+                "SELECT kind, paid, received, count FROM period_totals "
+                "WHERE user_cnic = ? AND ((kind = 'day' AND period = ?) OR (kind = 'month' AND period = ?))",
+                (cnic, today, today[:7]),
+            ).fetchall()
+        totals = {
+            row["kind"]: {"paid": row["paid"] / 100, "received": row["received"] / 100,
+                          "net": (row["received"] - row["paid"]) / 100, "count": row["count"]}
+            for row in rows
+        }
+        return {"balance": self.balance(cnic), "today": totals.get("day", zero), "month": totals.get("month", zero)}
+
+    def reconcile(self, fix=False):
+        # Compare the balances and aggregate tables against a full recompute
+        # from the transaction history. Returns one line per discrepancy; with
+        # fix=True the aggregates are rebuilt from the history afterwards
+        # (balances are never rewritten, those need a human).
+        problems = []
+        with self.transaction() as conn:
+            for row in conn.execute(f"""
+                SELECT cnic, balance, opening_balance + COALESCE(t.net, 0) AS expected, t.last_balance
+                FROM accounts LEFT JOIN (
+                    SELECT user_cnic, {RECEIVED} - {PAID} AS net,
+                           (SELECT balance_after FROM transactions WHERE user_cnic = x.user_cnic
+                            ORDER BY id DESC LIMIT 1) AS last_balance
+                    FROM transactions AS x GROUP BY user_cnic
+                ) AS t ON t.user_cnic = cnic
+                WHERE balance != expected OR balance != COALESCE(t.last_balance, balance)
+            """):
+                problems.append(
+                    f"account {row['cnic']}: balance {row['balance'] / 100:.2f}, "
+                    f"history gives {row['expected'] / 100:.2f}"
+                )
+            for table, columns, recomputed, key in (
+                ("period_totals", PERIOD_COLUMNS, RECOMPUTED_PERIOD_TOTALS, (0, 1, 2)),
+                ("counterparty_totals", COUNTERPARTY_COLUMNS, RECOMPUTED_COUNTERPARTY_TOTALS, (0, 1)),
+            ):
+                expected = f"SELECT {columns} FROM ({recomputed})"
+                stored = f"SELECT {columns} FROM {table}"
+                for label, query in (("stale", f"{stored} EXCEPT {expected}"),
+                                     ("missing", f"{expected} EXCEPT {stored}")):
+                    for row in conn.execute(query):
+                        name = "/".join(str(row[i]) for i in key)
+                        problems.append(f"{table} {label}: {name} {tuple(row)[len(key):]}")
+            if fix and problems:
+                self.rebuild_aggregates(conn)
+        return problems
+
+@lru_cache(maxsize=None)
+def get_ledger():
+    # One ledger (and connection pool) per process, shared by every session
+    return Ledger()
@@ -0,0 +1,89 @@
+# Concurrent payment load test.
+#
+# Many threads pay from the same account at once. Every thread submits the
+# same set of payments (same QR payloads, same scan session) in its own
+# order, the way double clicks, reruns and repeated scans resubmit a payment,
+# and the ledger is then checked for double charges:
+#
+#     python -m qrpay.loadtest --threads 32 --payments 500
+import argparse
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from qrpay.ledger import InsufficientFunds, Ledger
+from qrpay.payments import new_scan_session, payment_idempotency_key
+
+PAYER = ("Load Test Payer", "11111-1111111-1")
+RECIPIENT = ("Load Test Shop", "22222-2222222-2")
+
+def run(ledger, threads, payments, amount, opening_balance):
+    ledger.open_account(PAYER[1], PAYER[0], opening_balance)
+    ledger.open_account(RECIPIENT[1], RECIPIENT[0], 0)
+    session = new_scan_session()
+    keys = [payment_idempotency_key(f"QP:LOADTEST {n}", session) for n in range(payments)]
+    start = threading.Barrier(threads)
+    counts = {"paid": 0, "replayed": 0, "declined": 0}
+    lock = threading.Lock()
+
+    def worker(index):
+        order = list(keys)
+        random.Random(index).shuffle(order)
+        start.wait()
+        for key in order:
+            try:
+                transaction = ledger.transfer(PAYER[1], amount, RECIPIENT[0], RECIPIENT[1], key)
+                outcome = "replayed" if transaction["replayed"] else "paid"
+            except InsufficientFunds:
+                outcome = "declined"
+            with lock:
+                counts[outcome] += 1
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        list(pool.map(worker, range(threads)))
+    return counts, time.perf_counter() - started
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Hammer one ledger account with concurrent, repeated payments")
+    parser.add_argument("--threads", type=int, default=16, help="Concurrent payers")
+    parser.add_argument("--payments", type=int, default=200, help="Distinct payments, each submitted by every thread")
+    parser.add_argument("--amount", type=float, default=1.0, help="PKR per payment")
+    parser.add_argument("--opening-balance", type=float,
+                        help="Payer's opening balance (default: enough for three quarters of the payments)")
+    parser.add_argument("--ledger", help="Ledger file to use (default: a temporary file)")
+    args = parser.parse_args(argv)
+
+    opening = args.opening_balance
+    if opening is None:
+        opening = args.amount * (args.payments * 3 // 4)
+    with tempfile.TemporaryDirectory() as tmp:
+        ledger = Ledger(args.ledger or os.path.join(tmp, "loadtest.db"), pool_size=args.threads)
+        counts, elapsed = run(ledger, args.threads, args.payments, args.amount, opening)
+        payer_balance = ledger.balance(PAYER[1])
+        recipient_balance = ledger.balance(RECIPIENT[1])
+        problems = ledger.reconcile()
+        ledger.close()
+
+    total = sum(counts.values())
+    print(f"{total} submissions from {args.threads} threads in {elapsed:.2f}s ({total / elapsed:.0f}/s): "
+          f"{counts['paid']} paid, {counts['replayed']} replayed, {counts['declined']} declined")
+    expected_paid = min(args.payments, int(round(opening / args.amount, 6)))
+    failures = []
+    if counts["paid"] != expected_paid:
+        failures.append(f"expected {expected_paid} payments, ledger took {counts['paid']}")
+    if round(payer_balance, 2) != round(opening - counts["paid"] * args.amount, 2):
+        failures.append(f"payer balance {payer_balance:.2f} does not match {counts['paid']} payments")
+    if round(payer_balance + recipient_balance, 2) != round(opening, 2):
+        failures.append(f"money not conserved: {payer_balance:.2f} + {recipient_balance:.2f} != {opening:.2f}")
+    failures += problems
+    for line in failures:
+        print(f"FAIL {line}")
+    return 1 if failures else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
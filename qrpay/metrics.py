@@ -0,0 +1,149 @@
+import bisect
+import os
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Per-stage latency histograms of the scan-to-pay pipeline, exported in the
+# Prometheus text format. Observing is a bisect and a few additions under a
+# lock, cheap enough for every frame; QRPAY_METRICS=0 turns it off entirely.
+#
+#   frame_receive      QRCodeScanner.recv, the whole per-frame callback
+#   color_conversion   frame to luma plane (live) or encoded upload to grayscale
+#   detect             cheap locate-only pass of the live scanner
+#   decode             live decode pass, or the upload enhancement ladder
+#   upload_decode      qrpay.server: an upload on the image workers, end to end
+#   consistency_check  confirming a code over consecutive decodes
+#   scan_to_confirm    first frame of a scanner session to a confirmed code
+#   parse              parse_qr_data
+#   payment_commit     the ledger transfer of a payment
+
+METRICS_ENABLED = os.environ.get("QRPAY_METRICS", "1").lower() not in ("0", "false", "no", "off")
+
+# Port of the standalone /metrics endpoint started by the Streamlit app;
+# unset means no endpoint (qrpay.server serves /metrics on its own port)
+METRICS_PORT = int(os.environ.get("QRPAY_METRICS_PORT", "0"))
+
+# Upper bounds of the histogram buckets, in seconds
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+class Histogram:
+    # Cumulative-bucket latency histogram, one per stage
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # last slot is +Inf
+        self.sum = 0.0
+        self.count = 0
+        self.lock = threading.Lock()
+
+    def observe(self, seconds):
+        index = bisect.bisect_left(self.buckets, seconds)
+        with self.lock:
+            self.counts[index] += 1
+            self.sum += seconds
+            self.count += 1
+
+    def snapshot(self):
+        with self.lock:
+            return list(self.counts), self.sum, self.count
+
+stage_histograms = {}
+stage_histograms_lock = threading.Lock()
+
+def observe(stage, seconds):
+    if not METRICS_ENABLED:
+        return
+    histogram = stage_histograms.get(stage)
+    if histogram is None:
+        with stage_histograms_lock:
+            histogram = stage_histograms.setdefault(stage, Histogram())
+    histogram.observe(seconds)
+
+@contextmanager
+def timed(stage):
+    # Observe the time spent in the with block, also when it raises
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(stage, time.perf_counter() - started)
+
+def stage_items():
+    with stage_histograms_lock:
+        return sorted(stage_histograms.items())
+
+def stage_summary():
+    # {stage: {"count", "mean_ms"}} for quick looks and tests
+    summary = {}
+    for stage, histogram in stage_items():
+        _, total, count = histogram.snapshot()
+        summary[stage] = {"count": count, "mean_ms": round(total / count * 1000, 3) if count else None}
+    return summary
+
+def format_le(bound):
+    return "+Inf" if bound is None else repr(float(bound))
+
+def render_prometheus(extra_counters=()):
+    # Prometheus text exposition of the stage histograms. extra_counters are
+    # (name, help, type, [(labels dict, value), ...]) for other process stats.
+    lines = [
+        "# HELP qrpay_stage_seconds Latency of each scan-to-pay pipeline stage.",
+        "# TYPE qrpay_stage_seconds histogram",
+    ]
+    for stage, histogram in stage_items():
+        counts, total, count = histogram.snapshot()
+        cumulative = 0
+        for bound, n in zip(list(histogram.buckets) + [None], counts):
+            cumulative += n
+            lines.append(f'qrpay_stage_seconds_bucket{{stage="{stage}",le="{format_le(bound)}"}} {cumulative}')
+        lines.append(f'qrpay_stage_seconds_sum{{stage="{stage}"}} {total!r}')
+        lines.append(f'qrpay_stage_seconds_count{{stage="{stage}"}} {count}')
+    for name, help_text, kind, samples in extra_counters:
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} {kind}")
+        for labels, value in samples:
+            label_text = ",".join(f'{key}="{val}"' for key, val in labels.items())
+            lines.append(f"{name}{{{label_text}}} {value}" if label_text else f"{name} {value}")
+    return "\n".join(lines) + "\n"
+
+def cache_counters(caches):
+    # Prometheus samples from {"cache name": DecodeCache.stats()} style dicts (QRImageCache too)
+    counters = []
+    for field, kind in (("hits", "counter"), ("disk_hits", "counter"), ("misses", "counter"),
+                        ("evictions", "counter"), ("disk_evictions", "counter"),
+                        ("entries", "gauge"), ("hit_ratio", "gauge")):
+        suffix = "_total" if kind == "counter" else ""
+        samples = [({"cache": name}, stats[field]) for name, stats in caches.items()
+                   if stats.get(field) is not None]
+        counters.append((f"qrpay_cache_{field}{suffix}", f"Cache {field.replace('_', ' ')}.", kind, samples))
+    return counters
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        from qrpay.service import cache_stats
+        body = render_prometheus(cache_counters(cache_stats())).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+metrics_server_lock = threading.Lock()
+metrics_server = None
+
+def start_metrics_server(port=METRICS_PORT, host="127.0.0.1"):
+    # Serve GET /metrics from a daemon thread; only the first call starts it
+    global metrics_server
+    with metrics_server_lock:
+        if metrics_server is None and port:
+            metrics_server = ThreadingHTTPServer((host, port), MetricsHandler)
+            threading.Thread(target=metrics_server.serve_forever, name="qrpay-metrics", daemon=True).start()
+            print(f"Metrics on http://{host}:{port}/metrics")
+    return metrics_server
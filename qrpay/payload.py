@@ -0,0 +1,184 @@
+import json
+import re
+import struct
+import zlib
+
+from qrpay.cache import MISS, get_parse_cache
+from qrpay.metrics import timed
+
+# Compact payment payloads.
+#
+# "QP:" followed by the base45 (RFC 9285) text of
+#
+#     version  u8      PAYLOAD_VERSION
+#     cnic     6 bytes 13 CNIC digits as a big-endian integer
+#     amount   varint  amount in paisa
+#     sender   varint length + UTF-8
+#     invoice  varint length + UTF-8 (optional, only when present)
+#     crc      u32     CRC-32 of everything above
+#
+# Base45 uses only the QR alphanumeric character set, so the whole string is
+# encoded in alphanumeric mode and needs a much smaller QR version than the
+# equivalent JSON in byte mode.
+
+PAYLOAD_PREFIX = "QP:"
+PAYLOAD_VERSION = 1
+
+BASE45_CHARSET = "0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZ $%*+-./:"
+BASE45_VALUES = {c: i for i, c in enumerate(BASE45_CHARSET)}
+
+CNIC_PATTERN = re.compile(r"^(\d{5})-(\d{7})-(\d)$")
+
+def base45_encode(data):
+    out = []
+    for i in range(0, len(data) - 1, 2):
+        n = data[i] * 256 + data[i + 1]
+        out += [n % 45, n // 45 % 45, n // 2025]
+    if len(data) % 2:
+        out += [data[-1] % 45, data[-1] // 45]
+    return "".join(BASE45_CHARSET[v] for v in out)
+
+def base45_decode(text):
+    try:
+        values = [BASE45_VALUES[c] for c in text]
+    except KeyError as e:
+        raise ValueError(f"invalid base45 character {e.args[0]!r}")
+    if len(values) % 3 == 1:
+        raise ValueError("invalid base45 length")
+    out = bytearray()
+    for i in range(0, len(values), 3):
+        chunk = values[i:i + 3]
+        n = sum(v * 45 ** k for k, v in enumerate(chunk))
+        if len(chunk) == 3:
+            if n > 0xFFFF:
+                raise ValueError("invalid base45 triplet")
+            out += n.to_bytes(2, "big")
+        else:
+            if n > 0xFF:
+                raise ValueError("invalid base45 pair")
+            out.append(n)
+    return bytes(out)
+
+def write_varint(out, n):
+    while n >= 0x80:
+        out.append(n & 0x7F | 0x80)
+        n >>= 7
+    out.append(n)
+
+def read_varint(data, pos):
+    n = shift = 0
+    while True:
+        if pos >= len(data):
+            raise ValueError("truncated payload")
+        byte = data[pos]
+        pos += 1
+        n |= (byte & 0x7F) << shift
+        if byte < 0x80:
+            return n, pos
+        shift += 7
+
+def write_text(out, text):
+    raw = text.encode("utf-8")
+    write_varint(out, len(raw))
+    out += raw
+
+def read_text(data, pos):
+    length, pos = read_varint(data, pos)
+    if pos + length > len(data):
+        raise ValueError("truncated payload")
+    return data[pos:pos + length].decode("utf-8"), pos + length
+
+def encode_payment(payment):
+    # Compact string for a payment dict, or None when it carries anything the
+    # format cannot represent exactly (extra keys, sub-paisa amounts, ...)
+    if set(payment) - {"type", "sender", "sender_cnic", "amount", "invoice"}:
+        return None
+    match = CNIC_PATTERN.match(str(payment.get("sender_cnic", "")))
+    sender = payment.get("sender")
+    amount = payment.get("amount")
+    invoice = payment.get("invoice")
+    if payment.get("type") != "payment" or not match or not isinstance(sender, str):
+        return None
+    if not isinstance(amount, (int, float)) or amount < 0 or round(amount * 100) / 100 != amount:
+        return None
+    if invoice is not None and not isinstance(invoice, str):
+        return None
+
+    out = bytearray([PAYLOAD_VERSION])
+    out += int("".join(match.groups())).to_bytes(6, "big")
+    write_varint(out, round(amount * 100))
+    write_text(out, sender)
+    if invoice is not None:
+        write_text(out, invoice)
+    out += struct.pack(">I", zlib.crc32(out))
+    return PAYLOAD_PREFIX + base45_encode(bytes(out))
+
+def decode_payment(text):
+    # Payment dict from a compact string; raises ValueError when it is damaged
+    if not text.startswith(PAYLOAD_PREFIX):
+        raise ValueError("not a compact payment payload")
+    data = base45_decode(text[len(PAYLOAD_PREFIX):])
+    if len(data) < 5:
+        raise ValueError("truncated payload")
+    body, (crc,) = data[:-4], struct.unpack(">I", data[-4:])
+    if zlib.crc32(body) != crc:
+        raise ValueError("payload checksum mismatch")
+    if body[0] != PAYLOAD_VERSION:
+        raise ValueError(f"unsupported payload version {body[0]}")
+
+    if len(body) < 7:
+        raise ValueError("truncated payload")
+    digits = f"{int.from_bytes(body[1:7], 'big'):013d}"
+    paisa, pos = read_varint(body, 7)
+    sender, pos = read_text(body, pos)
+    payment = {
+        "type": "payment",
+        "sender": sender,
+        "sender_cnic": f"{digits[:5]}-{digits[5:12]}-{digits[12]}",
+        "amount": paisa / 100,
+    }
+    if pos < len(body):
+        payment["invoice"], pos = read_text(body, pos)
+    if pos != len(body):
+        raise ValueError("trailing bytes in payload")
+    return payment
+
+def encode_qr_payload(data):
+    # Text to put in a QR code: the compact form for payments it can
+    # represent, JSON for everything else (user info codes, extra fields)
+    if isinstance(data, dict):
+        compact = encode_payment(data)
+        if compact is not None:
+            return compact
+    return json.dumps(data)
+
+def decode_qr_payload(text):
+    # Inverse of encode_qr_payload; legacy JSON codes still decode
+    if text.startswith(PAYLOAD_PREFIX):
+        return decode_payment(text)
+    return json.loads(text)
+
+# Function to parse QR data
+def parse_qr_data(qr_data):
+    # Rescans of the same code are answered from the parse cache, keyed by
+    # the exact QR text
+    with timed("parse"):
+        cache = get_parse_cache()
+        payment_data = cache.get(qr_data)
+        if payment_data is MISS:
+            payment_data = parse_payment_text(qr_data)
+            cache.put(qr_data, payment_data)
+    return payment_data
+
+def parse_payment_text(qr_data):
+    try:
+        payment_data = decode_qr_payload(qr_data)
+        if 'type' in payment_data and payment_data['type'] == 'payment':
+            print(f"Valid payment QR code detected: {payment_data}")
+            return payment_data
+        else:
+            print("Invalid QR code: Not a payment request.")
+            return None
+    except Exception as e:
+        print(f"Error parsing QR code data: {str(e)}")
+        return None
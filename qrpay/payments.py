@@ -0,0 +1,19 @@
+import hashlib
+import re
+import uuid
+
+# Function to validate CNIC format
+def validate_cnic(cnic):
+    # Pattern for CNIC: 00000-0000000-0 (exactly this format)
+    pattern = r'^\d{5}-\d{7}-\d{1}$'
+    return bool(re.match(pattern, cnic))
+
+# Function to start a scan session: every payment made from one scan shares
+# the session's idempotency key, whatever reruns or double clicks happen
+def new_scan_session():
+    return uuid.uuid4().hex
+
+# Function to derive the idempotency key of a payment from the scanned QR
+# payload and the scan session it was read in
+def payment_idempotency_key(qr_data, scan_session):
+    return hashlib.sha256(f"{scan_session}\n{qr_data}".encode("utf-8")).hexdigest()
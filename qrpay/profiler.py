@@ -0,0 +1,311 @@
+# Sampling profiler for the live scanner and the Streamlit app.
+#
+# A background thread samples the Python stacks of every thread in the process
+# and writes them in the folded format (one "frame;frame;frame count" line per
+# unique stack) that flamegraph.pl, speedscope and inferno read directly.
+# Nothing runs until a profile is started, so a disabled profiler costs one
+# attribute check per frame.
+#
+# Scanner sessions profile their first N frames or seconds when
+# QRPAY_PROFILE_FRAMES or QRPAY_PROFILE_SECONDS is set, and with
+# QRPAY_PROFILE_RECORD=1 also save the frames they saw, which can be replayed
+# through a headless scanner under the profiler:
+#
+#     python -m qrpay.profiler replay profiles/scanner-20250101-120000-frames.npz
+#     python -m qrpay.profiler replay counter.mp4 --frames 300 --fps 30 --out replay.folded
+#     flamegraph.pl replay.folded > replay.svg
+import argparse
+import os
+import sys
+import threading
+import time
+from collections import Counter
+
+# Where profiles and recordings are written
+PROFILE_DIR = os.environ.get("QRPAY_PROFILE_DIR", "profiles")
+
+# Seconds between stack samples
+PROFILE_INTERVAL = float(os.environ.get("QRPAY_PROFILE_INTERVAL", "0.005"))
+
+# Profile the first N frames / seconds of every live scanner session (0 = off)
+PROFILE_FRAMES = int(os.environ.get("QRPAY_PROFILE_FRAMES", "0"))
+PROFILE_SECONDS = float(os.environ.get("QRPAY_PROFILE_SECONDS", "0"))
+
+# Also save the frames seen while profiling a scanner, for replay
+PROFILE_RECORD = os.environ.get("QRPAY_PROFILE_RECORD", "0").lower() in ("1", "true", "yes", "on")
+
+# Most frames and luma bytes one recording keeps in memory; profiling goes on
+# without recording once either is reached (300 1080p frames are ~600 MB)
+PROFILE_RECORD_MAX_FRAMES = int(os.environ.get("QRPAY_PROFILE_RECORD_MAX_FRAMES", "300"))
+PROFILE_RECORD_MAX_BYTES = int(float(os.environ.get("QRPAY_PROFILE_RECORD_MAX_MB", "256")) * 1024 * 1024)
+
+class StackSampler:
+    # Samples sys._current_frames() every interval until stopped or the
+    # deadline passes. Stacks are rooted at the thread name, so the decode
+    # pool, WebRTC and Streamlit script threads show up as separate towers.
+    def __init__(self, interval=PROFILE_INTERVAL):
+        self.interval = interval
+        self.stacks = Counter()
+        self.samples = 0
+        self.stop_event = threading.Event()
+        self.thread = None
+
+    def start(self, seconds=None):
+        deadline = time.perf_counter() + seconds if seconds else None
+        self.thread = threading.Thread(target=self.run, args=(deadline,), name="qrpay-profiler", daemon=True)
+        self.thread.start()
+        return self
+
+    def run(self, deadline):
+        own = threading.get_ident()
+        names = {}
+        while not self.stop_event.wait(self.interval):
+            if deadline is not None and time.perf_counter() >= deadline:
+                break
+            frames = sys._current_frames()
+            if frames.keys() - names.keys():
+                names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for ident, frame in frames.items():
+                if ident == own:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                    frame = frame.f_back
+                stack.append(names.get(ident, str(ident)))
+                self.stacks[";".join(reversed(stack))] += 1
+            self.samples += 1
+
+    def stop(self):
+        self.stop_event.set()
+        if self.thread is not None and self.thread is not threading.current_thread():
+            self.thread.join()
+
+    def write(self, path):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        with open(path, "w") as f:
+            for stack, count in sorted(self.stacks.items()):
+                f.write(f"{stack} {count}\n")
+        return path
+
+    def top(self, limit=15):
+        # Functions by self time (the innermost frame of each sample)
+        leaves = Counter()
+        for stack, count in self.stacks.items():
+            leaves[stack.rsplit(";", 1)[-1]] += count
+        return leaves.most_common(limit)
+
+# Sampling covers every thread, so only one profile runs per process at a time
+active_lock = threading.Lock()
+active_profile = None
+
+def profile_path(name, suffix):
+    return os.path.join(PROFILE_DIR, f"{name}-{time.strftime('%Y%m%d-%H%M%S')}{suffix}")
+
+class ProfileSession:
+    # A profile bounded by frames and/or seconds. The scanner calls on_frame
+    # for every frame while it is active; app-wide profiles are bounded by
+    # seconds only. The folded stacks (and the recording, if any) are written
+    # when the bound is reached or finish is called. lock guards recorded and
+    # finished, since the frame thread, the timer and on_ended can all race.
+    def __init__(self, name, frames=0, seconds=0.0, record=False, interval=PROFILE_INTERVAL):
+        self.name = name
+        self.frames = frames
+        self.seconds = seconds
+        self.record = record
+        self.sampler = StackSampler(interval)
+        self.frame_count = 0
+        self.started = None
+        self.recorded = []          # (seconds since start, luma ndarray)
+        self.recorded_bytes = 0
+        self.path = None
+        self.finished = False
+        self.lock = threading.Lock()
+
+    def start(self):
+        global active_profile
+        with active_lock:
+            if active_profile is not None:
+                print(f"Profile {self.name} not started: {active_profile.name} is still running")
+                self.finished = True
+                return False
+            active_profile = self
+        self.started = time.perf_counter()
+        self.path = profile_path(self.name, ".folded")
+        self.sampler.start()
+        print(f"Profiling {self.name} for {self.describe_bound()}")
+        if self.seconds and not self.frames:
+            # No frames drive this profile, so a timer ends it
+            timer = threading.Timer(self.seconds, self.finish)
+            timer.daemon = True
+            timer.start()
+        return True
+
+    def describe_bound(self):
+        bounds = []
+        if self.frames:
+            bounds.append(f"{self.frames} frames")
+        if self.seconds:
+            bounds.append(f"{self.seconds:g} s")
+        return " or ".join(bounds) or "until stopped"
+
+    def on_frame(self, frame):
+        # Returns False once the profile is over and the caller can drop it
+        if self.finished:
+            return False
+        if self.started is None and not self.start():
+            return False
+        self.frame_count += 1
+        if self.record:
+            self.record_frame(frame)
+        if (self.frames and self.frame_count >= self.frames) or (
+                self.seconds and time.perf_counter() - self.started >= self.seconds):
+            # Writing (and compressing a recording) must not stall the frame thread
+            threading.Thread(target=self.finish, name="qrpay-profile-writer").start()
+            return False
+        return True
+
+    def record_frame(self, frame):
+        from qrpay.scanner import luma_plane
+        luma = luma_plane(frame)
+        with self.lock:
+            if self.finished or not self.record:
+                return
+            if (len(self.recorded) >= PROFILE_RECORD_MAX_FRAMES
+                    or self.recorded_bytes + luma.nbytes > PROFILE_RECORD_MAX_BYTES):
+                self.record = False
+                print(f"Profile {self.name}: recording stopped at {len(self.recorded)} frames "
+                      f"({self.recorded_bytes / (1024 * 1024):.0f} MB), still profiling")
+                return
+            self.recorded.append((time.perf_counter() - self.started, luma.copy()))
+            self.recorded_bytes += luma.nbytes
+
+    def finish(self):
+        global active_profile
+        with self.lock:
+            if self.finished:
+                return
+            self.finished = True
+            # Frames arriving from now on are not recorded
+            recorded, self.recorded = self.recorded, []
+        with active_lock:
+            if active_profile is self:
+                active_profile = None
+        self.sampler.stop()
+        self.sampler.write(self.path)
+        print(f"Profile {self.name}: {self.sampler.samples} samples, "
+              f"{self.frame_count} frames written to {self.path}")
+        if recorded:
+            self.write_recording(self.path[:-len(".folded")] + "-frames.npz", recorded)
+
+    def write_recording(self, path, recorded):
+        import numpy as np
+        shapes = {img.shape for _, img in recorded}
+        if len(shapes) > 1:
+            # Resolution changed mid-stream; keep the frames of the last size
+            shape = recorded[-1][1].shape
+            recorded = [(t, img) for t, img in recorded if img.shape == shape]
+        np.savez_compressed(
+            path,
+            timestamps=np.array([t for t, _ in recorded]),
+            frames=np.stack([img for _, img in recorded]),
+        )
+        print(f"Recorded {len(recorded)} frames to {path}")
+
+def start_profile(name, seconds):
+    # Profile the whole process for a number of seconds (the Streamlit app);
+    # returns the session, or None when another profile is running
+    session = ProfileSession(name, seconds=seconds)
+    return session if session.start() else None
+
+def scanner_profile():
+    # Profile for a new scanner session from the QRPAY_PROFILE_* settings, or None
+    if not (PROFILE_FRAMES or PROFILE_SECONDS):
+        return None
+    return ProfileSession("scanner", PROFILE_FRAMES, PROFILE_SECONDS, PROFILE_RECORD)
+
+def load_recording(path, max_frames=None):
+    # [(timestamp, yuv420p VideoFrame)] from a recording (.npz) or a video file
+    import av
+    import cv2
+    import numpy as np
+
+    frames = []
+    if path.endswith(".npz"):
+        with np.load(path) as data:
+            for t, luma in zip(data["timestamps"], data["frames"]):
+                frames.append((float(t), luma))
+                if max_frames and len(frames) >= max_frames:
+                    break
+    else:
+        capture = cv2.VideoCapture(path)
+        fps = capture.get(cv2.CAP_PROP_FPS) or 30.0
+        while not max_frames or len(frames) < max_frames:
+            ok, img = capture.read()
+            if not ok:
+                break
+            frames.append((len(frames) / fps, cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)))
+        capture.release()
+    if not frames:
+        raise ValueError(f"no frames in {path}")
+    # WebRTC delivers yuv420p; build those frames up front so the conversion is not profiled
+    return [(t, av.VideoFrame.from_ndarray(luma, format="gray").reformat(format="yuv420p")) for t, luma in frames]
+
+def wait_for_frame(due):
+    # Pacing between replayed frames; its own function so the idle time is
+    # labelled as such in the profile
+    time.sleep(max(0.0, due - time.perf_counter()))
+
+def replay(path, out=None, max_frames=None, fps=None, multi_code=False, interval=PROFILE_INTERVAL):
+    # Feed a recording through a headless scanner at its recorded pace (or
+    # fps) while sampling, and return the session
+    from qrpay.scanner import QRCodeScanner
+
+    frames = load_recording(path, max_frames)
+    scanner = QRCodeScanner(session_sync=False, multi_code=multi_code)
+    session = ProfileSession("replay", interval=interval)
+    if not session.start():
+        raise RuntimeError("another profile is running")
+    if out:
+        session.path = out
+    started = time.perf_counter()
+    confirmed_at = None
+    for index, (t, frame) in enumerate(frames):
+        wait_for_frame(started + (index / fps if fps else t))
+        frame.pts = index
+        scanner.recv(frame)
+        session.frame_count += 1
+        if scanner.qr_detected and confirmed_at is None:
+            confirmed_at = time.perf_counter() - started
+            # Keep going like a kiosk would until the camera is stopped
+            scanner.qr_detected = False
+            scanner.detection_counter = 0
+    scanner.on_ended()
+    session.finish()
+    session.confirmed_after = confirmed_at
+    return session
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Profile the QR scanner")
+    commands = parser.add_subparsers(dest="command", required=True)
+    replay_parser = commands.add_parser("replay", help="Replay recorded frames through a headless scanner")
+    replay_parser.add_argument("recording", help="Recording (.npz) from a profiled session, or a video file")
+    replay_parser.add_argument("--out", help="Folded stacks output (default: profiles/replay-<time>.folded)")
+    replay_parser.add_argument("--frames", type=int, help="Replay at most this many frames")
+    replay_parser.add_argument("--fps", type=float, help="Replay at this rate instead of the recorded timing")
+    replay_parser.add_argument("--multi-code", action="store_true", help="Scan in multi-code mode")
+    replay_parser.add_argument("--interval", type=float, default=PROFILE_INTERVAL, help="Seconds between samples")
+    args = parser.parse_args(argv)
+
+    session = replay(args.recording, args.out, args.frames, args.fps, args.multi_code, args.interval)
+    if session.confirmed_after is not None:
+        print(f"First code confirmed after {session.confirmed_after * 1000:.0f} ms")
+    print("Top functions by self time:")
+    total = sum(session.sampler.stacks.values()) or 1
+    for function, count in session.sampler.top():
+        print(f"{count / total * 100:6.1f}%  {function}")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
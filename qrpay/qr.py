@@ -0,0 +1,515 @@
+import io
+import os
+import json
+import time
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+
+import cv2
+import numpy as np
+import qrcode
+from PIL import Image
+
+# parse_qr_data lives with the payload format, which does not need OpenCV
+from qrpay.payload import encode_qr_payload, parse_qr_data
+
+# Padding added around a known code position (as a fraction of its size)
+# when cropping the region to decode
+ROI_PADDING = 0.5
+
+def crop_around_bbox(img, bbox, pad=ROI_PADDING):
+    # Return the padded region of img around bbox and its (x, y) offset,
+    # or (None, None) if the region is too small to hold a readable code
+    pts = np.asarray(bbox, dtype=np.float32).reshape(-1, 2)
+    x_min, y_min = pts.min(axis=0)
+    x_max, y_max = pts.max(axis=0)
+    pad_x = (x_max - x_min) * pad
+    pad_y = (y_max - y_min) * pad
+    h, w = img.shape[:2]
+    x0 = max(int(x_min - pad_x), 0)
+    y0 = max(int(y_min - pad_y), 0)
+    x1 = min(int(x_max + pad_x) + 1, w)
+    y1 = min(int(y_max + pad_y) + 1, h)
+    if x1 - x0 < 21 or y1 - y0 < 21:
+        return None, None
+    return img[y0:y1, x0:x1], np.array([x0, y0], dtype=np.float32)
+
+# Downscaled detection: longest side of the image used to locate codes while
+# their size is unknown, and the module size (in pixels) to aim for once it is
+PYRAMID_MAX_SIDE = int(os.environ.get("QRPAY_PYRAMID_MAX_SIDE", "640"))
+PYRAMID_MODULE_PX = 3.0
+PYRAMID_MIN_SCALE = 0.125
+
+def pyramid_scale(shape, module_px=None, scale=None):
+    # Pick the factor used to downscale an image of this shape before locating
+    # codes; an explicit scale wins, then the known module size, then the image size
+    if scale is None:
+        if module_px:
+            scale = PYRAMID_MODULE_PX / module_px
+        else:
+            scale = PYRAMID_MAX_SIDE / max(shape[:2])
+    return min(1.0, max(scale, PYRAMID_MIN_SCALE))
+
+def estimate_module_px(bbox, straight_qrcode):
+    # straight_qrcode is the rectified code at one pixel per module, so its
+    # width is the module count and gives the module size in the frame
+    if bbox is None or straight_qrcode is None or straight_qrcode.size == 0:
+        return None
+    pts = np.asarray(bbox, dtype=np.float32).reshape(-1, 2)
+    side = np.linalg.norm(pts - np.roll(pts, 1, axis=0), axis=1).mean()
+    return float(side) / straight_qrcode.shape[1]
+
+def pyramid_locate(detector, img, scale, multi=False):
+    # Find code quads on a downscaled grayscale copy of img and map them back
+    # to full-resolution coordinates, shaped like detect() output (1, 4, 2)
+    small = img
+    if scale < 1.0:
+        small = cv2.resize(img, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+    if small.ndim == 3:
+        small = cv2.cvtColor(small, cv2.COLOR_BGR2GRAY)
+    if multi:
+        found, points = detector.detectMulti(small)
+    else:
+        found, points = detector.detect(small)
+    if not found or points is None:
+        return []
+    return [quad.reshape(1, 4, 2) / scale for quad in points.reshape(-1, 4, 2)]
+
+def decode_at(detector, img, quad):
+    # Decode only the full-resolution crop around a quad found at a coarser scale
+    roi, offset = crop_around_bbox(img, quad)
+    if roi is None:
+        return None, None, None
+    data, bbox, straight_qrcode = detector.detectAndDecode(roi)
+    if bbox is not None:
+        bbox = bbox + offset
+    return data, bbox, straight_qrcode
+
+# Decoder backends: name -> factory returning an object with the
+# cv2.QRCodeDetector methods (detect, detectMulti, detectAndDecode,
+# detectAndDecodeMulti), or None when the backend is not available here
+DECODER_BACKENDS = {}
+
+# Where the WeChat CNN detector looks for its model files
+WECHAT_MODEL_DIR = os.environ.get(
+    "QRPAY_WECHAT_MODEL_DIR",
+    os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "models", "wechat_qrcode"),
+)
+WECHAT_MODEL_FILES = ("detect.prototxt", "detect.caffemodel", "sr.prototxt", "sr.caffemodel")
+
+def register_decoder_backend(name):
+    # Decorator adding a detector factory to DECODER_BACKENDS under name
+    def register(factory):
+        DECODER_BACKENDS[name] = factory
+        return factory
+    return register
+
+@register_decoder_backend("classic")
+def make_classic_detector():
+    return cv2.QRCodeDetector()
+
+@register_decoder_backend("aruco")
+def make_aruco_detector():
+    # Only in OpenCV 4.8 and above
+    if not hasattr(cv2, "QRCodeDetectorAruco"):
+        return None
+    return cv2.QRCodeDetectorAruco()
+
+@register_decoder_backend("wechat")
+def make_wechat_detector():
+    # Needs opencv-contrib and the model files present locally
+    paths = [os.path.join(WECHAT_MODEL_DIR, name) for name in WECHAT_MODEL_FILES]
+    if not hasattr(cv2, "wechat_qrcode_WeChatQRCode") or not all(os.path.exists(p) for p in paths):
+        return None
+    return WeChatQRDetector(cv2.wechat_qrcode_WeChatQRCode(*paths))
+
+class WeChatQRDetector:
+    # Adapts cv2.wechat_qrcode_WeChatQRCode to the QRCodeDetector method names.
+    # The CNN detector only reports codes it could decode and has no rectified output.
+    def __init__(self, detector):
+        self.detector = detector
+
+    def detectAndDecodeMulti(self, img):
+        texts, points = self.detector.detectAndDecode(img)
+        if not texts:
+            return False, (), None, None
+        return True, tuple(texts), np.array(points, dtype=np.float32).reshape(-1, 4, 2), None
+
+    def detectAndDecode(self, img):
+        found, texts, points, _ = self.detectAndDecodeMulti(img)
+        if not found:
+            return "", None, None
+        return texts[0], points[:1], None
+
+    def detectMulti(self, img):
+        found, _, points, _ = self.detectAndDecodeMulti(img)
+        return found, points
+
+    def detect(self, img):
+        found, _, points, _ = self.detectAndDecodeMulti(img)
+        return found, points[:1] if found else None
+
+@lru_cache(maxsize=None)
+def build_decoder_corpus():
+    # Small bundled corpus for the backend benchmark and detector warm-up:
+    # payment codes at a few module sizes and angles, padded with a quiet zone
+    # like a real photo. Cached and shared, so callers must not modify the images.
+    corpus = []
+    for box_size, angle in ((3, 0), (5, 12), (8, -25)):
+        data = {"type": "payment", "sender": "Benchmark", "sender_cnic": "12345-1234567-1", "amount": 100.0 * box_size}
+        img = cv2.cvtColor(generate_qr_array(data, box_size=box_size), cv2.COLOR_GRAY2BGR)
+        img = cv2.copyMakeBorder(img, 40, 40, 40, 40, cv2.BORDER_CONSTANT, value=(255, 255, 255))
+        h, w = img.shape[:2]
+        rotation = cv2.getRotationMatrix2D((w / 2, h / 2), angle, 1.0)
+        img = cv2.warpAffine(img, rotation, (w, h), borderValue=(255, 255, 255))
+        corpus.append((img, encode_qr_payload(data)))
+    return corpus
+
+@lru_cache(maxsize=None)
+def select_decoder_backend():
+    # Startup micro-benchmark: the fastest available backend that reads the
+    # whole corpus correctly wins. QRPAY_DECODER_BACKEND restricts the choice.
+    forced = os.environ.get("QRPAY_DECODER_BACKEND")
+    corpus = build_decoder_corpus()
+    best_name, best_time = "classic", None
+    for name, factory in DECODER_BACKENDS.items():
+        if forced and name != forced:
+            continue
+        try:
+            detector = factory()
+            if detector is None:
+                continue
+            configure_qr_detector(detector)
+            # Warm up once so one-off initialisation is not counted
+            detector.detectAndDecode(corpus[0][0])
+            started = time.perf_counter()
+            for img, expected in corpus:
+                data, _, _ = detector.detectAndDecode(img)
+                if data != expected:
+                    raise ValueError(f"misread corpus code as {data!r}")
+            elapsed = time.perf_counter() - started
+        except Exception as e:
+            print(f"Decoder backend {name} rejected: {str(e)}")
+            continue
+        print(f"Decoder backend {name}: {elapsed * 1000:.1f} ms for {len(corpus)} images")
+        if best_time is None or elapsed < best_time:
+            best_name, best_time = name, elapsed
+    print(f"Using {best_name} QR decoder backend")
+    return best_name
+
+# Tuning of the classic detector, unset means OpenCV's defaults: the
+# tolerances used when matching finder pattern proportions along x and y, and
+# whether alignment markers are used to refine the geometry of larger codes.
+# Backends without these settings ignore them.
+QR_DETECTOR_EPS_X = os.environ.get("QRPAY_QR_EPS_X")
+QR_DETECTOR_EPS_Y = os.environ.get("QRPAY_QR_EPS_Y")
+QR_DETECTOR_ALIGNMENT_MARKERS = os.environ.get("QRPAY_QR_ALIGNMENT_MARKERS")
+
+def configure_qr_detector(detector, eps_x=QR_DETECTOR_EPS_X, eps_y=QR_DETECTOR_EPS_Y,
+                          alignment_markers=QR_DETECTOR_ALIGNMENT_MARKERS):
+    if eps_x is not None and hasattr(detector, "setEpsX"):
+        detector.setEpsX(float(eps_x))
+    if eps_y is not None and hasattr(detector, "setEpsY"):
+        detector.setEpsY(float(eps_y))
+    if alignment_markers is not None and hasattr(detector, "setUseAlignmentMarkers"):
+        detector.setUseAlignmentMarkers(str(alignment_markers).lower() in ("1", "true", "yes", "on"))
+    return detector
+
+def create_qr_detector():
+    # New configured detector from the selected backend. Detectors are not
+    # thread-safe; get_qr_detector hands out one per thread instead.
+    return configure_qr_detector(DECODER_BACKENDS[select_decoder_backend()]())
+
+class DetectorPool:
+    # One detector per thread, built on the thread's first decode and reused
+    # for the rest of its life. Decode pool workers, server and batch worker
+    # processes are long-lived, so construction happens once per worker
+    # instead of once per upload or scanner session.
+    def __init__(self, factory=create_qr_detector):
+        self.factory = factory
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.created = 0
+        self.warmed = 0
+
+    def get(self):
+        detector = getattr(self.local, "detector", None)
+        if detector is None:
+            detector = self.local.detector = self.factory()
+            with self.lock:
+                self.created += 1
+        return detector
+
+    def warm_up(self):
+        # Build this thread's detector and run every detector call used by the
+        # decode paths once, so the first real image does not pay for
+        # initialisation
+        if getattr(self.local, "warm", False):
+            return
+        detector = self.get()
+        img, _ = build_decoder_corpus()[0]
+        detector.detect(img)
+        detector.detectMulti(img)
+        detector.detectAndDecode(img)
+        detector.detectAndDecodeMulti(img)
+        self.local.warm = True
+        with self.lock:
+            self.warmed += 1
+
+    def stats(self):
+        with self.lock:
+            return {"detectors": self.created, "warmed": self.warmed}
+
+qr_detector_pool = DetectorPool()
+
+def get_qr_detector():
+    # The calling thread's detector
+    return qr_detector_pool.get()
+
+def warm_up_qr_detector():
+    # Also usable as a thread or process pool initializer
+    qr_detector_pool.warm_up()
+
+# Number of threads shared by live scanner sessions and uploads for QR
+# decoding. OpenCV releases the GIL while detecting, so threads scale across cores.
+DECODE_WORKERS = max(1, (os.cpu_count() or 2) - 1)
+
+@lru_cache(maxsize=None)
+def get_decode_executor():
+    # One pool per process; each worker thread warms its detector as it starts
+    return ThreadPoolExecutor(max_workers=DECODE_WORKERS, thread_name_prefix="qr-decode",
+                              initializer=warm_up_qr_detector)
+
+decode_executor_warm_lock = threading.Lock()
+decode_executor_warm = False
+
+def warm_up_decode_executor():
+    # Start the decode threads now instead of on the first frames after
+    # startup. A thread is added per submit while none is idle and warms its
+    # detector in the initializer before it takes any task, so no-op tasks
+    # are enough and a busy thread never holds this up.
+    global decode_executor_warm
+    with decode_executor_warm_lock:
+        if decode_executor_warm:
+            return
+        # Benchmark the backends once here, not in every starting thread at once
+        select_decoder_backend()
+        executor = get_decode_executor()
+        for future in [executor.submit(int) for _ in range(DECODE_WORKERS)]:
+            future.result()
+        decode_executor_warm = True
+
+
+# Function to turn a QR module matrix into pixels
+def rasterize_qr(modules, box_size):
+    # modules is the boolean matrix (border included, True for dark modules).
+    # Scaling it is a single pair of np.repeat calls instead of drawing each
+    # module; the result is True for white pixels.
+    light = ~np.asarray(modules, dtype=bool)
+    return np.repeat(np.repeat(light, box_size, axis=0), box_size, axis=1)
+
+# Robustness target: the lowest error correction level generated codes may
+# use (L, M, Q or H). Each code gets the smallest QR version that fits at this
+# level, then the highest level that still fits in that version.
+QR_ERROR_CORRECTION = os.environ.get("QRPAY_QR_ERROR_CORRECTION", "M").upper()
+
+EC_LEVELS = {
+    "L": qrcode.constants.ERROR_CORRECT_L,
+    "M": qrcode.constants.ERROR_CORRECT_M,
+    "Q": qrcode.constants.ERROR_CORRECT_Q,
+    "H": qrcode.constants.ERROR_CORRECT_H,
+}
+EC_ORDER = list(EC_LEVELS.values())
+
+def fit_qr_code(text, error_correction=None):
+    # QRCode of minimal version for text with at least the requested (or
+    # configured) error correction. Versions come from best_fit, a capacity
+    # lookup, so the matrix and its mask evaluation are built only once.
+    if error_correction is None:
+        error_correction = EC_LEVELS[QR_ERROR_CORRECTION]
+    qr = qrcode.QRCode(version=None, error_correction=error_correction, border=4)
+    qr.add_data(text)
+    version = qr.best_fit()
+    level = error_correction
+    for higher in EC_ORDER[EC_ORDER.index(error_correction) + 1:]:
+        qr.error_correction = higher
+        try:
+            if qr.best_fit() > version:
+                # Higher levels never fit in a smaller version
+                break
+        except qrcode.exceptions.DataOverflowError:
+            break
+        level = higher
+    qr.error_correction = level
+    qr.version = version
+    qr.make(fit=False)
+    return qr
+
+def build_qr_matrix(data, error_correction=None):
+    # Compact payload for payments, JSON for everything else
+    return fit_qr_code(encode_qr_payload(data), error_correction).get_matrix()
+
+# Function to generate QR code
+def generate_qr_code(data, box_size=10, error_correction=None):
+    # 1-bit image of the QR code, ready to be written as a 1-bit PNG
+    # with no RGB conversion
+    return Image.fromarray(rasterize_qr(build_qr_matrix(data, error_correction), box_size))
+
+def generate_qr_array(data, box_size=10, error_correction=None):
+    # Grayscale uint8 ndarray of the QR code (0 dark, 255 light) for OpenCV
+    return rasterize_qr(build_qr_matrix(data, error_correction), box_size).astype(np.uint8) * 255
+
+def generate_qr_svg(data, box_size=10, error_correction=None):
+    # SVG bytes of the QR code: one path with a rectangle per horizontal run
+    # of dark modules, so the file stays small at any print size
+    modules = np.asarray(build_qr_matrix(data, error_correction), dtype=bool)
+    size = modules.shape[0]
+    edges = np.diff(np.pad(modules, ((0, 0), (1, 1))).astype(np.int8), axis=1)
+    path = []
+    for y, row in enumerate(edges):
+        starts = np.flatnonzero(row == 1)
+        stops = np.flatnonzero(row == -1)
+        path.extend(f"M{x0},{y}h{x1 - x0}v1h{x0 - x1}z" for x0, x1 in zip(starts, stops))
+    side = size * box_size
+    return (
+        f'<svg xmlns="http://www.w3.org/2000/svg" width="{side}" height="{side}" '
+        f'viewBox="0 0 {size} {size}" shape-rendering="crispEdges">'
+        f'<rect width="{size}" height="{size}" fill="#fff"/>'
+        f'<path d="{"".join(path)}" fill="#000"/></svg>'
+    ).encode()
+
+# Total size of PNG bytes kept by the generated QR code cache
+QR_CACHE_BYTES = int(os.environ.get("QRPAY_QR_CACHE_BYTES", str(32 * 1024 * 1024)))
+
+class QRImageCache:
+    # Process-wide LRU of encoded QR PNGs, bounded by their total size.
+    # Shared by every Streamlit session, so all access goes through the lock.
+    def __init__(self, max_bytes=QR_CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            png = self.entries.get(key)
+            if png is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return png
+
+    def put(self, key, png):
+        with self.lock:
+            if key in self.entries or len(png) > self.max_bytes:
+                return
+            self.entries[key] = png
+            self.size += len(png)
+            while self.size > self.max_bytes:
+                _, evicted = self.entries.popitem(last=False)
+                self.size -= len(evicted)
+                self.evictions += 1
+
+    def stats(self):
+        with self.lock:
+            return {
+                "entries": len(self.entries),
+                "bytes": self.size,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_ratio": round(self.hits / (self.hits + self.misses), 4) if self.hits + self.misses else None,
+            }
+
+qr_png_cache = QRImageCache()
+
+def generate_qr_png(data, box_size=10, error_correction=None):
+    # PNG bytes of the QR code for data. Payloads that serialise to the same
+    # canonical JSON share a cache entry, and a hit skips both building the
+    # QR matrix and PNG encoding.
+    key = (json.dumps(data, sort_keys=True, separators=(",", ":")), box_size, error_correction)
+    png = qr_png_cache.get(key)
+    if png is None:
+        buf = io.BytesIO()
+        generate_qr_code(data, box_size, error_correction).save(buf, format="PNG")
+        png = buf.getvalue()
+        qr_png_cache.put(key, png)
+    return png
+
+def qr_cache_stats():
+    # Hit/miss/eviction counters of the generated QR code cache
+    return qr_png_cache.stats()
+
+# Function to detect QR codes
+def detect_qr_code(frame, scale=None):
+    # This thread's detector from the shared pool
+    qr_detector = get_qr_detector()
+    
+    # Create a copy of the frame for display
+    display_frame = frame.copy()
+    qr_value = None
+    
+    # Locate codes on a downscaled grayscale copy first, doubling the scale until
+    # one decodes, and only decode the matching full-resolution crops
+    level = pyramid_scale(frame.shape, scale=scale)
+    while level < 1.0 and qr_value is None:
+        for quad in pyramid_locate(qr_detector, frame, level, multi=True):
+            data, bbox, _ = decode_at(qr_detector, frame, quad)
+            if bbox is not None and data:
+                qr_value = data
+                bbox = bbox.astype(int)
+                display_frame = cv2.polylines(display_frame, [bbox], True, (0, 255, 0), 8)
+                display_frame = cv2.putText(display_frame, "QR Code Detected", bbox[0][0], 
+                                  cv2.FONT_HERSHEY_SIMPLEX, 0.8, (0, 0, 255), 2)
+                break
+        level *= 2
+    if qr_value is not None:
+        return display_frame, qr_value
+    
+    try:
+        # For OpenCV 4.5.4 and above, use detectAndDecodeMulti
+        ret_qr, decoded_info, points, _ = qr_detector.detectAndDecodeMulti(frame)
+        
+        # If QR codes are detected
+        if ret_qr:
+            for s, p in zip(decoded_info, points):
+                # If the QR code contains data
+                if s:
+                    qr_value = s  # Assign the QR code value to the variable
+                    color = (0, 255, 0)  # Green color for successful decode
+                    
+                    # Draw a polygon around the QR code
+                    display_frame = cv2.polylines(display_frame, [p.astype(int)], True, color, 8)
+                    
+                    # Display the decoded text on the frame
+                    display_frame = cv2.putText(display_frame, "QR Code Detected", p[0].astype(int), 
+                                      cv2.FONT_HERSHEY_SIMPLEX, 0.8, (0, 0, 255), 2)
+                    break
+    except Exception as e:
+        # For older versions of OpenCV, use detectAndDecode
+        try:
+            data, bbox, _ = qr_detector.detectAndDecode(frame)
+            
+            # If a QR code is detected and contains data
+            if bbox is not None and data:
+                qr_value = data  # Assign the QR code value to the variable
+                
+                # Draw a polygon around the QR code
+                bbox = bbox.astype(int)
+                display_frame = cv2.polylines(display_frame, [bbox], True, (0, 255, 0), 8)
+                
+                # Display the decoded text on the frame
+                display_frame = cv2.putText(display_frame, "QR Code Detected", (bbox[0][0], bbox[0][1] - 10), 
+                                  cv2.FONT_HERSHEY_SIMPLEX, 0.8, (0, 0, 255), 2)
+        except Exception as e:
+            # Just continue if there's an error
+            pass
+    
+    return display_frame, qr_value
@@ -0,0 +1,50 @@
+# Ledger reconciliation.
+#
+# Recomputes every balance, daily/monthly total and counterparty total from the
+# transaction history and reports anything the incrementally maintained
+# aggregates disagree with:
+#
+#     python -m qrpay.reconcile
+#     python -m qrpay.reconcile --ledger /srv/qrpay/ledger.db --fix
+#     python -m qrpay.reconcile --check-plans
+#
+# Exits with status 1 when discrepancies are found (after --fix, only balance
+# discrepancies remain an error). --check-plans instead checks that every
+# Transaction History filter pages along an index, without sorting.
+import argparse
+import sys
+import time
+
+from qrpay.ledger import LEDGER_PATH, Ledger
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Check ledger aggregates against the transaction history")
+    parser.add_argument("--ledger", default=LEDGER_PATH, help=f"Ledger file (default: {LEDGER_PATH})")
+    parser.add_argument("--fix", action="store_true", help="Rebuild the aggregate tables from the history")
+    parser.add_argument("--check-plans", action="store_true",
+                        help="Check the transaction history query plans instead (no temp sorts or scans)")
+    args = parser.parse_args(argv)
+
+    ledger = Ledger(args.ledger, pool_size=1)
+    if args.check_plans:
+        problems = ledger.check_query_plans()
+        ledger.close()
+        for line in problems:
+            print(line)
+        print(f"{len(problems)} query plan problems found", file=sys.stderr)
+        return 1 if problems else 0
+    started = time.perf_counter()
+    problems = ledger.reconcile(fix=args.fix)
+    elapsed = time.perf_counter() - started
+    ledger.close()
+
+    for line in problems:
+        print(line)
+    print(f"{len(problems)} discrepancies found in {elapsed:.1f}s"
+          f"{' (aggregates rebuilt)' if args.fix and problems else ''}", file=sys.stderr)
+    if args.fix:
+        return 1 if any(line.startswith("account ") for line in problems) else 0
+    return 1 if problems else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
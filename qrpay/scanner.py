@@ -0,0 +1,488 @@
+import os
+import time
+import threading
+
+import av
+import cv2
+import numpy as np
+
+try:
+    import streamlit as st
+    from streamlit_webrtc import VideoTransformerBase
+except ImportError:
+    # Headless use (benchmarks, batch tools) without the Streamlit stack
+    st = None
+    VideoTransformerBase = object
+
+from qrpay.metrics import observe, timed
+from qrpay.profiler import ProfileSession, scanner_profile
+from qrpay.qr import (
+    crop_around_bbox,
+    decode_at,
+    estimate_module_px,
+    get_decode_executor,
+    get_qr_detector,
+    pyramid_locate,
+    pyramid_scale,
+)
+
+# Smallest CPU budget accepted. Budgets divide the measured pass cost, so 0
+# is not a way to disable decoding; values at or below this are raised to it.
+MIN_CPU_BUDGET = 0.001
+
+def cpu_budget(name, default):
+    budget = float(os.environ.get(name, default))
+    if budget < MIN_CPU_BUDGET:
+        print(f"{name}={budget} is not a positive CPU share, using {MIN_CPU_BUDGET}")
+        budget = MIN_CPU_BUDGET
+    return budget
+
+# CPU share of one core each live session may spend looking for codes
+IDLE_CPU_BUDGET = cpu_budget("QRPAY_IDLE_CPU_BUDGET", "0.05")
+ACTIVE_CPU_BUDGET = cpu_budget("QRPAY_ACTIVE_CPU_BUDGET", "0.5")
+
+class DecodeScheduler:
+    # Decides when the live scanner looks at a frame and how hard. With
+    # nothing in view only a cheap detect() pass runs, spaced out to stay
+    # within the idle CPU budget. Once a candidate quad appears it switches to
+    # full detectAndDecode, with a budget that grows with the detection
+    # confidence and decays again on every miss.
+    DETECT = "detect"
+    DECODE = "decode"
+
+    def __init__(self, idle_cpu_budget=IDLE_CPU_BUDGET, active_cpu_budget=ACTIVE_CPU_BUDGET):
+        self.idle_cpu_budget = max(idle_cpu_budget, MIN_CPU_BUDGET)
+        self.active_cpu_budget = max(active_cpu_budget, MIN_CPU_BUDGET)
+        self.confidence = 0.0       # 0..1, how sure we are a code is in view
+        self.last_start = 0.0       # perf_counter() of the last scheduled pass
+        # Moving average of seconds spent per pass, seeded with typical 720p costs
+        self.pass_cost = {self.DETECT: 0.01, self.DECODE: 0.03}
+
+    def mode(self):
+        # Any recent candidate quad is enough to start decoding
+        return self.DECODE if self.confidence >= 0.25 else self.DETECT
+
+    def next_pass(self, now):
+        # Return the pass to run on this frame, or None to let it through untouched
+        mode = self.mode()
+        budget = self.idle_cpu_budget + (self.active_cpu_budget - self.idle_cpu_budget) * self.confidence
+        if now - self.last_start < self.pass_cost[mode] / budget:
+            return None
+        self.last_start = now
+        return mode
+
+    def record(self, mode, elapsed, found, decoded):
+        # Feed back the measured cost and outcome of a finished pass
+        self.pass_cost[mode] = 0.8 * self.pass_cost[mode] + 0.2 * elapsed
+        if decoded:
+            self.confidence = 1.0
+        elif found:
+            self.confidence = max(self.confidence, 0.5)
+        else:
+            self.confidence *= 0.5
+            if self.confidence < 0.05:
+                self.confidence = 0.0
+
+# Draw FPS and decode time on the outgoing frames by default
+DEBUG_OVERLAY = os.environ.get("QRPAY_DEBUG_OVERLAY", "0").lower() in ("1", "true", "yes", "on")
+
+# How many failed crop decodes in a row count as losing the tracked code
+TRACK_MAX_MISSES = 2
+
+# Pixel formats whose first plane is the 8-bit luma (Y) channel
+LUMA_FORMATS = {"yuv420p", "yuvj420p", "yuv422p", "yuvj422p", "yuv444p", "yuvj444p", "nv12", "nv21", "gray"}
+
+def luma_plane(frame):
+    # Return the frame's luma as a 2-D uint8 array. For YUV frames this is a
+    # view on the first plane, so no colour conversion or copy is made
+    if frame.format.name in LUMA_FORMATS:
+        plane = frame.planes[0]
+        luma = np.frombuffer(plane, np.uint8).reshape(plane.height, plane.line_size)
+        return luma[:, :frame.width]
+    return frame.to_ndarray(format="gray")
+
+class QRCodeScanner(VideoTransformerBase):
+    def __init__(self, session_sync=st is not None, multi_code=False, debug_overlay=DEBUG_OVERLAY):
+        # Reset all internal state variables
+        self.session_sync = session_sync  # Mirror scan progress into st.session_state
+        self.multi_code = multi_code  # Decode every code in view and let the user pick one
+        self.debug_overlay = debug_overlay  # Draw FPS and decode time on every frame
+        self.qr_code = None
+        self.qr_codes = []          # Confirmed codes, ordered left to right
+        self.code_counts = {}       # Consecutive detections per code in multi-code mode
+        self.detection_counter = 0  # Counter for consecutive detections
+        self.last_data = None       # Store last detected data for consistency check
+        self.detection_threshold = 2 # Number of consecutive detections required
+        self.qr_detected = False    # Flag to track if QR has been detected and processed
+        self.frame_count = 0        # Counter for frame processing optimization
+        self.scheduler = DecodeScheduler()  # Sets the decode rate from cost and confidence
+        self.track_bbox = None      # Last known code position, used to crop later frames
+        self.track_misses = 0       # Consecutive failed decodes inside the tracked region
+        self.module_px = None       # Module size of the last decoded code, sets the pyramid scale
+        self.pyramid_level = 0      # Doublings above the base pyramid scale for the next locate
+        
+        # Decode stage: at most one decode in flight per session, plus a single
+        # pending slot where the newest frame replaces any older waiting frame
+        self.decode_executor = get_decode_executor()
+        self.decode_lock = threading.Lock()
+        self.decode_busy = False    # True while a decode task is running for this session
+        self.pending_frame = None   # Latest frame waiting for the decode stage
+        self.overlay_bboxes = []    # Bounding boxes from the most recent finished decode
+        self.overlay_labels = []    # Numbers drawn next to each box in multi-code mode
+        self.overlay_key = None     # What the cached overlay buffers currently show
+        self.overlay_layer = None   # Reused BGR buffer holding the rendered overlay
+        self.overlay_mask = None    # Reused mask of the overlay pixels within overlay_rect
+        self.overlay_rect = None    # (x0, y0, x1, y1) region the overlay covers
+        self.frames_decoded = 0     # Frames that went through the detector
+        self.frames_dropped = 0     # Frames replaced in the pending slot before decoding
+        self.frames_skipped = 0     # Frames the scheduler let through without a pass
+        self.stopped = False        # Set when the WebRTC track ends
+        self.first_frame_at = None  # perf_counter() of the first frame, for scan_to_confirm
+        self.last_frame_at = None   # perf_counter() of the previous frame, for the FPS estimate
+        self.fps = 0.0              # Moving average of the incoming frame rate
+        self.decode_ms = 0.0        # Duration of the most recent detect or decode pass
+        self.profile = scanner_profile()  # Active ProfileSession, None when not profiling
+        
+        # Check session state and reset QR detection flags if needed
+        if self.session_sync and hasattr(st, 'session_state'):
+            # Initialize auto_stop_camera flag if it doesn't exist
+            if 'auto_stop_camera' not in st.session_state:
+                st.session_state.auto_stop_camera = False
+                
+            # Reset QR detection flags in session state if they were set from a previous scan
+            if hasattr(st.session_state, 'scan_state') and st.session_state.scan_state == "detected":
+                print("QRCodeScanner initialized with previous detection state, resetting...")
+                st.session_state.scan_state = "idle"
+                st.session_state.qr_detection_complete = False
+
+    @property
+    def qr_detector(self):
+        # Detector of the decode thread running the current pass, shared with
+        # every other session and upload that thread serves
+        return get_qr_detector()
+
+    def recv(self, frame):
+        # Time every frame and keep the FPS estimate for the debug overlay
+        if self.profile is not None and not self.profile.on_frame(frame):
+            self.profile = None
+        started = time.perf_counter()
+        if self.first_frame_at is None:
+            self.first_frame_at = started
+        if self.last_frame_at is not None and started > self.last_frame_at:
+            self.fps = 0.9 * self.fps + 0.1 / (started - self.last_frame_at)
+        self.last_frame_at = started
+        new_frame = self.process_frame(frame)
+        if self.debug_overlay:
+            new_frame = self.draw_debug(new_frame)
+        observe("frame_receive", time.perf_counter() - started)
+        return new_frame
+
+    def process_frame(self, frame):
+        # If QR already detected and processed, just return the frame with success indicator
+        # and don't attempt to detect QR codes anymore
+        if self.qr_detected or (self.session_sync and (
+                               (hasattr(st.session_state, 'scan_state') and 
+                                (st.session_state.scan_state == "detected" or 
+                                 st.session_state.stop_webrtc == True)) or 
+                               (hasattr(st.session_state, 'qr_processed') and 
+                                st.session_state.qr_processed))):
+            # Draw a success indicator on the frame
+            return self.draw_overlay(frame, [], "QR Code Detected! Processing payment...", 0.7)
+        
+        # Let the scheduler decide whether this frame gets a detect or decode pass
+        self.frame_count += 1
+        mode = self.scheduler.next_pass(time.perf_counter())
+        if mode is None:
+            self.frames_skipped += 1
+        else:
+            # The detector only needs luma, so decode straight from the Y plane;
+            # the worker only reads it and the frame is never written to
+            with timed("color_conversion"):
+                luma = luma_plane(frame)
+            self.submit_decode(luma, mode)
+        
+        # Nothing to draw: pass the frame through without an ndarray round-trip
+        bboxes, labels = self.overlay_bboxes, self.overlay_labels
+        if not bboxes:
+            return frame
+        
+        # Draw the overlay from the most recent finished decode
+        text = "QR Detected" if len(bboxes) == 1 else f"{len(bboxes)} QR Codes Detected"
+        return self.draw_overlay(frame, bboxes, text, 0.8, labels)
+
+    def draw_overlay(self, frame, bboxes, text, font_scale, labels=()):
+        # Render the overlay into reused buffers only when it changes, then
+        # paste just the covered region onto the outgoing frame
+        key = (frame.width, frame.height, text, tuple(b.tobytes() for b in bboxes), tuple(labels))
+        if key != self.overlay_key:
+            shape = (frame.height, frame.width)
+            if self.overlay_layer is None or self.overlay_layer.shape[:2] != shape:
+                self.overlay_layer = np.zeros(shape + (3,), np.uint8)
+            self.overlay_layer.fill(0)
+            mask = np.zeros(shape, np.uint8)
+            for target, color in ((self.overlay_layer, (0, 255, 0)), (mask, 255)):
+                if bboxes:
+                    cv2.polylines(target, bboxes, True, color, 2)
+                for bbox, label in zip(bboxes, labels):
+                    x, y = bbox.reshape(-1, 2).min(axis=0)
+                    cv2.putText(target, label, (int(x), max(int(y) - 8, 20)),
+                                cv2.FONT_HERSHEY_SIMPLEX, 1.0, color, 2)
+                cv2.putText(target, text, (10, 30), cv2.FONT_HERSHEY_SIMPLEX, font_scale, color, 2)
+            x, y, w, h = cv2.boundingRect(mask)
+            self.overlay_rect = (x, y, x + w, y + h)
+            self.overlay_mask = mask[y:y + h, x:x + w, None].astype(bool)
+            self.overlay_key = key
+        
+        x0, y0, x1, y1 = self.overlay_rect
+        img = frame.to_ndarray(format="bgr24")
+        np.copyto(img[y0:y1, x0:x1], self.overlay_layer[y0:y1, x0:x1], where=self.overlay_mask)
+        new_frame = av.VideoFrame.from_ndarray(img, format="bgr24")
+        new_frame.pts = frame.pts
+        if frame.time_base is not None:
+            new_frame.time_base = frame.time_base
+        return new_frame
+
+    def start_profile(self, frames=0, seconds=0.0, record=False):
+        # Profile this session from its next frame, e.g. when a kiosk is slow
+        self.profile = ProfileSession("scanner", frames, seconds, record)
+
+    def draw_debug(self, frame):
+        # FPS and last decode time in the bottom-left corner; only used when
+        # debugging, so it pays for a full ndarray round-trip on every frame
+        img = frame.to_ndarray(format="bgr24")
+        text = f"{self.fps:.1f} FPS  decode {self.decode_ms:.1f} ms"
+        (w, h), baseline = cv2.getTextSize(text, cv2.FONT_HERSHEY_SIMPLEX, 0.6, 1)
+        y = img.shape[0] - 12
+        cv2.rectangle(img, (4, y - h - 6), (16 + w, y + baseline + 2), (0, 0, 0), cv2.FILLED)
+        cv2.putText(img, text, (10, y), cv2.FONT_HERSHEY_SIMPLEX, 0.6, (255, 255, 255), 1)
+        new_frame = av.VideoFrame.from_ndarray(img, format="bgr24")
+        new_frame.pts = frame.pts
+        if frame.time_base is not None:
+            new_frame.time_base = frame.time_base
+        return new_frame
+
+    def submit_decode(self, img, mode):
+        # Queue a frame for decoding without ever blocking the frame thread
+        with self.decode_lock:
+            if self.stopped:
+                return
+            if self.decode_busy:
+                # Latest frame wins: replace whatever was waiting
+                if self.pending_frame is not None:
+                    self.frames_dropped += 1
+                self.pending_frame = (img, mode)
+                return
+            self.decode_busy = True
+        self.decode_executor.submit(self.decode_worker, (img, mode))
+
+    def decode_worker(self, job):
+        # Runs on the shared pool; keeps draining the pending slot so a session
+        # never has more than one task in the executor queue
+        try:
+            while job is not None:
+                img, mode = job
+                try:
+                    started = time.perf_counter()
+                    if mode == DecodeScheduler.DETECT:
+                        # Cheap pass: only look for a candidate quad
+                        quads = self.locate(img)
+                        elapsed = time.perf_counter() - started
+                        found = bool(quads)
+                        points = quads[0] if found else None
+                        observe("detect", elapsed)
+                        if found:
+                            # Seed tracking so the first decode pass already uses a crop
+                            self.track_bbox = points
+                            self.track_misses = 0
+                        self.handle_detect_result(points)
+                        self.scheduler.record(mode, elapsed, found, False)
+                    elif self.multi_code:
+                        codes, quads = self.multi_decode(img)
+                        elapsed = time.perf_counter() - started
+                        observe("decode", elapsed)
+                        with timed("consistency_check"):
+                            self.handle_multi_result(codes, quads)
+                        self.scheduler.record(mode, elapsed, bool(quads), bool(codes))
+                    else:
+                        data, bbox = self.tracked_decode(img)
+                        elapsed = time.perf_counter() - started
+                        observe("decode", elapsed)
+                        with timed("consistency_check"):
+                            self.handle_decode_result(data, bbox)
+                        self.scheduler.record(mode, elapsed, bbox is not None, bool(data))
+                    self.decode_ms = elapsed * 1000
+                except Exception as e:
+                    print(f"QR decode error: {str(e)}")
+                with self.decode_lock:
+                    self.frames_decoded += 1
+                    job, self.pending_frame = self.pending_frame, None
+                    if self.stopped or self.qr_detected:
+                        job = None
+        finally:
+            with self.decode_lock:
+                self.decode_busy = False
+                self.pending_frame = None
+
+    def tracked_decode(self, img):
+        # Decode inside the padded region around the last known position and only
+        # go back to the full frame once the code has been lost for a few passes
+        if self.track_bbox is not None:
+            roi, offset = crop_around_bbox(img, self.track_bbox)
+            if roi is not None:
+                data, bbox, straight_qrcode = self.qr_detector.detectAndDecode(roi)
+                if bbox is not None:
+                    bbox = bbox + offset
+                if bbox is not None and data:
+                    self.track_bbox = bbox
+                    self.track_misses = 0
+                    self.module_px = estimate_module_px(bbox, straight_qrcode) or self.module_px
+                    return data, bbox
+                self.track_misses += 1
+                if self.track_misses < TRACK_MAX_MISSES:
+                    return data, bbox
+            # Tracking lost, fall back to full-frame detection
+            self.track_bbox = None
+            self.track_misses = 0
+        
+        # Locate on a downscaled copy and decode only the full-resolution crop
+        quads = self.locate(img)
+        if not quads:
+            return None, None
+        data, bbox, straight_qrcode = decode_at(self.qr_detector, img, quads[0])
+        if bbox is not None and data:
+            self.track_bbox = bbox
+            self.module_px = estimate_module_px(bbox, straight_qrcode) or self.module_px
+        return data, bbox
+
+    def multi_decode(self, img):
+        # Decode every code in the frame in a single detector pass. Returns the
+        # decoded (data, bbox) pairs and the quads of all codes found.
+        found, decoded_info, points, _ = self.qr_detector.detectAndDecodeMulti(img)
+        if not found or points is None:
+            return [], []
+        quads = [quad.reshape(1, 4, 2) for quad in points.reshape(-1, 4, 2)]
+        codes = [(data, quad) for data, quad in zip(decoded_info, quads) if data]
+        return codes, quads
+
+    def locate(self, img):
+        # Look for a code at the current pyramid level; after a miss the next
+        # pass tries twice the resolution, wrapping back once full size misses too
+        scale = min(1.0, pyramid_scale(img.shape, self.module_px) * 2 ** self.pyramid_level)
+        quads = pyramid_locate(self.qr_detector, img, scale, multi=self.multi_code)
+        if quads or scale >= 1.0:
+            self.pyramid_level = 0
+        else:
+            self.pyramid_level += 1
+        return quads
+
+    def handle_detect_result(self, bbox):
+        # A detect-only pass can show where a code is but cannot confirm it
+        if bbox is not None:
+            self.overlay_bboxes = [bbox.astype(int)]
+        else:
+            self.detection_counter = 0
+            self.code_counts = {}
+            self.overlay_bboxes = []
+        self.overlay_labels = []
+
+    def handle_multi_result(self, codes, quads):
+        # Each code keeps its own consecutive-detection count; a code missing
+        # from this pass starts again from zero
+        positions = {}
+        for data, bbox in codes:
+            positions[data] = bbox
+        self.code_counts = {data: self.code_counts.get(data, 0) + 1 for data in positions}
+        
+        # Number the codes left to right so the overlay matches the pick list
+        ordered = sorted(positions, key=lambda data: tuple(positions[data].reshape(-1, 2).min(axis=0)))
+        undecoded = [quad for quad in quads if not any(quad is bbox for _, bbox in codes)]
+        self.overlay_bboxes = [positions[data].astype(int) for data in ordered] + [q.astype(int) for q in undecoded]
+        self.overlay_labels = [str(i + 1) for i in range(len(ordered))]
+        
+        # Confirm once every code in view has been read consistently
+        if ordered and all(count >= self.detection_threshold for count in self.code_counts.values()):
+            self.confirm_codes(ordered)
+
+    def handle_decode_result(self, data, bbox):
+        # If QR code is detected
+        if bbox is not None and data:
+            # Verify detection consistency to avoid false positives
+            if data == self.last_data:
+                self.detection_counter += 1
+            else:
+                self.detection_counter = 1
+                self.last_data = data
+            
+            # Publish the bounding box for recv to draw
+            self.overlay_bboxes = [bbox.astype(int)]
+            self.overlay_labels = []
+            
+            # Only confirm detection after consistent readings to avoid false positives
+            if self.detection_counter >= self.detection_threshold:
+                self.confirm_codes([data])
+        else:
+            # Reset detection counter if no QR code found
+            self.detection_counter = 0
+            self.overlay_bboxes = []
+
+    def confirm_codes(self, codes):
+        if self.first_frame_at is not None:
+            observe("scan_to_confirm", time.perf_counter() - self.first_frame_at)
+        self.qr_codes = codes
+        if len(codes) == 1:
+            data = codes[0]
+            self.qr_code = data  # Set the result property that's checked in main code
+            print(f"Confirmed QR code detection: {data[:50]}...")
+        else:
+            print(f"Confirmed {len(codes)} QR codes in view")
+        
+        # Set the flag to stop further processing
+        self.qr_detected = True
+        
+        # Update session state - only if we haven't already detected a QR code
+        # Use a try-except block to handle potential ScriptRunContext errors
+        try:
+            if self.session_sync and len(codes) > 1:
+                # Several codes: stop the camera and let the user pick one to pay
+                st.session_state.camera_active = False
+                st.session_state.qr_candidates = codes
+                st.session_state.stop_webrtc = True
+                st.session_state.auto_stop_camera = True
+                st.rerun()
+            elif self.session_sync and not st.session_state.qr_detection_complete and not st.session_state.qr_processed:
+                data = codes[0]
+                # Set all the necessary flags to stop the camera and process the QR code
+                st.session_state.camera_active = False
+                st.session_state.scan_state = "detected"
+                st.session_state.qr_detection_complete = True
+                
+                # Store QR data in session state to ensure it's available after rerun
+                st.session_state.qr_result = data
+                
+                # Set flag to stop the WebRTC context on next rerun
+                st.session_state.stop_webrtc = True
+                # Set flag to indicate QR code has been processed
+                st.session_state.qr_processed = True
+                # Set flag to indicate that the stop buttons should be automatically clicked
+                st.session_state.auto_stop_camera = True
+                print("Set flag to stop WebRTC context and auto-click stop buttons on next rerun")
+                
+                # Trigger a rerun to update UI and stop camera - ONLY ONCE
+                print("QR detection complete, triggering rerun to update UI and stop camera")
+                st.rerun()
+        except Exception as e:
+            # This will catch the ScriptRunContext missing error in async threads
+            print(f"Async thread error (can be ignored): {str(e)}")
+            # Just set the flags but don't try to rerun
+            self.qr_detected = True
+
+    def on_ended(self):
+        # Drop any queued frame once the camera stops
+        with self.decode_lock:
+            self.stopped = True
+            self.pending_frame = None
+        # Write out a profile cut short by the camera stopping
+        if self.profile is not None:
+            if self.profile.started is not None:
+                self.profile.finish()
+            self.profile = None
@@ -0,0 +1,337 @@
+# Headless payment and scanning API.
+#
+# An asyncio HTTP/1.1 server in front of LocalService, so QR generation, image
+# decoding and payments can be scaled and load-tested apart from the Streamlit
+# UI (point the app at it with QRPAY_API_URL):
+#
+#     QRPAY_API_TOKEN=... python -m qrpay.server --host 0.0.0.0 --port 8600 --workers 4
+#
+# When QRPAY_API_TOKEN is set, every request but GET /health must carry it as
+# "Authorization: Bearer <token>"; listening beyond loopback requires it.
+#
+#     POST /generate                  {"data": {...}, "box_size": 10, "format": "png"|"svg"} -> image
+#     POST /decode-image              raw image bytes -> {"qr_data": ..., "stage": ..., "image": {...},
+#                                      "payment": ...}
+#     POST /parse                     {"qr_data": "..."} -> {"payment": ...}
+#     POST /pay                       {"payer_cnic", "amount", "recipient", "recipient_cnic",
+#                                      "qr_data", "scan_session"} -> {"transaction": {...}}
+#     POST /accounts                  {"cnic", "name", "initial_balance"} -> account
+#     GET  /accounts/<cnic>           -> {"cnic", "balance"}
+#     GET  /accounts/<cnic>/summary
+#     GET  /accounts/<cnic>/transactions?limit=&before_id=&since=&until=&counterparty=
+#     GET  /accounts/<cnic>/totals?kind=day|month&limit=
+#     GET  /accounts/<cnic>/counterparties?limit=
+#     GET  /stats                     -> {"caches": {"uploads": {...}, "payloads": {...}, "qr_images": {...}}}
+#     GET  /metrics                   stage latency histograms and cache counters, Prometheus text format
+#     GET  /health
+#
+# Image work runs on a process pool, ledger calls on the default thread pool,
+# so the event loop only parses requests and writes responses. The image
+# workers are started and their QR detectors warmed before the port opens.
+import argparse
+import asyncio
+import hmac
+import json
+import math
+import os
+import re
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from http import HTTPStatus
+from urllib.parse import parse_qs, unquote, urlsplit
+
+from qrpay.ledger import AccountNameMismatch, IdempotencyConflict, InsufficientFunds, UnknownAccount
+from qrpay.cache import MISS, get_upload_cache
+from qrpay.metrics import cache_counters, render_prometheus, timed
+from qrpay.payments import validate_cnic
+from qrpay.service import (
+    API_TOKEN,
+    LocalService,
+    cache_stats,
+    load_and_decode,
+    render_qr,
+    upload_cache_key,
+    warm_up_decoder,
+)
+
+# Largest request body accepted (uploaded photos are the big ones)
+MAX_BODY_BYTES = int(os.environ.get("QRPAY_API_MAX_BODY", str(20 * 1024 * 1024)))
+
+# Most rows one list request returns (the app pages by at most 100)
+MAX_PAGE_SIZE = 100
+
+class ApiError(Exception):
+    def __init__(self, status, message, **extra):
+        super().__init__(message)
+        self.status = status
+        self.body = dict(error=message, **extra)
+
+def json_body(body):
+    try:
+        payload = json.loads(body or b"{}")
+    except ValueError:
+        raise ApiError(HTTPStatus.BAD_REQUEST, "request body is not valid JSON")
+    if not isinstance(payload, dict):
+        raise ApiError(HTTPStatus.BAD_REQUEST, "request body must be a JSON object")
+    return payload
+
+def require(payload, *names):
+    missing = [name for name in names if payload.get(name) in (None, "")]
+    if missing:
+        raise ApiError(HTTPStatus.BAD_REQUEST, f"missing fields: {', '.join(missing)}")
+    return [payload[name] for name in names]
+
+def int_param(query, name, default, maximum=None):
+    # Query string integer; with a maximum, clamped to 1..maximum
+    try:
+        value = int(query.get(name, default))
+    except ValueError:
+        raise ApiError(HTTPStatus.BAD_REQUEST, f"{name} must be an integer")
+    return value if maximum is None else min(max(value, 1), maximum)
+
+def number_field(payload, name, default, kind=float):
+    # JSON number only: strings, lists, booleans (true would be 1) and the
+    # infinities json.loads makes of 1e400 are rejected
+    value = payload.get(name, default)
+    if isinstance(value, bool) or not isinstance(value, (int, float)) or not math.isfinite(value):
+        raise ApiError(HTTPStatus.BAD_REQUEST, f"{name} must be a number")
+    if kind is int and value != int(value):
+        raise ApiError(HTTPStatus.BAD_REQUEST, f"{name} must be an integer")
+    return kind(value)
+
+# Reachable without the API token (load balancer health checks)
+PUBLIC_PATHS = ("/health",)
+
+class PaymentApi:
+    def __init__(self, service, workers=None, token=API_TOKEN):
+        self.service = service
+        self.token = token
+        # Each image worker builds and warms its QR detector as it starts
+        self.pool = ProcessPoolExecutor(max_workers=workers, initializer=warm_up_decoder)
+        self.routes = [
+            ("GET", re.compile(r"^/health$"), self.health),
+            ("GET", re.compile(r"^/stats$"), self.stats),
+            ("GET", re.compile(r"^/metrics$"), self.metrics),
+            ("POST", re.compile(r"^/generate$"), self.generate),
+            ("POST", re.compile(r"^/decode-image$"), self.decode_image),
+            ("POST", re.compile(r"^/parse$"), self.parse),
+            ("POST", re.compile(r"^/pay$"), self.pay),
+            ("POST", re.compile(r"^/accounts$"), self.open_account),
+            ("GET", re.compile(r"^/accounts/(?P<cnic>[^/]+)$"), self.balance),
+            ("GET", re.compile(r"^/accounts/(?P<cnic>[^/]+)/summary$"), self.summary),
+            ("GET", re.compile(r"^/accounts/(?P<cnic>[^/]+)/transactions$"), self.transactions),
+            ("GET", re.compile(r"^/accounts/(?P<cnic>[^/]+)/totals$"), self.totals),
+            ("GET", re.compile(r"^/accounts/(?P<cnic>[^/]+)/counterparties$"), self.counterparties),
+        ]
+
+    async def in_process_pool(self, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(self.pool, partial(func, *args))
+
+    async def in_thread(self, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(None, partial(func, *args))
+
+    async def health(self, body, query):
+        return {"status": "ok"}
+
+    async def stats(self, body, query):
+        return {"caches": cache_stats()}
+
+    async def metrics(self, body, query):
+        return "text/plain; version=0.0.4", render_prometheus(cache_counters(cache_stats())).encode()
+
+    async def generate(self, body, query):
+        payload = json_body(body)
+        (data,) = require(payload, "data")
+        fmt = payload.get("format", "png")
+        if fmt not in ("png", "svg"):
+            raise ApiError(HTTPStatus.BAD_REQUEST, "format must be png or svg")
+        image = await self.in_process_pool(render_qr, data, number_field(payload, "box_size", 10, int), fmt)
+        return "image/svg+xml" if fmt == "svg" else "image/png", image
+
+    async def decode_image(self, body, query):
+        if not body:
+            raise ApiError(HTTPStatus.BAD_REQUEST, "empty image")
+        # The cache lives in this process, so repeats never reach the image workers
+        cache = get_upload_cache()
+        key = await self.in_thread(upload_cache_key, body)
+        result = await self.in_thread(cache.get, key)
+        if result is MISS:
+            try:
+                with timed("upload_decode"):
+                    result = await self.in_process_pool(load_and_decode, body)
+            except ValueError as e:
+                raise ApiError(HTTPStatus.UNPROCESSABLE_ENTITY, str(e))
+            await self.in_thread(cache.put, key, result)
+        qr_data = result["qr_data"]
+        return dict(result, payment=self.service.parse(qr_data) if qr_data else None)
+
+    async def parse(self, body, query):
+        (qr_data,) = require(json_body(body), "qr_data")
+        return {"payment": self.service.parse(qr_data)}
+
+    async def pay(self, body, query):
+        payload = json_body(body)
+        args = require(payload, "payer_cnic", "amount", "recipient", "recipient_cnic", "qr_data", "scan_session")
+        args[1] = number_field(payload, "amount", None)
+        try:
+            transaction = await self.in_thread(self.service.pay, *args)
+        except InsufficientFunds as e:
+            raise ApiError(HTTPStatus.PAYMENT_REQUIRED, "insufficient funds", balance=e.args[0])
+        except IdempotencyConflict as e:
+            raise ApiError(HTTPStatus.CONFLICT, str(e))
+        except ValueError as e:
+            raise ApiError(HTTPStatus.BAD_REQUEST, str(e))
+        return {"transaction": transaction}
+
+    async def open_account(self, body, query):
+        payload = json_body(body)
+        cnic, name = require(payload, "cnic", "name")
+        if not isinstance(cnic, str) or not validate_cnic(cnic):
+            raise ApiError(HTTPStatus.BAD_REQUEST, "cnic must be in the format 00000-0000000-0")
+        if not isinstance(name, str) or not name.strip():
+            raise ApiError(HTTPStatus.BAD_REQUEST, "name must be a non-empty string")
+        initial_balance = number_field(payload, "initial_balance", 0)
+        if initial_balance < 0:
+            raise ApiError(HTTPStatus.BAD_REQUEST, "initial_balance must not be negative")
+        try:
+            return await self.in_thread(self.service.open_account, cnic, name, initial_balance)
+        except AccountNameMismatch:
+            raise ApiError(HTTPStatus.FORBIDDEN, "name does not match the account for this CNIC")
+
+    async def balance(self, body, query, cnic):
+        return {"cnic": cnic, "balance": await self.in_thread(self.service.balance, cnic)}
+
+    async def summary(self, body, query, cnic):
+        return await self.in_thread(self.service.summary, cnic)
+
+    async def transactions(self, body, query, cnic):
+        return {"transactions": await self.in_thread(
+            self.service.list_transactions, cnic, int_param(query, "limit", 20, MAX_PAGE_SIZE),
+            int_param(query, "before_id", 0) or None, query.get("since"), query.get("until"),
+            query.get("counterparty"),
+        )}
+
+    async def totals(self, body, query, cnic):
+        return {"totals": await self.in_thread(
+            self.service.period_totals, cnic, query.get("kind", "day"), int_param(query, "limit", 30, MAX_PAGE_SIZE)
+        )}
+
+    async def counterparties(self, body, query, cnic):
+        return {"counterparties": await self.in_thread(
+            self.service.top_counterparties, cnic, int_param(query, "limit", 5, MAX_PAGE_SIZE)
+        )}
+
+    def authorized(self, path, headers):
+        if not self.token or path in PUBLIC_PATHS:
+            return True
+        scheme, _, token = headers.get("authorization", "").partition(" ")
+        return scheme.lower() == "bearer" and hmac.compare_digest(token.strip().encode(), self.token.encode())
+
+    async def dispatch(self, method, target, body, headers=None):
+        # Returns (status, content type, body bytes)
+        url = urlsplit(target)
+        query = {key: values[-1] for key, values in parse_qs(url.query).items()}
+        try:
+            if not self.authorized(url.path, headers or {}):
+                raise ApiError(HTTPStatus.UNAUTHORIZED, "missing or wrong API token")
+            allowed = False
+            for route_method, pattern, handler in self.routes:
+                match = pattern.match(url.path)
+                if not match:
+                    continue
+                allowed = True
+                if route_method != method:
+                    continue
+                params = {key: unquote(value) for key, value in match.groupdict().items()}
+                result = await handler(body, query, **params)
+                if isinstance(result, tuple):
+                    return HTTPStatus.OK, result[0], result[1]
+                return HTTPStatus.OK, "application/json", json.dumps(result).encode()
+            status = HTTPStatus.METHOD_NOT_ALLOWED if allowed else HTTPStatus.NOT_FOUND
+            raise ApiError(status, status.phrase)
+        except ApiError as e:
+            return e.status, "application/json", json.dumps(e.body).encode()
+        except UnknownAccount as e:
+            return HTTPStatus.NOT_FOUND, "application/json", json.dumps({"error": f"unknown account {e}"}).encode()
+        except Exception as e:
+            print(f"API error on {method} {target}: {str(e)}")
+            return HTTPStatus.INTERNAL_SERVER_ERROR, "application/json", json.dumps({"error": str(e)}).encode()
+
+    async def handle_connection(self, reader, writer):
+        # Minimal HTTP/1.1 with keep-alive; bodies must carry Content-Length
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line.strip():
+                    break
+                try:
+                    method, target, version = request_line.decode("latin-1").split()
+                except ValueError:
+                    break
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b"\r\n", b"\n", b""):
+                        break
+                    name, _, value = line.decode("latin-1").partition(":")
+                    headers[name.strip().lower()] = value.strip()
+                try:
+                    length = int(headers.get("content-length") or 0)
+                except ValueError:
+                    length = -1
+                if length < 0:
+                    status, content_type, payload = (HTTPStatus.BAD_REQUEST, "application/json",
+                                                     json.dumps({"error": "invalid Content-Length"}).encode())
+                    keep_alive = False
+                elif length > MAX_BODY_BYTES:
+                    status, content_type, payload = (HTTPStatus.REQUEST_ENTITY_TOO_LARGE, "application/json",
+                                                     json.dumps({"error": "request body too large"}).encode())
+                    keep_alive = False
+                else:
+                    body = await reader.readexactly(length) if length else b""
+                    status, content_type, payload = await self.dispatch(method, target, body, headers)
+                    keep_alive = version == "HTTP/1.1" and headers.get("connection", "").lower() != "close"
+                writer.write(
+                    f"HTTP/1.1 {status.value} {status.phrase}\r\n"
+                    f"Content-Type: {content_type}\r\n"
+                    f"Content-Length: {len(payload)}\r\n"
+                    f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n".encode("latin-1") + payload
+                )
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+async def serve(host, port, workers):
+    api = PaymentApi(LocalService(), workers)
+    # Start the image workers before accepting requests, so the first uploads
+    # do not wait for process start-up and detector warm-up
+    await api.in_process_pool(warm_up_decoder)
+    server = await asyncio.start_server(api.handle_connection, host, port)
+    print(f"QR payment API listening on http://{host}:{port}")
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        api.pool.shutdown(cancel_futures=True)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Serve the QR payment API over HTTP")
+    parser.add_argument("--host", default="127.0.0.1", help="Interface to listen on")
+    parser.add_argument("--port", type=int, default=8600, help="Port to listen on")
+    parser.add_argument("-j", "--workers", type=int, help="Image worker processes (default: all cores)")
+    args = parser.parse_args(argv)
+    if args.host not in ("127.0.0.1", "localhost", "::1") and not API_TOKEN:
+        parser.error(f"set QRPAY_API_TOKEN before listening on {args.host}; the API can move money")
+    try:
+        asyncio.run(serve(args.host, args.port, args.workers))
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
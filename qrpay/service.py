@@ -0,0 +1,141 @@
+import os
+import sys
+import threading
+from functools import lru_cache
+
+from qrpay.cache import MISS, content_key, get_parse_cache, get_upload_cache
+from qrpay.ledger import get_ledger
+from qrpay.metrics import timed
+from qrpay.payload import parse_qr_data
+from qrpay.payments import payment_idempotency_key
+
+# Base URL of a qrpay.server instance (e.g. http://127.0.0.1:8600). When set,
+# the app sends QR generation, image decoding, payments and ledger reads
+# there instead of doing them in the Streamlit process.
+API_URL = os.environ.get("QRPAY_API_URL", "")
+
+# Shared secret of the API: qrpay.server requires it as a bearer token on
+# every request but /health, and RemoteService sends it
+API_TOKEN = os.environ.get("QRPAY_API_TOKEN", "")
+
+# OpenCV and qrcode are imported on first use, so pages that only read the
+# ledger (the login page, a remote-API client) never load them
+
+def upload_cache_key(data):
+    # Content hash of the upload plus the settings that change what decoding it gives
+    from qrpay.enhance import UPLOAD_STAGES
+    from qrpay.ingest import UPLOAD_MAX_SIDE
+    return f"{content_key(data)}:{UPLOAD_MAX_SIDE}:{','.join(UPLOAD_STAGES)}"
+
+def load_and_decode(data, executor=None):
+    # Decode an uploaded image (JPEG, PNG, ...) and return the QR text (None
+    # when no enhancement stage finds a code), the stage that read it and
+    # how the image was loaded. With an executor the costlier stages run in
+    # parallel on it.
+    from qrpay.enhance import enhanced_decode
+    from qrpay.ingest import load_upload_gray, upload_slots
+
+    with upload_slots:
+        with timed("color_conversion"):
+            img, image = load_upload_gray(data)
+        with timed("decode"):
+            qr_data, stage = enhanced_decode(img, executor=executor)
+    print(f"Upload {image['width']}x{image['height']} {image['format']} decoded at "
+          f"{image['decoded_width']}x{image['decoded_height']}, "
+          f"~{image['load_bytes_estimate'] / (1024 * 1024):.1f} MB of buffers while loading")
+    return {"qr_data": qr_data, "stage": stage, "image": image}
+
+def decode_upload(data, executor=None):
+    # load_and_decode, answered from the upload cache when the same bytes
+    # were decoded before. Images with no code are cached too; unreadable
+    # files are not.
+    cache = get_upload_cache()
+    key = upload_cache_key(data)
+    result = cache.get(key)
+    if result is MISS:
+        result = load_and_decode(data, executor)
+        cache.put(key, result)
+    return result
+
+def cache_stats():
+    # Hit ratios and sizes of the decode result caches, and of the generated
+    # QR code cache once qrpay.qr is loaded (no code was generated before)
+    caches = {"uploads": get_upload_cache().stats(), "payloads": get_parse_cache().stats()}
+    qr = sys.modules.get("qrpay.qr")
+    if qr is not None:
+        caches["qr_images"] = qr.qr_cache_stats()
+    return caches
+
+def decode_image_bytes(data, executor=None):
+    # Text of the QR code in an encoded image, or None
+    return decode_upload(data, executor)["qr_data"]
+
+def warm_up_decoder():
+    # Build and warm this thread's detector; the image worker initializer of qrpay.server
+    from qrpay.qr import warm_up_qr_detector
+    warm_up_qr_detector()
+
+def warm_up_decode_threads():
+    from qrpay.qr import warm_up_decode_executor
+    warm_up_decode_executor()
+
+def render_qr(data, box_size=10, fmt="png"):
+    from qrpay.qr import generate_qr_png, generate_qr_svg
+
+    if fmt == "svg":
+        return generate_qr_svg(data, box_size)
+    return generate_qr_png(data, box_size)
+
+class LocalService:
+    # The app's operations done in this process, against the local ledger.
+    # qrpay.server exposes exactly these over HTTP and qrpay.client.RemoteService
+    # calls them with the same signatures.
+    def __init__(self, ledger=None):
+        self.ledger = ledger or get_ledger()
+
+    def generate_qr(self, data, box_size=10, fmt="png"):
+        return render_qr(data, box_size, fmt)
+
+    def decode_image(self, data):
+        # Enhancement stages run on the shared decode threads, whose detectors are warm
+        from qrpay.qr import get_decode_executor
+        return decode_image_bytes(data, get_decode_executor())
+
+    def warm_up(self):
+        # Start the decode threads and their detectors without blocking the caller
+        threading.Thread(target=warm_up_decode_threads, name="qr-warm-up", daemon=True).start()
+
+    def parse(self, qr_data):
+        return parse_qr_data(qr_data)
+
+    def pay(self, payer_cnic, amount, recipient, recipient_cnic, qr_data, scan_session):
+        # Payments are keyed by QR payload and scan session, see payment_idempotency_key
+        idempotency_key = payment_idempotency_key(qr_data, scan_session)
+        with timed("payment_commit"):
+            return self.ledger.transfer(payer_cnic, amount, recipient, recipient_cnic, idempotency_key)
+
+    def open_account(self, cnic, name, initial_balance=0.0):
+        return self.ledger.open_account(cnic, name, initial_balance)
+
+    def balance(self, cnic):
+        return self.ledger.balance(cnic)
+
+    def summary(self, cnic):
+        return self.ledger.summary(cnic)
+
+    def list_transactions(self, cnic, limit=20, before_id=None, since=None, until=None, counterparty=None):
+        return self.ledger.list_transactions(cnic, limit, before_id, since, until, counterparty)
+
+    def period_totals(self, cnic, kind="day", limit=30):
+        return self.ledger.period_totals(cnic, kind, limit)
+
+    def top_counterparties(self, cnic, limit=5):
+        return self.ledger.top_counterparties(cnic, limit)
+
+@lru_cache(maxsize=None)
+def get_service():
+    # Remote API when QRPAY_API_URL is set, this process otherwise
+    if API_URL:
+        from qrpay.client import RemoteService
+        return RemoteService(API_URL, API_TOKEN)
+    return LocalService()
@@ -0,0 +1,123 @@
+# Streamlit startup benchmark.
+#
+# Runs qrpay_webrtc14.py headlessly with Streamlit's AppTest in a fresh
+# interpreter and reports the cold first run (logged-out page, including the
+# app's imports), the first run after logging in, and the rerun time of common
+# interactions. Also lists which heavy modules the logged-out page loaded.
+#
+#     python -m qrpay.startup_benchmark --reruns 20 --json startup.json
+#     python -m qrpay.startup_benchmark --compare startup.json
+import argparse
+import json
+import multiprocessing
+import os
+import statistics
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+APP_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "qrpay_webrtc14.py")
+
+HEAVY_MODULES = ["cv2", "av", "qrcode", "streamlit_webrtc", "aiortc", "PIL.ImageFont", "numpy"]
+
+def percentiles(values):
+    # No numpy here: the spawned interpreter must not import it before the app does.
+    # quantiles needs two values; a single run is its own p95.
+    p95 = statistics.quantiles(values, n=20, method="inclusive")[-1] if len(values) > 1 else values[0]
+    return {"p50": round(statistics.median(values), 1), "p95": round(p95, 1)}
+
+def timed(run):
+    started = time.perf_counter()
+    run()
+    return (time.perf_counter() - started) * 1000
+
+def measure(app_path, reruns):
+    # Runs in a fresh spawned interpreter, so nothing is imported yet
+    with tempfile.TemporaryDirectory() as tmp:
+        os.environ["QRPAY_LEDGER_PATH"] = os.path.join(tmp, "ledger.db")
+        before = set(sys.modules)
+        started = time.perf_counter()
+        from streamlit.testing.v1 import AppTest
+        streamlit_import_ms = (time.perf_counter() - started) * 1000
+        baseline = set(sys.modules) - before
+
+        at = AppTest.from_file(app_path, default_timeout=120)
+        result = {"streamlit_import_ms": round(streamlit_import_ms, 1)}
+        result["cold_run_ms"] = round(timed(at.run), 1)
+        loaded = set(sys.modules) - before - baseline
+        result["heavy_modules_at_login_page"] = sorted(name for name in HEAVY_MODULES if name in loaded)
+
+        # The WebRTC widget needs a browser session; stand it in with the
+        # "not started" value the app already handles
+        import streamlit_webrtc
+        streamlit_webrtc.webrtc_streamer = lambda **kwargs: None
+
+        at.text_input[0].input("Benchmark User")
+        at.text_input[1].input("12345-1234567-1")
+        result["login_run_ms"] = round(timed(at.button[0].click().run), 1)
+        if at.exception:
+            raise RuntimeError(at.exception[0].value)
+
+        interactions = {
+            "rerun": lambda i: at.run(),
+            "show_my_qr": lambda i: next(b for b in at.button if b.label == "Show My QR Code").click().run(),
+            "history_page_size": lambda i: at.selectbox(key="history_page_size").set_value([10, 25][i % 2]).run(),
+            "multi_code_toggle": lambda i: at.checkbox(key="multi_code").set_value(i % 2 == 0).run(),
+        }
+        result["rerun_ms"] = {}
+        for name, interact in interactions.items():
+            times = [timed(lambda: interact(i)) for i in range(reruns)]
+            if at.exception:
+                raise RuntimeError(f"{name}: {at.exception[0].value}")
+            result["rerun_ms"][name] = percentiles(times)
+    return result
+
+def run(app_path, reruns):
+    context = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(max_workers=1, mp_context=context) as pool:
+        return pool.submit(measure, app_path, reruns).result()
+
+def compare(result, baseline, tolerance):
+    regressions = []
+    for key in ("cold_run_ms", "login_run_ms"):
+        if baseline.get(key) and result[key] > baseline[key] * (1 + tolerance):
+            regressions.append(f"{key}: {baseline[key]} ms -> {result[key]} ms")
+    for name, latency in result["rerun_ms"].items():
+        old = baseline.get("rerun_ms", {}).get(name)
+        if old and latency["p95"] > old["p95"] * (1 + tolerance):
+            regressions.append(f"{name} p95: {old['p95']} ms -> {latency['p95']} ms")
+    return regressions
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Measure Streamlit cold start and rerun times")
+    parser.add_argument("--app", default=APP_PATH, help="Streamlit script to run")
+    parser.add_argument("--reruns", type=int, default=10, help="Repetitions of each interaction")
+    parser.add_argument("--json", help="Write the results to this file")
+    parser.add_argument("--compare", help="Baseline JSON from an earlier run to check for regressions")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="Allowed relative slowdown over the baseline")
+    args = parser.parse_args(argv)
+    if args.reruns < 1:
+        parser.error("--reruns must be at least 1")
+
+    result = run(args.app, args.reruns)
+    print(f"streamlit import   {result['streamlit_import_ms']:>8.1f} ms")
+    print(f"cold first run     {result['cold_run_ms']:>8.1f} ms  "
+          f"(heavy modules: {', '.join(result['heavy_modules_at_login_page']) or 'none'})")
+    print(f"first run logged in {result['login_run_ms']:>7.1f} ms")
+    for name, latency in result["rerun_ms"].items():
+        print(f"{name:<18} p50 {latency['p50']:>7.1f} ms  p95 {latency['p95']:>7.1f} ms")
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(result, f, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(result, json.load(f), args.tolerance)
+        for line in regressions:
+            print(f"REGRESSION {line}")
+        return 1 if regressions else 0
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,119 +1,18 @@
 import streamlit as st
-import cv2
-import numpy as np
-from PIL import Image, ImageDraw, ImageFont
-import io
-import re
-import json
-import time
-import qrcode
 
-# Set page configuration
-
-from streamlit_webrtc import webrtc_streamer, VideoTransformerBase
-import av
+# Only light modules here: OpenCV, qrcode, PyAV and streamlit_webrtc are
+# imported where they are first needed, so the login page never loads them
+from qrpay.assets import load_static
+from qrpay.payload import parse_qr_data
+from qrpay.payments import validate_cnic, new_scan_session
+from qrpay.ledger import AccountNameMismatch, InsufficientFunds, UnknownAccount
+from qrpay.metrics import start_metrics_server
+from qrpay.service import get_service
 
-class QRCodeScanner(VideoTransformerBase):
-    def __init__(self):
-        # Reset all internal state variables
-        self.qr_code = None
-        self.qr_detector = cv2.QRCodeDetector()
-        self.detection_counter = 0  # Counter for consecutive detections
-        self.last_data = None       # Store last detected data for consistency check
-        self.detection_threshold = 2 # Number of consecutive detections required
-        self.qr_detected = False    # Flag to track if QR has been detected and processed
-        self.frame_count = 0        # Counter for frame processing optimization
-        
-        # Check session state and reset QR detection flags if needed
-        if hasattr(st, 'session_state'):
-            # Initialize auto_stop_camera flag if it doesn't exist
-            if 'auto_stop_camera' not in st.session_state:
-                st.session_state.auto_stop_camera = False
-                
-            # Reset QR detection flags in session state if they were set from a previous scan
-            if hasattr(st.session_state, 'scan_state') and st.session_state.scan_state == "detected":
-                print("QRCodeScanner initialized with previous detection state, resetting...")
-                st.session_state.scan_state = "idle"
-                st.session_state.qr_detection_complete = False
+# Prometheus /metrics for this process when QRPAY_METRICS_PORT is set
+start_metrics_server()
 
-    def recv(self, frame):
-        img = frame.to_ndarray(format="bgr24")
-        
-        # If QR already detected and processed, just return the frame with success indicator
-        # and don't attempt to detect QR codes anymore
-        if self.qr_detected or (hasattr(st, 'session_state') and 
-                               hasattr(st.session_state, 'scan_state') and 
-                               (st.session_state.scan_state == "detected" or 
-                                st.session_state.stop_webrtc == True)) or \
-                               (hasattr(st.session_state, 'qr_processed') and 
-                                st.session_state.qr_processed):
-            # Draw a success indicator on the frame
-            cv2.putText(img, "QR Code Detected! Processing payment...", (10, 30),
-                        cv2.FONT_HERSHEY_SIMPLEX, 0.7, (0, 255, 0), 2)
-            return av.VideoFrame.from_ndarray(img, format="bgr24")
-        
-        # Skip every other frame for performance optimization
-        self.frame_count += 1
-        if self.frame_count % 2 != 0:
-            return av.VideoFrame.from_ndarray(img, format="bgr24")
-            
-        # Try to detect QR code
-        data, bbox, _ = self.qr_detector.detectAndDecode(img)
-        
-        # If QR code is detected
-        if bbox is not None and data:
-            # Verify detection consistency to avoid false positives
-            if data == self.last_data:
-                self.detection_counter += 1
-            else:
-                self.detection_counter = 1
-                self.last_data = data
-            
-            # Draw the bounding box and text
-            cv2.polylines(img, [bbox.astype(int)], True, (0, 255, 0), 2)
-            cv2.putText(img, "QR Detected", (10, 30), cv2.FONT_HERSHEY_SIMPLEX, 0.8, (0, 255, 0), 2)
-            
-            # Only confirm detection after consistent readings to avoid false positives
-            if self.detection_counter >= self.detection_threshold:
-                self.qr_code = data  # Set the result property that's checked in main code
-                print(f"Confirmed QR code detection: {data[:50]}...")
-                
-                # Set the flag to stop further processing
-                self.qr_detected = True
-                
-                # Update session state - only if we haven't already detected a QR code
-                # Use a try-except block to handle potential ScriptRunContext errors
-                try:
-                    if hasattr(st, 'session_state') and not st.session_state.qr_detection_complete and not st.session_state.qr_processed:
-                        # Set all the necessary flags to stop the camera and process the QR code
-                        st.session_state.camera_active = False
-                        st.session_state.scan_state = "detected"
-                        st.session_state.qr_detection_complete = True
-                        
-                        # Store QR data in session state to ensure it's available after rerun
-                        st.session_state.qr_result = data
-                        
-                        # Set flag to stop the WebRTC context on next rerun
-                        st.session_state.stop_webrtc = True
-                        # Set flag to indicate QR code has been processed
-                        st.session_state.qr_processed = True
-                        # Set flag to indicate that the stop buttons should be automatically clicked
-                        st.session_state.auto_stop_camera = True
-                        print("Set flag to stop WebRTC context and auto-click stop buttons on next rerun")
-                        
-                        # Trigger a rerun to update UI and stop camera - ONLY ONCE
-                        print("QR detection complete, triggering rerun to update UI and stop camera")
-                        st.rerun()
-                except Exception as e:
-                    # This will catch the ScriptRunContext missing error in async threads
-                    print(f"Async thread error (can be ignored): {str(e)}")
-                    # Just set the flags but don't try to rerun
-                    self.qr_detected = True
-        else:
-            # Reset detection counter if no QR code found
-            self.detection_counter = 0
-            
-        return av.VideoFrame.from_ndarray(img, format="bgr24")
+# Set page configuration
 
 st.set_page_config(
     page_title="QR Payment System",
@@ -122,266 +21,215 @@ st.set_page_config(
     initial_sidebar_state="expanded"
 )
 
-# Custom CSS for better UI
-st.markdown("""
-<style>
-.main-header {
-    font-size: 2.5rem;
-    color: #3F51B5;
-    text-align: center;
-    margin-bottom: 1rem;
-    font-weight: bold;
-}
-.sub-header {
-    font-size: 1.5rem;
-    color: #303F9F;
-    margin-bottom: 1rem;
-}
-.info-box {
-    background-color: #E8EAF6;
-    padding: 1rem;
-    border-radius: 0.5rem;
-    margin: 1rem 0;
-    border-left: 5px solid #3F51B5;
-    color: #000000;
-}
-.success-box {
-    background-color: #E8F5E9;
-    padding: 1rem;
-    border-radius: 0.5rem;
-    margin: 1rem 0;
-    border-left: 5px solid #4CAF50;
-    color: #000000;
-}
-.error-box {
-    background-color: #FFEBEE;
-    padding: 1rem;
-    border-radius: 0.5rem;
-    margin: 1rem 0;
-    border-left: 5px solid #F44336;
-    color: #000000;
-}
-.warning-box {
-    background-color: #FFF8E1;
-    padding: 1rem;
-    border-radius: 0.5rem;
-    margin: 1rem 0;
-    border-left: 5px solid #FFC107;
-    color: #000000;
-}
-.qr-container {
-    display: flex;
-    justify-content: center;
-    margin: 2rem 0;
-}
-.result-text {
-    font-size: 1.2rem;
-    background-color: #f0f2f6;
-    padding: 1rem;
-    border-radius: 0.5rem;
-    margin: 1rem 0;
-    border-left: 5px solid #4CAF50;
-    color: #000000;
-}
-.status-text {
-    font-size: 1rem;
-    color: #FF5722;
-}
-.success-text {
-    font-size: 1.2rem;
-    color: #4CAF50;
-    font-weight: bold;
-}
-.centered-image {
-    display: flex;
-    justify-content: center;
-}
-.balance-display {
-    font-size: 1.5rem;
-    font-weight: bold;
-    color: #3F51B5;
-    text-align: center;
-    padding: 1rem;
-    background-color: #E8EAF6;
-    border-radius: 0.5rem;
-    margin: 1rem 0;
-}
-.tab-content {
-    padding: 1rem;
-    border: 1px solid #ddd;
-    border-radius: 0.5rem;
-    margin-top: 1rem;
-}
-.transaction-details {
-    background-color: #E3F2FD;
-    padding: 1rem;
-    border-radius: 0.5rem;
-    margin: 1rem 0;
-    border-left: 5px solid #2196F3;
-    color: #000000;
-}
-</style>
-""", unsafe_allow_html=True)
+# Custom CSS for better UI (read from disk once per process)
+st.markdown(f"<style>{load_static('app.css')}</style>", unsafe_allow_html=True)
 
 # App title and description
 st.markdown('<p class="main-header">QR Payment System</p>', unsafe_allow_html=True)
 
-# Initialize session state variables if they don't exist
-if 'user_logged_in' not in st.session_state:
-    st.session_state.user_logged_in = False
-if 'username' not in st.session_state:
-    st.session_state.username = ""
-if 'user_cnic' not in st.session_state:
-    st.session_state.user_cnic = ""
-if 'balance' not in st.session_state:
-    st.session_state.balance = 0.0
-if 'qr_result' not in st.session_state:
-    st.session_state.qr_result = None
-if 'scanning' not in st.session_state:
-    st.session_state.scanning = False
-if 'payment_confirmed' not in st.session_state:
-    st.session_state.payment_confirmed = False
-if 'payment_amount' not in st.session_state:
-    st.session_state.payment_amount = 0.0
-if 'payment_recipient' not in st.session_state:
-    st.session_state.payment_recipient = ""
-if 'payment_cnic' not in st.session_state:
-    st.session_state.payment_cnic = ""
-if 'transaction_history' not in st.session_state:
-    st.session_state.transaction_history = []
-if 'show_my_qr' not in st.session_state:
-    st.session_state.show_my_qr = False
-if 'scan_state' not in st.session_state:
-    st.session_state.scan_state = "idle"  # idle, scanning, detected, confirmed
-if 'parsed_payment_data' not in st.session_state:
-    st.session_state.parsed_payment_data = None
-if 'active_tab' not in st.session_state:
-    st.session_state.active_tab = "My QR Code"  # Track which tab is active
-if 'camera_active' not in st.session_state:
-    st.session_state.camera_active = False  # Track camera state specifically for Scan & Pay tab
-if 'qr_detection_complete' not in st.session_state:
-    st.session_state.qr_detection_complete = False  # Flag to indicate QR detection is complete and UI should update
-if 'stop_webrtc' not in st.session_state:
-    st.session_state.stop_webrtc = False  # Flag to stop the WebRTC context on next rerun
+# Session defaults, set in one pass on the first run of a session (and again
+# after logout, which deletes every key) instead of checking each key on
+# every rerun
+def session_defaults():
+    return {
+        "user_logged_in": False,
+        "username": "",
+        "user_cnic": "",
+        "balance": 0.0,
+        "qr_result": None,
+        "scanning": False,
+        "payment_confirmed": False,
+        "payment_amount": 0.0,
+        "payment_recipient": "",
+        "payment_cnic": "",
+        "show_my_qr": False,
+        "scan_state": "idle",  # idle, scanning, detected, confirmed
+        "parsed_payment_data": None,
+        "active_tab": "My QR Code",  # Track which tab is active
+        "camera_active": False,  # Track camera state specifically for Scan & Pay tab
+        "qr_detection_complete": False,  # Flag to indicate QR detection is complete and UI should update
+        "stop_webrtc": False,  # Flag to stop the WebRTC context on next rerun
+        "multi_code": False,  # Decode every QR code in view in the live scanner
+        "debug_overlay": False,  # Draw FPS and decode time on the live scanner frames
+        "profile_scan": False,  # Profile the live scanner from its next frame
+        "profile_record": False,  # Also record that scan's frames for replay
+        "qr_processed": False,  # The confirmed live-scanner code has been parsed; cleared on each new scan
+        "qr_candidates": [],  # Codes confirmed together in multi-code mode, waiting for the user to pick one
+        "last_payment": None,  # Ledger transaction of the most recent payment
+        "history_cursors": [None],  # before_id of each Transaction History page visited so far
+        "history_filters": None,  # Filters the cursors above belong to
+        "scan_session": new_scan_session(),  # Rotated on each new scan or upload; part of the idempotency key
+        "upload_id": None,  # file_id of the upload the scan session above was started for
+        "upload_preview": None,  # Reduced preview image of that upload, or the error reading its header
+    }
 
-# Function to validate CNIC format
-def validate_cnic(cnic):
-    # Pattern for CNIC: 00000-0000000-0 (exactly this format)
-    pattern = r'^\d{5}-\d{7}-\d{1}$'
-    return bool(re.match(pattern, cnic))
+if "session_initialized" not in st.session_state:
+    for key, value in session_defaults().items():
+        if key not in st.session_state:
+            st.session_state[key] = value
+    st.session_state.session_initialized = True
 
-# Function to generate QR code
-# Function to generate QR code (simplified version)
-def generate_qr_code(data, box_size=10):
-    # Convert data to JSON string
-    json_data = json.dumps(data)
-    
-    # Create QR code instance
-    qr = qrcode.QRCode(
-        version=1,
-        error_correction=qrcode.constants.ERROR_CORRECT_H,
-        box_size=box_size,  # Adjustable box size parameter
-        border=4,
-    )
+# Function to describe a detected QR code in the multi-code pick list
+def describe_qr_candidate(index, qr_data):
+    payment_data = parse_qr_data(qr_data)
+    if payment_data:
+        return f"{index + 1}. {payment_data['sender']} - PKR {payment_data['amount']:.2f}"
+    return f"{index + 1}. Not a payment QR code"
+
+# The balance shown everywhere mirrors the ledger, which other sessions
+# (e.g. someone paying this user) may have changed since the last rerun
+if st.session_state.user_logged_in:
+    try:
+        st.session_state.balance = get_service().balance(st.session_state.user_cnic)
+    except UnknownAccount:
+        # The ledger (or the API server's) no longer has this account, e.g.
+        # after a reset; start over from the login form
+        for key in list(st.session_state.keys()):
+            del st.session_state[key]
+        for key, value in session_defaults().items():
+            st.session_state[key] = value
+        st.session_state.session_initialized = True
+        st.warning("Your account was not found. Please log in again.")
+
+# Function to process payment
+def process_payment(amount, recipient, cnic, qr_data):
+    # The same QR code paid again in the same scan session (double click,
+    # rerun, scanning it twice) gets the original transaction back instead
+    # of a second debit
+    try:
+        # Debit (and credit the recipient, if they have an account) atomically
+        transaction = get_service().pay(
+            st.session_state.user_cnic, amount, recipient, cnic, qr_data, st.session_state.scan_session
+        )
+    except InsufficientFunds as e:
+        st.session_state.balance = e.args[0]
+        return False, f"Insufficient funds. Your balance is PKR {st.session_state.balance:.2f}.", None
+    except ValueError as e:
+        # e.g. the user scanned their own QR code
+        return False, f"Payment not made: {str(e)}.", None
+    st.session_state.balance = get_service().balance(st.session_state.user_cnic)
+    st.session_state.last_payment = transaction
+    if transaction["replayed"]:
+        return True, f"This payment to {recipient} was already made at {transaction['date']}. You were not charged again.", transaction
+    return True, f"Payment of PKR {amount:.2f} to {recipient} was successful.", transaction
+
+# Totals read from the ledger's incrementally maintained aggregates, so this
+# costs the same however long the history is
+def render_ledger_summary():
+    service = get_service()
+    summary = service.summary(st.session_state.user_cnic)
+    col_today, col_month_paid, col_month_received = st.columns(3)
+    col_today.metric("Paid Today", f"PKR {summary['today']['paid']:.2f}")
+    col_month_paid.metric("Paid This Month", f"PKR {summary['month']['paid']:.2f}")
+    col_month_received.metric("Received This Month", f"PKR {summary['month']['received']:.2f}")
     
-    # Add data to QR code
-    qr.add_data(json_data)
-    qr.make(fit=True)
+    with st.expander("📈 Summary"):
+        period = st.radio("Totals per", ["Day", "Month"], horizontal=True, key="history_summary_period")
+        totals = service.period_totals(st.session_state.user_cnic, period.lower(), limit=30 if period == "Day" else 12)
+        if totals:
+            st.bar_chart(
+                {"Period": [t['period'] for t in reversed(totals)],
+                 "Paid": [t['paid'] for t in reversed(totals)],
+                 "Received": [t['received'] for t in reversed(totals)]},
+                x="Period", y=["Paid", "Received"],
+            )
+        st.markdown("**Top Counterparties**")
+        st.dataframe(
+            service.top_counterparties(st.session_state.user_cnic),
+            hide_index=True,
+            use_container_width=True,
+            column_config={
+                "counterparty": "Counterparty",
+                "counterparty_cnic": "CNIC",
+                "paid": st.column_config.NumberColumn("Paid (PKR)", format="%.2f"),
+                "received": st.column_config.NumberColumn("Received (PKR)", format="%.2f"),
+                "count": "Transactions",
+            },
+        )
+
+# Transaction History tab. Runs as a fragment, so paging and filtering only
+# rerun this part of the page, and each run fetches just the visible page.
+@st.fragment
+def render_transaction_history():
+    filter_col1, filter_col2, filter_col3 = st.columns([2, 2, 1])
+    with filter_col1:
+        date_range = st.date_input("Date range", value=(), key="history_dates")
+    with filter_col2:
+        counterparty = st.text_input("Counterparty", placeholder="Name or 00000-0000000-0", key="history_counterparty").strip()
+    with filter_col3:
+        page_size = st.selectbox("Per page", [10, 25, 50, 100], index=1, key="history_page_size")
+    table_view = st.toggle("Table view", key="history_table_view")
     
-    # Create an image from the QR Code
-    img = qr.make_image(fill_color="black", back_color="white")
+    since = date_range[0] if len(date_range) > 0 else None
+    until = date_range[1] if len(date_range) > 1 else since
+    filters = (since, until, counterparty, page_size)
+    if st.session_state.history_filters != filters:
+        # New filters start again from the newest transaction
+        st.session_state.history_filters = filters
+        st.session_state.history_cursors = [None]
+    cursors = st.session_state.history_cursors
     
-    # Convert to RGB if not already
-    if img.mode != 'RGB':
-        img = img.convert('RGB')
+    # One extra row tells whether there is an older page
+    rows = get_service().list_transactions(
+        st.session_state.user_cnic, page_size + 1, cursors[-1], since, until, counterparty
+    )
+    transactions, has_older = rows[:page_size], len(rows) > page_size
     
-    return img
-
-# Function to detect QR codes
-def detect_qr_code(frame):
-    # Initialize the QR code detector
-    qr_detector = cv2.QRCodeDetector()
+    if not transactions:
+        if since or counterparty:
+            st.info("No transactions match these filters.")
+        else:
+            st.markdown('''
+            <div class="info-box">
+                <h3>No Transactions Yet</h3>
+                <p>Your transaction history will appear here after you make your first payment.</p>
+            </div>
+            ''', unsafe_allow_html=True)
+        return
     
-    # Create a copy of the frame for display
-    display_frame = frame.copy()
-    qr_value = None
+    st.markdown(f'<div class="balance-display">Current Balance: PKR {st.session_state.balance:.2f}</div>', unsafe_allow_html=True)
+    render_ledger_summary()
     
-    try:
-        # For OpenCV 4.5.4 and above, use detectAndDecodeMulti
-        ret_qr, decoded_info, points, _ = qr_detector.detectAndDecodeMulti(frame)
-        
-        # If QR codes are detected
-        if ret_qr:
-            for s, p in zip(decoded_info, points):
-                # If the QR code contains data
-                if s:
-                    qr_value = s  # Assign the QR code value to the variable
-                    color = (0, 255, 0)  # Green color for successful decode
-                    
-                    # Draw a polygon around the QR code
-                    display_frame = cv2.polylines(display_frame, [p.astype(int)], True, color, 8)
-                    
-                    # Display the decoded text on the frame
-                    display_frame = cv2.putText(display_frame, "QR Code Detected", p[0].astype(int), 
-                                      cv2.FONT_HERSHEY_SIMPLEX, 0.8, (0, 0, 255), 2)
-                    break
-    except Exception as e:
-        # For older versions of OpenCV, use detectAndDecode
-        try:
-            data, bbox, _ = qr_detector.detectAndDecode(frame)
-            
-            # If a QR code is detected and contains data
-            if bbox is not None and data:
-                qr_value = data  # Assign the QR code value to the variable
-                
-                # Draw a polygon around the QR code
-                bbox = bbox.astype(int)
-                display_frame = cv2.polylines(display_frame, [bbox], True, (0, 255, 0), 8)
-                
-                # Display the decoded text on the frame
-                display_frame = cv2.putText(display_frame, "QR Code Detected", (bbox[0][0], bbox[0][1] - 10), 
-                                  cv2.FONT_HERSHEY_SIMPLEX, 0.8, (0, 0, 255), 2)
-        except Exception as e:
-            # Just continue if there's an error
-            pass
-    
-    return display_frame, qr_value
-
-# Function to process payment
-def process_payment(amount, recipient, cnic):
-    if st.session_state.balance >= amount:
-        # Update user balance
-        st.session_state.balance -= amount
-        
-        # Record the transaction
-        transaction = {
-            "date": time.strftime("%Y-%m-%d %H:%M:%S"),
-            "type": "payment",
-            "amount": amount,
-            "recipient": recipient,
-            "recipient_cnic": cnic,
-            "balance_after": st.session_state.balance
-        }
-        
-        st.session_state.transaction_history.append(transaction)
-        
-        return True, f"Payment of PKR {amount:.2f} to {recipient} was successful."
+    if table_view:
+        st.dataframe(
+            transactions,
+            hide_index=True,
+            use_container_width=True,
+            column_order=["id", "date", "type", "amount", "counterparty", "counterparty_cnic", "balance_after"],
+            column_config={
+                "id": "#",
+                "date": "Date",
+                "type": "Type",
+                "amount": st.column_config.NumberColumn("Amount (PKR)", format="%.2f"),
+                "counterparty": "Counterparty",
+                "counterparty_cnic": "Counterparty CNIC",
+                "balance_after": st.column_config.NumberColumn("Balance After (PKR)", format="%.2f"),
+            },
+        )
     else:
-        return False, f"Insufficient funds. Your balance is PKR {st.session_state.balance:.2f}."
-
-# Function to parse QR data
-def parse_qr_data(qr_data):
-    try:
-        payment_data = json.loads(qr_data)
-        if 'type' in payment_data and payment_data['type'] == 'payment':
-            print(f"Valid payment QR code detected: {payment_data}")
-            return payment_data
-        else:
-            print("Invalid QR code: Not a payment request.")
-            return None
-    except Exception as e:
-        print(f"Error parsing QR code data: {str(e)}")
-        return None
+        for transaction in transactions:
+            counterparty_label = "Recipient" if transaction['type'] == "payment" else "From"
+            st.markdown(f'''
+            <div class="transaction-details">
+                <h4>Transaction #{transaction['id']}</h4>
+                <p><strong>Date:</strong> {transaction['date']}</p>
+                <p><strong>Type:</strong> {transaction['type'].title()}</p>
+                <p><strong>Amount:</strong> PKR {transaction['amount']:.2f}</p>
+                <p><strong>{counterparty_label}:</strong> {transaction['counterparty']}</p>
+                <p><strong>{counterparty_label} CNIC:</strong> {transaction['counterparty_cnic']}</p>
+                <p><strong>Balance After:</strong> PKR {transaction['balance_after']:.2f}</p>
+            </div>
+            ''', unsafe_allow_html=True)
+    
+    col_newer, col_page, col_older = st.columns([1, 2, 1])
+    # Callbacks move the cursor before the fragment reruns
+    with col_newer:
+        st.button("⬅️ Newer", key="history_newer", disabled=len(cursors) == 1, on_click=cursors.pop)
+    with col_page:
+        st.markdown(f"<p style='text-align: center;'>Page {len(cursors)}</p>", unsafe_allow_html=True)
+    with col_older:
+        st.button("Older ➡️", key="history_older", disabled=not has_older,
+                  on_click=cursors.append, args=(transactions[-1]['id'],))
 
 # Function to detect QR code continuously
 # Function to handle real-time QR code scanning using the local function
@@ -404,18 +252,42 @@ with st.sidebar:
                 elif not validate_cnic(user_cnic):
                     st.error("CNIC must be in the exact format: 00000-0000000-0")
                 else:
-                    st.session_state.user_logged_in = True
-                    st.session_state.username = username
-                    st.session_state.user_cnic = user_cnic
-                    st.session_state.balance = initial_balance
-                    st.success(f"Welcome, {username}!")
-                    st.rerun()
+                    # Returning users keep the balance stored in the ledger
+                    try:
+                        account = get_service().open_account(user_cnic, username, initial_balance)
+                    except AccountNameMismatch:
+                        st.error("This CNIC already has an account under a different name.")
+                    else:
+                        st.session_state.user_logged_in = True
+                        st.session_state.username = account["name"]
+                        st.session_state.user_cnic = user_cnic
+                        st.session_state.balance = account["balance"]
+                        # Get the QR detectors ready while the user finds their way to a scan
+                        get_service().warm_up()
+                        st.success(f"Welcome, {account['name']}!")
+                        st.rerun()
     else:
         st.markdown('<p class="sub-header">User Information</p>', unsafe_allow_html=True)
         st.markdown(f"**Name:** {st.session_state.username}")
         st.markdown(f"**CNIC:** {st.session_state.user_cnic}")
         st.markdown(f'<div class="balance-display">Balance: PKR {st.session_state.balance:.2f}</div>', unsafe_allow_html=True)
-        
+
+        # Sampling profiler, for finding out why a kiosk has become slow
+        with st.expander("🛠️ Diagnostics"):
+            st.number_input("Profile duration (seconds)", min_value=1, max_value=120, value=10, key="profile_seconds")
+            if st.button("Profile app", key="profile_app"):
+                from qrpay.profiler import start_profile
+                session = start_profile("app", st.session_state.profile_seconds)
+                if session:
+                    st.info(f"Profiling every thread, writing {session.path}")
+                else:
+                    st.warning("A profile is already running.")
+            st.checkbox("Record scanned frames for replay", key="profile_record",
+                        help="Keeps up to a few hundred frames in memory while profiling the next scan")
+            if st.button("Profile next scan", key="profile_next_scan"):
+                st.session_state.profile_scan = True
+                st.info("The live scanner is profiled from its next frame.")
+
         if st.button("Logout"):
             # Reset all session state variables
             for key in list(st.session_state.keys()):
@@ -483,12 +355,8 @@ else:
         # Display QR code if button was clicked
         if st.session_state.show_my_qr:
             # Generate QR code with smaller box size for better display
-            qr_img = generate_qr_code(user_data, box_size=6)
-            
-            # Convert PIL image to bytes for Streamlit
-            buf = io.BytesIO()
-            qr_img.save(buf, format="PNG")
-            byte_im = buf.getvalue()
+            # (PNG bytes come from the shared cache on reruns)
+            byte_im = get_service().generate_qr(user_data, box_size=6)
             
             # Display QR code with controlled width
             st.markdown('<div class="qr-container"></div>', unsafe_allow_html=True)
@@ -552,12 +420,7 @@ else:
             }
             
             # Generate QR code with smaller box size
-            qr_img = generate_qr_code(payment_data, box_size=6)
-            
-            # Convert PIL image to bytes for Streamlit
-            buf = io.BytesIO()
-            qr_img.save(buf, format="PNG")
-            byte_im = buf.getvalue()
+            byte_im = get_service().generate_qr(payment_data, box_size=6)
             
             # Display QR code with controlled width
             qr_placeholder.markdown('<div class="qr-container"></div>', unsafe_allow_html=True)
@@ -610,11 +473,14 @@ else:
                 with camera_col1:
                     if not st.session_state.camera_active:
                         if st.button("🎥 Start Camera", key="start_camera", use_container_width=True):
-                            # Reset all QR-related state variables when starting camera
+                            # Reset all QR-related state variables when starting camera;
+                            # a new scan session, so paying the same code again is a new payment
+                            st.session_state.scan_session = new_scan_session()
                             st.session_state.scan_state = "idle"
                             st.session_state.parsed_payment_data = None
                             st.session_state.qr_result = None
                             st.session_state.qr_detection_complete = False
+                            st.session_state.qr_candidates = []
                             # Reset the QR processed flag to allow new QR processing
                             st.session_state.qr_processed = False
                             st.session_state.stop_webrtc = False
@@ -634,6 +500,9 @@ else:
                 
                 # Real-time QR scanning using streamlit-webrtc
                 st.markdown("### 📷 Real-time QR Scanner")
+                st.checkbox("🔢 Detect multiple QR codes", key="multi_code",
+                            help="Read every QR code in view at once, then choose which one to pay")
+                st.checkbox("🐞 Show scanner FPS and decode time", key="debug_overlay")
                 
                 # Check if we need to stop the WebRTC context
                 if hasattr(st.session_state, 'stop_webrtc') and st.session_state.stop_webrtc:
@@ -655,6 +524,10 @@ else:
                             print("Automatically proceeding to payment processing")
                     # No need to rerun here as it can cause infinite loops
                 else:
+                    # Imported here so only logged-in pages load PyAV, OpenCV and aiortc
+                    from streamlit_webrtc import webrtc_streamer
+                    from qrpay.scanner import QRCodeScanner
+                    
                     # Start the WebRTC streamer normally
                     ctx = webrtc_streamer(
                         key="qrscanner",
@@ -663,6 +536,15 @@ else:
                         async_processing=True,
                     )
                     
+                    # Pass the multi-code and debug settings to the running scanner
+                    if ctx and ctx.video_processor:
+                        ctx.video_processor.multi_code = st.session_state.multi_code
+                        ctx.video_processor.debug_overlay = st.session_state.debug_overlay
+                        if st.session_state.profile_scan:
+                            ctx.video_processor.start_profile(seconds=st.session_state.get("profile_seconds", 10),
+                                                              record=st.session_state.profile_record)
+                            st.session_state.profile_scan = False
+                    
                     # If the streamer is active and we have a QR detection flag, try to stop it
                     if ctx and ctx.state and ctx.state.playing and (st.session_state.qr_detection_complete or st.session_state.auto_stop_camera):
                         try:
@@ -679,8 +561,29 @@ else:
                 ctx_has_qr = False
                 if 'ctx' in locals() and ctx is not None and ctx.video_processor and ctx.video_processor.qr_code:
                     ctx_has_qr = True
+                
+                # Several codes confirmed in one pass: take them from the scanner for the pick list
+                if 'ctx' in locals() and ctx is not None and ctx.video_processor and len(ctx.video_processor.qr_codes) > 1:
+                    st.session_state.qr_candidates = list(ctx.video_processor.qr_codes)
+                    ctx.video_processor.qr_codes = []
+                    st.session_state.camera_active = False
                     
-                if ctx_has_qr or st.session_state.qr_detection_complete:
+                if st.session_state.qr_candidates and not st.session_state.qr_processed:
+                    # Let the user choose which of the detected codes to pay
+                    candidates = st.session_state.qr_candidates
+                    st.success(f"✅ {len(candidates)} QR codes detected! Choose the one to pay.")
+                    choice = st.radio(
+                        "Detected QR codes",
+                        range(len(candidates)),
+                        format_func=lambda i: describe_qr_candidate(i, candidates[i]),
+                        key="qr_candidate_choice"
+                    )
+                    if st.button("✅ Use Selected QR Code", type="primary", key="use_qr_candidate"):
+                        st.session_state.qr_result = candidates[choice]
+                        st.session_state.qr_candidates = []
+                        st.session_state.qr_detection_complete = True
+                        st.rerun()
+                elif ctx_has_qr or st.session_state.qr_detection_complete:
                     # Get QR data either from video processor or from session state
                     if ctx_has_qr:
                         qr_data = ctx.video_processor.qr_code
@@ -702,10 +605,6 @@ else:
                     # This avoids potential errors and infinite loops
                     
                     # Process the QR code data - but only if we haven't already processed it
-                    # Add a flag to track if we've already processed this QR data
-                    if 'qr_processed' not in st.session_state:
-                        st.session_state.qr_processed = False
-                        
                     if not st.session_state.qr_processed:
                         try:
                             # Parse the QR data using our helper function
@@ -775,30 +674,24 @@ else:
                         with col1:
                             if st.button("💰 Pay Now", type="primary", key="quick_pay", use_container_width=True):
                                 print(f"Pay Now button clicked. Processing payment of {payment_data['amount']} to {payment_data['sender']}")
-                                success, message = process_payment(
+                                success, message, transaction = process_payment(
                                     payment_data['amount'],
                                     payment_data['sender'],
-                                    payment_data['sender_cnic']
+                                    payment_data['sender_cnic'],
+                                    st.session_state.qr_result
                                 )
                                 if success:
                                     # Update state for successful payment
                                     st.session_state.scan_state = "confirmed"
                                     # Make sure camera is stopped
                                     st.session_state.camera_active = False
-                                    # Show celebration effect
-                                    st.balloons()
-                                    # Add success message with transaction details
-                                    st.success(f"💰 Payment of PKR {payment_data['amount']:.2f} to {payment_data['sender']} was successful!")
-                                    
-                                    # Add transaction to history
-                                    transaction = {
-                                        "date": time.strftime("%Y-%m-%d %H:%M:%S"),
-                                        "type": "payment",
-                                        "amount": payment_data['amount'],
-                                        "recipient": payment_data['sender'],
-                                        "recipient_cnic": payment_data['sender_cnic'],
-                                        "balance_after": st.session_state.balance
-                                    }
+                                    if transaction['replayed']:
+                                        st.info(f"ℹ️ {message}")
+                                    else:
+                                        # Show celebration effect
+                                        st.balloons()
+                                        # Add success message with transaction details
+                                        st.success(f"💰 Payment of PKR {payment_data['amount']:.2f} to {payment_data['sender']} was successful!")
                                     
                                     # Show transaction details
                                     st.markdown(f'''
@@ -806,7 +699,7 @@ else:
                                         <h4>Transaction Details</h4>
                                         <p><strong>Date:</strong> {transaction['date']}</p>
                                         <p><strong>Amount:</strong> PKR {transaction['amount']:.2f}</p>
-                                        <p><strong>Recipient:</strong> {transaction['recipient']}</p>
+                                        <p><strong>Recipient:</strong> {transaction['counterparty']}</p>
                                         <p><strong>New Balance:</strong> PKR {transaction['balance_after']:.2f}</p>
                                     </div>
                                     ''', unsafe_allow_html=True)
@@ -815,10 +708,12 @@ else:
                                     st.markdown("### Next Actions")
                                     if st.button("📷 Scan Another QR Code", key="scan_another"):
                                         # Reset for new scan - completely reset all QR-related state variables
+                                        st.session_state.scan_session = new_scan_session()
                                         st.session_state.scan_state = "idle"
                                         st.session_state.parsed_payment_data = None
                                         st.session_state.qr_result = None
                                         st.session_state.qr_detection_complete = False
+                                        st.session_state.qr_candidates = []
                                         st.session_state.stop_webrtc = False
                                         st.session_state.camera_active = True
                                         # Reset the QR processed flag to allow new QR processing
@@ -880,35 +775,47 @@ else:
                 )
             
                 if uploaded_file is not None:
+                    if uploaded_file.file_id != st.session_state.upload_id:
+                        # Each new upload is a new scan session
+                        st.session_state.upload_id = uploaded_file.file_id
+                        st.session_state.scan_session = new_scan_session()
+                        # Preview built once per upload from a reduced decode,
+                        # after the header has passed the size checks
+                        from qrpay.ingest import upload_preview
+                        try:
+                            st.session_state.upload_preview = upload_preview(uploaded_file.getvalue())
+                        except ValueError as e:
+                            st.session_state.upload_preview = str(e)
                     # Process uploaded image
-                    image = Image.open(uploaded_file)
-                    st.image(image, caption="Uploaded Image", width=300)
-                    
-                    # Convert to numpy array
-                    img_array = np.array(image)
-                    
-                    # Convert RGB to BGR for OpenCV
-                    if len(img_array.shape) == 3 and img_array.shape[2] == 3:
-                        img_array = cv2.cvtColor(img_array, cv2.COLOR_RGB2BGR)
+                    if isinstance(st.session_state.upload_preview, str):
+                        st.warning(f"⚠️ Cannot preview this image: {st.session_state.upload_preview}")
+                    else:
+                        st.image(st.session_state.upload_preview, caption="Uploaded Image", width=300)
                     
                     # Process button
                     if st.button("🔍 Scan Uploaded Image", type="primary"):
                         with st.spinner("Processing image..."):
-                            display_frame, qr_value = detect_qr_code(img_array)
+                            # The encoded file goes to the service as is; it
+                            # does the decoding (here or on the API server)
+                            try:
+                                qr_value = get_service().decode_image(uploaded_file.getvalue())
+                            except ValueError as e:
+                                st.error(f"❌ Could not read the uploaded image: {str(e)}")
+                                qr_value = None
                             
                             if qr_value:
                                 st.success("✅ QR Code found in image!")
                                 
                                 # Parse the QR data
-                                parsed_data, is_valid, message = parse_qr_data(qr_value)
+                                parsed_data = parse_qr_data(qr_value)
                                 
-                                if is_valid:
+                                if parsed_data:
                                     st.session_state.qr_result = qr_value
                                     st.session_state.parsed_payment_data = parsed_data
                                     st.session_state.scan_state = "detected"
                                     st.rerun()
                                 else:
-                                    st.error(f"❌ {message}")
+                                    st.error("❌ Invalid QR code: Not a valid payment request.")
                             else:
                                 st.error("❌ No QR code detected in the uploaded image.")
             
@@ -930,14 +837,18 @@ else:
                     # Payment confirmation
                     if st.session_state.balance >= payment_data['amount']:
                         if st.button("✅ Confirm Payment", type="primary", key="confirm_upload_payment"):
-                            success, message = process_payment(
+                            success, message, transaction = process_payment(
                                 payment_data['amount'],
                                 payment_data['sender'],
-                                payment_data['sender_cnic']
+                                payment_data['sender_cnic'],
+                                st.session_state.qr_result
                             )
                             if success:
                                 st.session_state.scan_state = "confirmed"
-                                st.success("🎉 Payment completed successfully!")
+                                if transaction['replayed']:
+                                    st.info(f"ℹ️ {message}")
+                                else:
+                                    st.success("🎉 Payment completed successfully!")
                                 st.rerun()
                             else:
                                 st.error(message)
@@ -961,14 +872,18 @@ else:
     # Payment success display (shown in both tabs)
     if st.session_state.scan_state == "confirmed":
         st.markdown("---")
-        if st.session_state.transaction_history:
-            last_transaction = st.session_state.transaction_history[-1]
+        last_transaction = st.session_state.last_payment
+        if last_transaction and last_transaction['replayed']:
+            # The same code was paid before in this scan session; nothing was charged
+            st.info(f"ℹ️ This payment to {last_transaction['counterparty']} was already made at "
+                    f"{last_transaction['date']}. You were not charged again.")
+        elif last_transaction:
             
             st.markdown(f'''
             <div class="success-box">
                 <h4>🎉 Payment Successful!</h4>
                 <p><strong>Amount Paid:</strong> PKR {last_transaction['amount']:.2f}</p>
-                <p><strong>Recipient:</strong> {last_transaction['recipient']}</p>
+                <p><strong>Recipient:</strong> {last_transaction['counterparty']}</p>
                 <p><strong>New Balance:</strong> PKR {last_transaction['balance_after']:.2f}</p>
                 <p><strong>Transaction Time:</strong> {last_transaction['date']}</p>
             </div>
@@ -977,6 +892,8 @@ else:
         col_reset1, col_reset2 = st.columns(2)
         with col_reset1:
             if st.button("🔄 Scan Another QR Code", key="scan_another_main"):
+                # A new scan session, so the next payment gets a new key
+                st.session_state.scan_session = new_scan_session()
                 st.session_state.scan_state = "idle"
                 st.session_state.qr_result = None
                 st.session_state.parsed_payment_data = None
@@ -984,6 +901,7 @@ else:
         
         with col_reset2:
             if st.button("📊 View Transactions", key="view_transactions"):
+                st.session_state.scan_session = new_scan_session()
                 st.session_state.scan_state = "idle"
                 st.session_state.qr_result = None
                 st.session_state.parsed_payment_data = None
@@ -998,29 +916,7 @@ else:
         st.markdown('<div class="tab-content">', unsafe_allow_html=True)
         st.markdown('<p class="sub-header">Transaction History</p>', unsafe_allow_html=True)
             
-        if st.session_state.transaction_history:
-            st.markdown(f'<div class="balance-display">Current Balance: PKR {st.session_state.balance:.2f}</div>', unsafe_allow_html=True)
-            
-            # Display transactions
-            for i, transaction in enumerate(reversed(st.session_state.transaction_history)):
-                st.markdown(f'''
-                <div class="transaction-details">
-                    <h4>Transaction #{len(st.session_state.transaction_history) - i}</h4>
-                    <p><strong>Date:</strong> {transaction['date']}</p>
-                    <p><strong>Type:</strong> {transaction['type'].title()}</p>
-                    <p><strong>Amount:</strong> PKR {transaction['amount']:.2f}</p>
-                    <p><strong>Recipient:</strong> {transaction['recipient']}</p>
-                    <p><strong>Recipient CNIC:</strong> {transaction['recipient_cnic']}</p>
-                    <p><strong>Balance After:</strong> PKR {transaction['balance_after']:.2f}</p>
-                </div>
-                ''', unsafe_allow_html=True)
-        else:
-            st.markdown('''
-            <div class="info-box">
-                <h3>No Transactions Yet</h3>
-                <p>Your transaction history will appear here after you make your first payment.</p>
-            </div>
-            ''', unsafe_allow_html=True)
+        render_transaction_history()
             
         st.markdown('</div>', unsafe_allow_html=True)
 